@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2024, Your Name'
+__docformat__ = 'restructuredtext en'
+
+# 传书基准测试：启动本地替身服务，用插件真实的上传代码（engine.BatchSender +
+# transfer.send_book）发送合成的 EPUB 语料，统计吞吐量、单本延迟分位数、
+# 峰值内存和 CPU 时间，结果写入 JSON 文件以便比较不同版本。
+#
+#   python bench/bench_transfer.py --corpus mixed --latency 0.005 --bandwidth 50
+#   python bench/bench_transfer.py --corpus small --compare bench_output.json
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import types
+import zipfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(os.path.dirname(HERE), 'src')
+
+# 语料：名称 -> [(本数, 每本字节数)]，实际大小再乘以 --scale
+CORPORA = {
+    'small': [(200, 100 * 1024)],
+    'huge': [(3, 100 * 1024 * 1024)],
+    'mixed': [(100, 200 * 1024), (20, 5 * 1024 * 1024), (2, 50 * 1024 * 1024)],
+}
+
+CONTAINER_XML = '''<?xml version="1.0"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/></rootfiles>
+</container>'''
+
+CONTENT_OPF = '''<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="2.0" unique-identifier="id">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:title>{title}</dc:title><dc:identifier id="id">{title}</dc:identifier><dc:language>zh</dc:language>
+  </metadata>
+  <manifest>
+    <item id="text" href="text.xhtml" media-type="application/xhtml+xml"/>
+    <item id="img" href="image.jpg" media-type="image/jpeg"/>
+  </manifest>
+  <spine><itemref idref="text"/></spine>
+</package>'''
+
+
+def load_plugin_modules():
+    """不执行插件的 __init__.py（依赖 calibre），直接从 src/ 导入不依赖 Qt 的模块。"""
+    if 'calibre_plugins.duokan_wifi_transfer' not in sys.modules:
+        namespace = sys.modules.setdefault('calibre_plugins', types.ModuleType('calibre_plugins'))
+        namespace.__path__ = getattr(namespace, '__path__', [])
+        package = types.ModuleType('calibre_plugins.duokan_wifi_transfer')
+        package.__path__ = [SRC]
+        sys.modules['calibre_plugins.duokan_wifi_transfer'] = package
+    from calibre_plugins.duokan_wifi_transfer import engine, transfer
+    return engine, transfer
+
+
+def write_epub(path, title, size):
+    """生成大小约为 size 的 EPUB，主体是不可压缩的随机“图片”。"""
+    with zipfile.ZipFile(path, 'w') as zf:
+        zf.writestr('mimetype', 'application/epub+zip', compress_type=zipfile.ZIP_STORED)
+        zf.writestr('META-INF/container.xml', CONTAINER_XML)
+        zf.writestr('OEBPS/content.opf', CONTENT_OPF.format(title=title))
+        zf.writestr('OEBPS/text.xhtml', f'<html><body><p>{title}</p></body></html>')
+        zf.writestr('OEBPS/image.jpg', os.urandom(max(size - 2048, 0)), compress_type=zipfile.ZIP_STORED)
+
+
+def build_corpus(name, scale, directory):
+    """生成（或复用已生成的）语料，返回书单。"""
+    books = []
+    for group, (count, size) in enumerate(CORPORA[name]):
+        size = max(int(size * scale), 4096)
+        for i in range(count):
+            title = f'{name}-{group}-{i:04d}'
+            path = os.path.join(directory, f'{title}-{size}.epub')
+            if not os.path.exists(path):
+                write_epub(path, title, size)
+            books.append({'title': title, 'path': path})
+    return books
+
+
+def start_server(args):
+    cmd = [
+        sys.executable, os.path.join(HERE, 'duokan_server.py'), '--port', '0',
+        '--latency', str(args.latency), '--bandwidth', str(args.bandwidth),
+        '--server-delay', str(args.server_delay), '--failure-rate', str(args.failure_rate),
+    ]
+    if args.seed is not None:
+        cmd += ['--seed', str(args.seed)]
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, universal_newlines=True)
+    port = int(proc.stdout.readline())
+    return proc, f'http://127.0.0.1:{port}'
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(int(round(fraction * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def peak_rss_bytes():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 以 KB 为单位，macOS 以字节为单位
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+            stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(args, books, address):
+    engine, transfer = load_plugin_modules()
+    latencies = []
+
+    def timed_send(path, title, **kwargs):
+        started = time.perf_counter()
+        try:
+            return transfer.send_book(path, title, chunk_size=args.chunk_size, **kwargs)
+        finally:
+            latencies.append(time.perf_counter() - started)
+
+    total_bytes = sum(os.path.getsize(book['path']) for book in books)
+    cpu_before = os.times()
+    started = time.perf_counter()
+    # 上传代码的调试输出很多，基准测试时丢弃
+    with contextlib.redirect_stdout(io.StringIO()):
+        sender = engine.BatchSender(timed_send, address, [dict(book) for book in books],
+                                    max_workers=args.concurrency, order=args.order)
+        success_count, failed_books = sender.run()
+    elapsed = time.perf_counter() - started
+    cpu_after = os.times()
+
+    return {
+        'books': len(books),
+        'succeeded': success_count,
+        'failed': len(failed_books),
+        'bytes': total_bytes,
+        'seconds': round(elapsed, 4),
+        'books_per_second': round(len(books) / elapsed, 3),
+        'mb_per_second': round(total_bytes / elapsed / 1024 / 1024, 3),
+        'latency_p50': round(percentile(latencies, 0.50), 4),
+        'latency_p95': round(percentile(latencies, 0.95), 4),
+        'cpu_seconds': round((cpu_after.user - cpu_before.user) + (cpu_after.system - cpu_before.system), 4),
+        'peak_rss_bytes': peak_rss_bytes(),
+    }
+
+
+def compare(result, previous_path):
+    with open(previous_path, 'rb') as f:
+        previous = json.loads(f.read().decode('utf-8'))['result']
+    print('\n与上次结果比较：')
+    for key in ('books_per_second', 'mb_per_second', 'latency_p50', 'latency_p95', 'cpu_seconds', 'peak_rss_bytes'):
+        old, new = previous.get(key), result.get(key)
+        if old and new is not None:
+            print(f'  {key:18s} {old:>14} -> {new:<14} ({(new - old) / old * 100:+.1f}%)')
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='多看阅读WiFi传书上传性能基准测试')
+    parser.add_argument('--corpus', choices=sorted(CORPORA), default='mixed')
+    parser.add_argument('--scale', type=float, default=1.0, help='语料中每本书大小的缩放比例')
+    parser.add_argument('--concurrency', type=int, default=2)
+    parser.add_argument('--order', choices=('original', 'smallest', 'largest'), default='original',
+                        help='发送顺序')
+    parser.add_argument('--chunk-size', type=int, default=512 * 1024)
+    parser.add_argument('--latency', type=float, default=0.0, help='模拟的网络延迟（秒）')
+    parser.add_argument('--bandwidth', type=float, default=0.0, help='服务端带宽上限（MB/s）')
+    parser.add_argument('--server-delay', type=float, default=0.0, help='服务端处理每本书的耗时（秒）')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='服务端随机失败的概率')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--corpus-dir', default=os.path.join(tempfile.gettempdir(), 'duokan_bench_corpus'))
+    parser.add_argument('--output', default='bench_output.json', help='结果 JSON 文件')
+    parser.add_argument('--compare', help='与之前的结果 JSON 文件比较')
+    parser.add_argument('--build-corpus-only', action='store_true', help=argparse.SUPPRESS)
+    return parser
+
+
+def prepare_corpus(args):
+    """在子进程中生成语料，生成时分配的内存不计入本进程的峰值 RSS。"""
+    subprocess.check_call([
+        sys.executable, os.path.abspath(__file__), '--build-corpus-only',
+        '--corpus', args.corpus, '--scale', str(args.scale), '--corpus-dir', args.corpus_dir])
+    return build_corpus(args.corpus, args.scale, args.corpus_dir)
+
+
+def main(args=None):
+    args = build_parser().parse_args(args)
+    if args.seed is not None:
+        random.seed(args.seed)
+    os.makedirs(args.corpus_dir, exist_ok=True)
+    if args.build_corpus_only:
+        build_corpus(args.corpus, args.scale, args.corpus_dir)
+        return 0
+    books = prepare_corpus(args)
+
+    proc, address = start_server(args)
+    try:
+        result = run_benchmark(args, books, address)
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {key: value for key, value in vars(args).items()
+                       if key not in ('output', 'compare', 'corpus_dir', 'build_corpus_only')},
+        'result': result,
+    }
+    for key, value in result.items():
+        print(f'{key:18s} {value}')
+    if args.compare:
+        compare(result, args.compare)
+    with open(args.output, 'wb') as f:
+        f.write(json.dumps(report, indent=2, ensure_ascii=False).encode('utf-8'))
+    return 1 if result['failed'] and not args.failure_rate else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
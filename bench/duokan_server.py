@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2024, Your Name'
+__docformat__ = 'restructuredtext en'
+
+# 多看阅读 WiFi 传书服务的本地替身，用于基准测试。
+# 实现 GET /、GET /files 和 POST /files，可模拟网络延迟、带宽上限、
+# 服务端处理耗时和随机失败。
+#
+#   python bench/duokan_server.py --port 0 --latency 0.005 --bandwidth 20
+
+import argparse
+import http.server
+import json
+import random
+import sys
+import threading
+import time
+
+
+class DuokanHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'DuokanStandIn/1.0'
+    # 响应头和响应体分两次写出，开启 Nagle 会与客户端的延迟 ACK 叠加出 40 ms 停顿
+    disable_nagle_algorithm = True
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def setup(self):
+        super(DuokanHandler, self).setup()
+        # 新建 TCP 连接的握手开销
+        time.sleep(self.server.options.latency)
+
+    def reply(self, status, body, content_type='text/plain; charset=utf-8'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        time.sleep(self.server.options.latency)
+        if self.path.rstrip('/') == '/files':
+            with self.server.lock:
+                listing = [{'name': name, 'size': size} for name, size in self.server.files.items()]
+            self.reply(200, json.dumps(listing).encode('utf-8'), 'application/json')
+        else:
+            self.reply(200, '<html><title>多看WiFi传书</title></html>'.encode('utf-8'),
+                       'text/html; charset=utf-8')
+
+    def read_body(self, length):
+        """按带宽上限读取请求体，返回 (文件名, 文件字节数, 是否读完整个请求体)。"""
+        options = self.server.options
+        rate = options.bandwidth * 1024 * 1024 if options.bandwidth else 0
+        started = time.monotonic()
+        received = 0
+        head = b''
+        while received < length:
+            chunk = self.rfile.read(min(64 * 1024, length - received))
+            if not chunk:
+                break
+            if len(head) < 1024:
+                head += chunk[:1024]
+            received += len(chunk)
+            if rate:
+                delay = received / rate - (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+        filename = 'unknown.epub'
+        marker = b'filename="'
+        if marker in head:
+            start = head.index(marker) + len(marker)
+            filename = head[start:head.index(b'"', start)].decode('utf-8', 'replace')
+        # 扣除 multipart 前导和结尾，得到文件本身的大小
+        boundary = self.headers.get_param('boundary', header='content-type') or ''
+        preamble = head.find(b'\r\n\r\n') + 4 if b'\r\n\r\n' in head else 0
+        epilogue = len(f'\r\n--{boundary}--\r\n') if boundary else 0
+        return filename, max(received - preamble - epilogue, 0), received == length
+
+    def do_POST(self):
+        options = self.server.options
+        time.sleep(options.latency)
+        length = int(self.headers.get('Content-Length', 0))
+        filename, received, complete = self.read_body(length)
+        if not complete:
+            # 客户端中途断开（取消或出错）：真实设备不会保存半个文件
+            self.close_connection = True
+            try:
+                self.reply(400, b'incomplete body')
+            except OSError:
+                pass
+            return
+        time.sleep(options.server_delay)
+        if random.random() < options.failure_rate:
+            self.reply(500, b'simulated failure')
+            return
+        with self.server.lock:
+            self.server.files[filename] = received
+        self.reply(200, b'{"result":"ok"}', 'application/json')
+
+
+def make_server(options, host='127.0.0.1'):
+    server = http.server.ThreadingHTTPServer((host, options.port), DuokanHandler)
+    server.daemon_threads = True
+    server.options = options
+    server.files = {}
+    server.lock = threading.Lock()
+    return server
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='多看阅读 WiFi 传书服务的本地替身')
+    parser.add_argument('--port', type=int, default=0, help='监听端口，0 表示自动选择')
+    parser.add_argument('--latency', type=float, default=0.0, help='每个连接和请求的延迟（秒）')
+    parser.add_argument('--bandwidth', type=float, default=0.0, help='上传带宽上限（MB/s），0 表示不限')
+    parser.add_argument('--server-delay', type=float, default=0.0, help='收完请求体后的处理耗时（秒）')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='随机返回 500 的概率')
+    parser.add_argument('--seed', type=int, default=None)
+    return parser
+
+
+def main(args=None):
+    options = build_parser().parse_args(args)
+    random.seed(options.seed)
+    server = make_server(options)
+    # 第一行输出实际端口，供基准脚本读取
+    print(server.server_address[1], flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
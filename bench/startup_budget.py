@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2024, Your Name'
+__docformat__ = 'restructuredtext en'
+
+# 启动耗时检查：在 calibre 环境中测量插件给 calibre 启动增加的时间——导入
+# ui.py、创建 InterfacePlugin 并调用 genesis() 和 initialization_complete()——
+# 超过预算时以退出码 1 结束。同时检查启动后没有读取设置和图标，也没有导入
+# 对话框、传输层等模块。
+#
+#   calibre-debug bench/startup_budget.py
+#   calibre-debug bench/startup_budget.py -- --budget-ms 20 --repeat 50
+
+import argparse
+import os
+import statistics
+import sys
+import time
+import types
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(os.path.dirname(HERE), 'src')
+
+# 插件对 calibre 启动时间的预算（毫秒）：导入 ui.py 加上一次 genesis() 和
+# initialization_complete()
+DEFAULT_BUDGET_MS = 20.0
+DEFAULT_REPEAT = 20
+
+# 启动时不应导入的插件模块，第一次使用对应功能时才加载
+LAZY_MODULES = (
+    'main', 'service', 'engine', 'transfer', 'health', 'preflight', 'autosend', 'manifest',
+    'sendqueue', 'metrics', 'slim', 'convert', 'cache', 'discovery', 'cli')
+
+
+def load_plugin_package():
+    """把 src/ 注册为 calibre_plugins.duokan_wifi_transfer 包，与 calibre 加载插件时的包名一致。"""
+    if 'calibre_plugins.duokan_wifi_transfer' not in sys.modules:
+        namespace = sys.modules.setdefault('calibre_plugins', types.ModuleType('calibre_plugins'))
+        namespace.__path__ = getattr(namespace, '__path__', [])
+        package = types.ModuleType('calibre_plugins.duokan_wifi_transfer')
+        package.__path__ = [SRC]
+        sys.modules['calibre_plugins.duokan_wifi_transfer'] = package
+
+
+def measure(repeat):
+    """返回 (导入 ui.py 的毫秒数, 每次创建并初始化插件的毫秒数列表, 最后一个插件实例)。"""
+    # 不显示窗口；没有显示器的机器上也能运行
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    # calibre 在加载插件之前已经导入了这些模块，不计入插件的耗时
+    from calibre.gui2 import Application
+    from calibre.gui2.actions import InterfaceAction  # noqa: F401
+    try:
+        from qt.core import QAction, QMainWindow
+    except ImportError:
+        from PyQt5.Qt import QAction, QMainWindow
+    app = Application([])
+    gui = QMainWindow()
+
+    load_plugin_package()
+    started = time.perf_counter()
+    from calibre_plugins.duokan_wifi_transfer.ui import InterfacePlugin
+    import_ms = (time.perf_counter() - started) * 1000
+
+    samples = []
+    plugin = None
+    for i in range(repeat):
+        # calibre 在调用 genesis() 之前创建工具栏动作，这里同样不计入
+        qaction = QAction(InterfacePlugin.name, gui)
+        started = time.perf_counter()
+        plugin = InterfacePlugin(gui, '')
+        plugin.qaction = qaction
+        plugin.genesis()
+        plugin.initialization_complete()
+        samples.append((time.perf_counter() - started) * 1000)
+    # 处理启动期间已到期的事件；推迟执行的定时器此时还不应触发
+    app.processEvents()
+    return import_ms, samples, plugin
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='检查插件给 calibre 启动增加的耗时是否在预算内')
+    parser.add_argument('--budget-ms', type=float, default=DEFAULT_BUDGET_MS,
+                        help=f'导入 ui.py 加一次初始化的预算，默认 {DEFAULT_BUDGET_MS} ms')
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                        help=f'初始化的测量次数，取中位数，默认 {DEFAULT_REPEAT}')
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ['--']:
+        argv = argv[1:]
+    args = parser.parse_args(argv)
+
+    import_ms, samples, plugin = measure(max(1, args.repeat))
+    init_ms = statistics.median(samples)
+    total_ms = import_ms + init_ms
+    print(f'导入 ui.py: {import_ms:.2f} ms')
+    print(f'genesis() + initialization_complete(): 中位数 {init_ms:.2f} ms，'
+          f'最大 {max(samples):.2f} ms（{len(samples)} 次）')
+    print(f'合计: {total_ms:.2f} ms，预算 {args.budget_ms:.2f} ms')
+
+    problems = []
+    if total_ms > args.budget_ms:
+        problems.append(f'启动耗时 {total_ms:.2f} ms 超过预算 {args.budget_ms:.2f} ms')
+    loaded = [name for name in LAZY_MODULES
+              if f'calibre_plugins.duokan_wifi_transfer.{name}' in sys.modules]
+    if loaded:
+        problems.append(f'启动时导入了 {", ".join(loaded)}')
+    if plugin._prefs is not None:
+        problems.append('启动时读取了设置')
+    if sys.modules['calibre_plugins.duokan_wifi_transfer.ui']._icons is not None:
+        problems.append('启动时读取了图标文件')
+    if plugin.menu.actions():
+        problems.append('启动时创建了菜单项')
+    for problem in problems:
+        print(f'失败: {problem}')
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -27,3 +27,12 @@ class DuokanWifiBase(InterfaceActionBase):
     #: that actually does something. Its specified as a string to avoid
     #: loading the class until the plugin is actually used.
     actual_plugin       = 'calibre_plugins.duokan_wifi_transfer.ui:InterfacePlugin'
+
+    def cli_main(self, argv):
+        '''
+        无界面批量发送入口，供 ``calibre-debug -r 多看阅读WiFi传书 -- [参数]`` 调用。
+        不导入 ui.py/main.py，因此不会创建任何 Qt 控件。
+        '''
+        import sys
+        from calibre_plugins.duokan_wifi_transfer.cli import main
+        sys.exit(main(argv[1:]))
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2024, Your Name'
+__docformat__ = 'restructuredtext en'
+
+# 自动发送新书：监听书库的新增书籍和格式变化事件，合并一段时间内的事件后
+# 在后台线程中批量发送。本模块不导入 Qt。
+
+import queue
+import threading
+import time
+
+# 最后一个事件之后等待的秒数；持续导入时最迟在第一个事件之后 max_delay 秒发送
+DEFAULT_DELAY = 10.0
+DEFAULT_MAX_DELAY = 60.0
+
+
+class Debouncer(object):
+    """合并一段时间内陆续到达的书籍 ID，安静 delay 秒后调用 flush(book_ids)。
+
+    事件一直不断时，最迟在第一个事件之后 max_delay 秒调用一次，避免大批量
+    导入期间迟迟不发送。flush 在计时器线程中调用，ID 保持到达顺序。
+    """
+
+    def __init__(self, flush, delay=DEFAULT_DELAY, max_delay=DEFAULT_MAX_DELAY):
+        self.flush = flush
+        self.delay = delay
+        self.max_delay = max(delay, max_delay)
+        self._ids = {}  # 用 dict 去重并保持顺序
+        self._first = None
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def add(self, book_ids):
+        with self._lock:
+            now = time.monotonic()
+            for book_id in book_ids:
+                self._ids[book_id] = None
+            if self._first is None:
+                self._first = now
+            if self._timer is not None:
+                self._timer.cancel()
+            wait = min(self.delay, self._first + self.max_delay - now)
+            self._timer = threading.Timer(max(0.0, wait), self._fire)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _fire(self):
+        with self._lock:
+            book_ids = list(self._ids)
+            self._ids = {}
+            self._first = None
+            self._timer = None
+        if book_ids:
+            self.flush(book_ids)
+
+    def cancel(self):
+        """丢弃尚未发送的 ID。"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = None
+            self._ids = {}
+            self._first = None
+
+
+class AutoSender(object):
+    """calibre 书库事件监听器，把新增或修改了指定格式的书合并成批发送。
+
+    send_batch(book_ids) 在本对象唯一的后台线程中依次调用，上一批还没发完时
+    到达的批次会合并为一批。formats 为触发发送的格式（大写）。
+    """
+
+    def __init__(self, send_batch, delay=DEFAULT_DELAY, max_delay=DEFAULT_MAX_DELAY,
+                 formats=('EPUB',)):
+        self.send_batch = send_batch
+        self.formats = {fmt.upper() for fmt in formats}
+        self.debouncer = Debouncer(self.enqueue, delay, max_delay)
+        self.db = None
+        self._batches = queue.Queue()
+        self._thread = None
+
+    def start(self, db):
+        """在书库（new_api）上注册监听器，切换书库时先调用 stop()。"""
+        self.stop()
+        self.db = db
+        db.add_listener(self)
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='duokan-autosend', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        if self.db is not None:
+            try:
+                self.db.remove_listener(self)
+            except Exception:
+                pass
+            self.db = None
+        self.debouncer.cancel()
+
+    def __call__(self, event_type, library_id, event_data):
+        """calibre 在自己的事件分发线程中调用。
+
+        新增的书在写入格式文件时同样产生 format_added，因此不单独处理
+        book_created（此时书还没有可发送的格式）。book_edited 为在 calibre
+        中直接编辑了某个格式，较早的 calibre 版本没有该事件。
+        """
+        if getattr(event_type, 'name', '') in ('format_added', 'book_edited'):
+            book_id, fmt = event_data[0], event_data[1]
+            if (fmt or '').upper() in self.formats:
+                self.debouncer.add([book_id])
+
+    def enqueue(self, book_ids):
+        self._batches.put(book_ids)
+
+    def _run(self):
+        while True:
+            book_ids = dict.fromkeys(self._batches.get())
+            # 上一批发送期间积累的批次合并发送
+            while True:
+                try:
+                    book_ids.update(dict.fromkeys(self._batches.get_nowait()))
+                except queue.Empty:
+                    break
+            try:
+                self.send_batch(list(book_ids))
+            except Exception:
+                import traceback
+                print(f"自动发送失败:\n{traceback.format_exc()}")
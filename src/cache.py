@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2024, Your Name'
+__docformat__ = 'restructuredtext en'
+
+import os
+import threading
+import uuid
+
+
+def plugin_cache_dir(name):
+    """calibre 缓存目录下本插件的子目录。"""
+    from calibre.constants import cache_dir
+    path = os.path.join(cache_dir(), 'duokan_wifi_transfer', name)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+class OutputCache(object):
+    """按键保存生成文件（精简或转换后的 EPUB）的磁盘缓存。
+
+    命中时更新文件 mtime 作为最近使用时间；写入后总大小超过 max_bytes 时
+    从最久未使用的文件开始删除。
+    """
+
+    def __init__(self, directory, max_bytes, ext='.epub'):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ext = ext
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def lock_for(self, key):
+        """同一个键的生成过程互斥，多设备同时发送同一本书时只生成一次。"""
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def path_for(self, key):
+        return os.path.join(self.directory, key + self.ext)
+
+    def get(self, key):
+        """返回缓存文件路径，未命中时返回 None。"""
+        path = self.path_for(key)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def temp_path(self, key):
+        """生成文件时使用的临时路径，完成后交给 put()。"""
+        return os.path.join(self.directory, f'{key}.{uuid.uuid4().hex}.tmp')
+
+    def put(self, key, temp_path):
+        path = self.path_for(key)
+        os.replace(temp_path, path)
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep=None):
+        with self._lock:
+            entries = []
+            total = 0
+            for entry in os.scandir(self.directory):
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                # 跳过正在生成的临时文件
+                if not entry.name.endswith(self.ext) or '.tmp' in entry.name:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+            entries.sort()
+            for mtime, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                if path == keep:
+                    continue
+                try:
+                    os.remove(path)
+                except OSError:
+                    # Windows 上正在上传的文件无法删除，留到下次淘汰
+                    continue
+                total -= size
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2024, Your Name'
+__docformat__ = 'restructuredtext en'
+
+# 无界面的批量发送命令，不创建任何 Qt 控件：
+#
+#   calibre-debug -r 多看阅读WiFi传书 -- --search 'tags:"待读"' --address http://192.168.1.8:8080
+#   calibre-debug -e cli.py -- --ids 1,2,3
+#
+# 每本书的结果以一行 JSON 写到标准输出，调试日志写到标准错误；有书发送失败
+# 时退出码为 1，参数错误时为 2。
+
+import argparse
+import json
+import sys
+import threading
+
+EXIT_OK = 0
+EXIT_FAILED = 1
+EXIT_USAGE = 2
+
+
+def usage_error(parser, message):
+    """打印用法和错误信息到标准错误，返回 EXIT_USAGE。"""
+    parser.print_usage(sys.stderr)
+    print(f'{parser.prog}: 错误: {message}', file=sys.stderr)
+    return EXIT_USAGE
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='duokan_wifi_transfer',
+        description='把 calibre 书库中的书籍通过 WiFi 发送到多看阅读')
+    parser.add_argument('--library', help='书库路径，默认使用 calibre 当前书库')
+    selection = parser.add_mutually_exclusive_group()
+    selection.add_argument('--search', help='calibre 搜索表达式，如 tags:"待读"')
+    selection.add_argument('--ids', help='逗号分隔的书籍 ID 列表')
+    selection.add_argument('--all', action='store_true', help='发送整个书库')
+    parser.add_argument('--address', help='多看阅读WiFi地址，默认使用插件设置')
+    parser.add_argument('--concurrency', type=int, help='同时上传的数量')
+    parser.add_argument('--order', choices=('original', 'smallest', 'largest'),
+                        help='发送顺序：原顺序、小书优先或大书优先，默认使用插件设置')
+    parser.add_argument('--limit', type=float, help='上传限速（MB/s），0 表示不限速，默认使用插件设置')
+    parser.add_argument('--sync', action='store_true', help='只发送设备上缺失或变化的书籍')
+    parser.add_argument('--resend', action='store_true', help='不跳过已发送且未变化的书籍')
+    parser.add_argument('--convert', action='store_true', help='把非EPUB格式转换为EPUB后发送')
+    parser.add_argument('--slim', action='store_true', help='发送前精简EPUB')
+    parser.add_argument('--no-preflight', action='store_true', help='发送前不检查EPUB是否完整')
+    parser.add_argument('--progress', action='store_true', help='同时输出字节进度事件')
+    return parser
+
+
+def parse_ids(raw):
+    try:
+        return [int(x) for x in raw.replace(' ', '').split(',') if x]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'无效的书籍 ID 列表: {raw}')
+
+
+def open_library(path):
+    from calibre.library import db
+    if not path:
+        from calibre.utils.config import prefs
+        path = prefs['library_path']
+    return db(path, read_only=True).new_api
+
+
+class JSONLinesWriter(object):
+    """线程安全地逐行写出 JSON 事件。"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._lock = threading.Lock()
+
+    def write(self, event, **fields):
+        line = json.dumps(dict(event=event, **fields), ensure_ascii=False)
+        with self._lock:
+            self.stream.write(line + '\n')
+            self.stream.flush()
+
+
+def main(args=None):
+    import calibre.customize.ui  # noqa 以脚本方式运行时加载插件，使 calibre_plugins 可导入
+    from calibre.utils.config import JSONConfig
+    from calibre_plugins.duokan_wifi_transfer.engine import (
+        BatchSender, collect_books, converter_from_prefs, slimmer_from_prefs, rate_limit_from_prefs,
+        DEFAULT_MAX_CONCURRENT_UPLOADS, MIN_UPLOAD_TIMEOUT, ORDER_ORIGINAL)
+    from calibre_plugins.duokan_wifi_transfer.transfer import (
+        RateSchedule, get_limiter, send_book, DEFAULT_CHUNK_SIZE)
+    from calibre_plugins.duokan_wifi_transfer.convert import DEFAULT_SOURCE_FORMATS
+    from calibre_plugins.duokan_wifi_transfer.health import DEFAULT_OUTAGE_WAIT
+
+    parser = build_parser()
+    opts = parser.parse_args(args)
+    prefs = JSONConfig('plugins/duokan_wifi_transfer')
+
+    address = opts.address or prefs.get('wifi_address')
+    if not address:
+        return usage_error(parser, '未指定多看阅读WiFi地址，请使用 --address')
+    if not address.startswith('http://'):
+        address = 'http://' + address
+
+    # JSON 结果独占标准输出，发送过程中的调试日志改写到标准错误
+    out = JSONLinesWriter(sys.stdout)
+    sys.stdout = sys.stderr
+    try:
+        db = open_library(opts.library)
+        if opts.ids:
+            try:
+                book_ids = parse_ids(opts.ids)
+            except argparse.ArgumentTypeError as e:
+                return usage_error(parser, str(e))
+        elif opts.search:
+            book_ids = sorted(db.search(opts.search))
+        elif opts.all:
+            book_ids = sorted(db.all_book_ids())
+        else:
+            return usage_error(parser, '请使用 --search、--ids 或 --all 指定要发送的书籍')
+
+        from calibre_plugins.duokan_wifi_transfer.manifest import SentManifest
+        manifest = SentManifest()
+        books, failed_books, skipped_count = collect_books(
+            db, book_ids, address,
+            manifest=None if opts.resend else manifest,
+            convert=opts.convert,
+            source_formats=prefs.get('convert_source_formats', DEFAULT_SOURCE_FORMATS))
+        for title, reason in failed_books:
+            out.write('book', title=title, success=False, error=reason)
+
+        # 损坏的 EPUB 在上传前就报告失败
+        if prefs.get('preflight_enabled', True) and not opts.no_preflight:
+            from calibre_plugins.duokan_wifi_transfer.preflight import EpubPreflight
+            preflight = EpubPreflight()
+            preflight.check_books(books)
+            try:
+                preflight.save()
+            except OSError as e:
+                print(f"保存预检结果失败: {e}")
+            for book in books:
+                if book.get('error'):
+                    failed_books.append((book['title'], book['error']))
+                    out.write('book', book_id=book.get('book_id'), title=book['title'],
+                              path=book['path'], success=False, error=book['error'])
+            books = [book for book in books if not book.get('error')]
+
+        preparers = []
+        if opts.convert:
+            preparers.append(converter_from_prefs(prefs))
+        if opts.slim:
+            preparers.append(slimmer_from_prefs(prefs))
+
+        skipped = [skipped_count]
+        history = None
+        if prefs.get('record_history', True):
+            from calibre_plugins.duokan_wifi_transfer.metrics import MetricsHistory
+            history = MetricsHistory(max_bytes=int(prefs.get('history_max_kb', 1024)) * 1024)
+
+        if opts.limit is None:
+            rate_limit = rate_limit_from_prefs(prefs)
+        else:
+            rate_limit = RateSchedule(opts.limit) if opts.limit > 0 else 0
+        limiter = get_limiter(address, rate_limit)
+
+        def send(path, title, **kwargs):
+            return send_book(
+                path, title,
+                chunk_size=int(prefs.get('upload_chunk_size', DEFAULT_CHUNK_SIZE)),
+                send_buffer=prefs.get('socket_send_buffer') or None,
+                on_record=history.append if history is not None else None,
+                limiter=limiter,
+                **kwargs)
+
+        def on_result(book, success, error_message):
+            out.write('book', book_id=book.get('book_id'), title=book['title'],
+                      path=book['path'], success=success, error=error_message)
+
+        def on_bytes(title, book_sent, book_total, batch_sent, batch_total, rate, eta):
+            out.write('progress', title=title, book_sent=int(book_sent), book_total=int(book_total),
+                      batch_sent=int(batch_sent), batch_total=int(batch_total),
+                      bytes_per_second=round(rate), eta_seconds=round(eta, 1))
+
+        def on_synced(already_on_device, upload_count):
+            skipped[0] += already_on_device
+            out.write('synced', already_on_device=already_on_device, to_upload=upload_count)
+
+        success_count = 0
+        if books:
+            sender = BatchSender(
+                send, address, books,
+                max_workers=opts.concurrency or int(prefs.get(
+                    'max_concurrent_uploads', DEFAULT_MAX_CONCURRENT_UPLOADS)),
+                ordered=True, manifest=manifest, sync=opts.sync, preparers=preparers,
+                order=opts.order or prefs.get('send_order', ORDER_ORIGINAL),
+                min_timeout=int(prefs.get('upload_timeout', MIN_UPLOAD_TIMEOUT)),
+                outage_wait=float(prefs.get('device_outage_wait', DEFAULT_OUTAGE_WAIT)),
+                on_result=on_result, on_synced=on_synced,
+                on_bytes=on_bytes if opts.progress else None)
+            success_count, worker_failed = sender.run()
+            failed_books.extend(worker_failed)
+
+        out.write('summary', sent=success_count, failed=len(failed_books), skipped=skipped[0])
+        return EXIT_FAILED if failed_books else EXIT_OK
+    finally:
+        sys.stdout = out.stream
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2024, Your Name'
+__docformat__ = 'restructuredtext en'
+
+# 把没有 EPUB 格式的书转换为 EPUB 后再上传。
+# convert_to_epub() 在 calibre 的工作进程中运行，本模块顶层不能导入 Qt。
+
+import hashlib
+import os
+import tempfile
+
+# 没有 EPUB 时按此顺序挑选转换源格式
+DEFAULT_SOURCE_FORMATS = ['AZW3', 'MOBI', 'AZW', 'FB2', 'DOCX', 'HTMLZ', 'RTF', 'TXT', 'PDF']
+
+
+def pick_source_format(available, preferred=DEFAULT_SOURCE_FORMATS):
+    """从书籍已有的格式中选出转换源格式，没有可用格式时返回 None。"""
+    available = {fmt.upper() for fmt in available or ()}
+    for fmt in preferred:
+        if fmt in available:
+            return fmt
+    return None
+
+
+def convert_to_epub(src, dst, opf=None):
+    """用 calibre 的转换流水线把 src 转为 EPUB 写入 dst。
+
+    opf 为书库中的元数据（OPF 字节串），用来覆盖源文件自带的元数据。
+    """
+    from calibre.customize.conversion import OptionRecommendation
+    from calibre.ebooks.conversion.plumber import Plumber
+    from calibre.utils.logging import Log
+
+    with tempfile.TemporaryDirectory() as tdir:
+        recommendations = []
+        if opf:
+            opf_path = os.path.join(tdir, 'metadata.opf')
+            with open(opf_path, 'wb') as f:
+                f.write(opf)
+            recommendations.append(('read_metadata_from_opf', opf_path, OptionRecommendation.HIGH))
+        plumber = Plumber(src, dst, Log())
+        plumber.merge_ui_recommendations(recommendations)
+        plumber.run()
+    return os.path.getsize(dst)
+
+
+class EpubConverter(object):
+    """发送前的转换阶段，只处理带 convert_from 的书。
+
+    和 EpubSlimmer 一样，每本书通过 fork_job 在独立的工作进程中转换，结果
+    按源文件内容哈希加元数据缓存在磁盘上，下次发送时不再重复转换。
+    """
+
+    # 转换失败时不能退回上传原格式文件
+    required = True
+
+    def __init__(self, max_workers=2, cache_bytes=2 * 1024 ** 3, cache=None):
+        from calibre_plugins.duokan_wifi_transfer.cache import OutputCache, plugin_cache_dir
+        self.max_workers = max_workers
+        self.cache = cache or OutputCache(plugin_cache_dir('convert'), cache_bytes)
+
+    def cache_key(self, path, opf):
+        from calibre_plugins.duokan_wifi_transfer.manifest import cached_file_hash
+        digest = hashlib.sha1(cached_file_hash(path).encode('ascii'))
+        digest.update(opf or b'')
+        return digest.hexdigest()
+
+    def prepare(self, book, abort=None):
+        """返回转换后的 EPUB 路径；不需要转换的书原样返回。
+
+        abort 为 threading.Event，set() 后结束正在运行的工作进程。
+        """
+        from calibre.utils.ipc.simple_worker import fork_job
+
+        if not book.get('convert_from'):
+            return book.get('upload_path') or book['path']
+
+        key = self.cache_key(book['path'], book.get('opf'))
+        with self.cache.lock_for(key):
+            cached = self.cache.get(key)
+            if cached:
+                return cached
+
+            # Plumber 根据输出文件扩展名选择输出插件
+            tmp = self.cache.temp_path(key) + '.epub'
+            try:
+                print(f"正在将 {book['title']} 从 {book['convert_from']} 转换为 EPUB")
+                fork_job(
+                    'calibre_plugins.duokan_wifi_transfer.convert', 'convert_to_epub',
+                    args=(book['path'], tmp, book.get('opf')), no_output=True, abort=abort)
+                return self.cache.put(key, tmp)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2024, Your Name'
+__docformat__ = 'restructuredtext en'
+
+# 在局域网中查找多看阅读WiFi传书服务。只依赖标准库，不导入 Qt。
+#
+# 先探测上次使用过的地址；未命中时对本机所在的每个 /24 网段同时发起非阻塞
+# TCP 连接（一次 select 等待整个网段），只对端口开放的主机发送 GET / 识别服务。
+
+import errno
+import http.client
+import ipaddress
+import selectors
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from calibre_plugins.duokan_wifi_transfer.transfer import USER_AGENT
+
+DEFAULT_PORT = 8080
+
+# TCP 连接的等待时间（秒），局域网内正常设备的握手远小于此值
+CONNECT_TIMEOUT = 0.8
+# 对端口开放的主机发送 GET / 的超时（秒）
+PROBE_TIMEOUT = 2.0
+
+# 同时打开的 socket 数量上限（Windows 上 select 最多支持 512 个）
+MAX_PENDING_CONNECTS = 256
+
+# GET / 响应中出现任意一个即认为是多看阅读WiFi传书服务
+SERVICE_MARKERS = ('多看', 'duokan', 'newfile')
+
+_IN_PROGRESS = {0, errno.EINPROGRESS, errno.EALREADY, errno.EWOULDBLOCK,
+                getattr(errno, 'WSAEWOULDBLOCK', errno.EWOULDBLOCK)}
+
+
+def split_address(address):
+    """返回地址中的 (主机, 端口)，缺省端口为 DEFAULT_PORT。"""
+    if '//' not in address:
+        address = 'http://' + address
+    parts = urlsplit(address)
+    return parts.hostname, parts.port or DEFAULT_PORT
+
+
+def make_address(host, port):
+    return f'http://{host}:{port}'
+
+
+def local_ipv4_addresses():
+    """本机的局域网 IPv4 地址（私有地址，不含回环）。"""
+    found = []
+    # 连接 UDP socket 不会发出数据包，只用来得到默认路由使用的本机地址
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            s.connect(('10.255.255.255', 1))
+            found.append(s.getsockname()[0])
+    except OSError:
+        pass
+    try:
+        for info in socket.getaddrinfo(socket.gethostname(), None, socket.AF_INET):
+            found.append(info[4][0])
+    except OSError:
+        pass
+    addresses = []
+    for ip in found:
+        try:
+            parsed = ipaddress.IPv4Address(ip)
+        except ValueError:
+            continue
+        if parsed.is_private and not parsed.is_loopback and not parsed.is_link_local \
+                and ip not in addresses:
+            addresses.append(ip)
+    return addresses
+
+
+def subnet_hosts(ip, prefix=24):
+    """ip 所在网段内除自身外的所有主机地址。"""
+    network = ipaddress.IPv4Network(f'{ip}/{prefix}', strict=False)
+    return [str(host) for host in network.hosts() if str(host) != ip]
+
+
+def open_ports(targets, timeout=CONNECT_TIMEOUT, batch_size=MAX_PENDING_CONNECTS):
+    """对 [(主机, 端口)] 同时发起非阻塞连接，返回能连上的目标。
+
+    每批目标共用一次 select 等待，整批耗时约为一个 timeout。
+    """
+    reachable = []
+    targets = list(targets)
+    for start in range(0, len(targets), batch_size):
+        sel = selectors.DefaultSelector()
+        pending = 0
+        try:
+            for target in targets[start:start + batch_size]:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.setblocking(False)
+                try:
+                    err = sock.connect_ex(target)
+                except OSError:
+                    sock.close()
+                    continue
+                if err not in _IN_PROGRESS:
+                    sock.close()
+                    continue
+                sel.register(sock, selectors.EVENT_WRITE, target)
+                pending += 1
+
+            deadline = time.monotonic() + timeout
+            while pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                for key, _ in sel.select(remaining):
+                    sock = key.fileobj
+                    if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                        reachable.append(key.data)
+                    sel.unregister(sock)
+                    sock.close()
+                    pending -= 1
+        finally:
+            for key in list(sel.get_map().values()):
+                key.fileobj.close()
+            sel.close()
+    return reachable
+
+
+def is_duokan_service(host, port, timeout=PROBE_TIMEOUT):
+    """GET / 并根据响应内容判断是否为多看阅读WiFi传书服务。"""
+    conn = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        conn.request('GET', '/', headers={'User-Agent': USER_AGENT})
+        response = conn.getresponse()
+        if response.status != 200:
+            return False
+        body = response.read(64 * 1024).decode('utf-8', errors='replace').lower()
+    except (OSError, http.client.HTTPException):
+        return False
+    finally:
+        conn.close()
+    return any(marker in body for marker in SERVICE_MARKERS)
+
+
+def identify(targets, max_workers=16, on_found=None):
+    """并发识别 [(主机, 端口)]，按输入顺序返回是多看服务的地址。"""
+    targets = list(targets)
+    if not targets:
+        return []
+    found = []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(targets))) as pool:
+        for (host, port), ok in zip(targets, pool.map(lambda t: is_duokan_service(*t), targets)):
+            if ok:
+                address = make_address(host, port)
+                found.append(address)
+                if on_found is not None:
+                    on_found(address)
+    return found
+
+
+def discover(known=(), ports=None, scan=True, on_found=None, cancelled=None):
+    """查找多看阅读WiFi传书服务，返回找到的地址列表。
+
+    known 为上次使用过的地址，优先探测；全部命中时不再扫描网段。ports 为
+    扫描网段时尝试的端口，默认取 known 中出现过的端口加 DEFAULT_PORT。
+    on_found(address) 在每找到一个地址时调用；cancelled() 返回真时停止扫描。
+    """
+    cancelled = cancelled or (lambda: False)
+    known_targets = []
+    for address in known:
+        try:
+            target = split_address(address)
+        except ValueError:
+            continue
+        if target[0] and target not in known_targets:
+            known_targets.append(target)
+    if ports is None:
+        ports = []
+        for _, port in known_targets + [(None, DEFAULT_PORT)]:
+            if port not in ports:
+                ports.append(port)
+
+    # 快速路径：上次使用过的地址
+    found = identify(open_ports(known_targets), on_found=on_found)
+    if not scan or (known_targets and len(found) == len(known_targets)) or cancelled():
+        return found
+
+    for ip in local_ipv4_addresses():
+        if cancelled():
+            break
+        targets = [(host, port) for host in subnet_hosts(ip) for port in ports
+                   if (host, port) not in known_targets]
+        for address in identify(open_ports(targets), on_found=on_found):
+            if address not in found:
+                found.append(address)
+    return found
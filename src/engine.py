@@ -0,0 +1,796 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2024, Your Name'
+__docformat__ = 'restructuredtext en'
+
+# 批量发送引擎：不导入 Qt，供对话框的后台线程和无界面的命令行共用。
+
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from calibre_plugins.duokan_wifi_transfer.convert import DEFAULT_SOURCE_FORMATS, pick_source_format
+from calibre_plugins.duokan_wifi_transfer.health import DEFAULT_OUTAGE_WAIT, get_health
+from calibre_plugins.duokan_wifi_transfer.transfer import (
+    BatchProgress, TeeRegistry, TransferCancelled, close_pool, fetch_device_files, needs_upload,
+    CANCELLED_MESSAGE)
+
+# 同一设备默认同时进行的上传数量
+DEFAULT_MAX_CONCURRENT_UPLOADS = 2
+
+# 发送顺序：按选择顺序、小书优先（进度最快可见）、大书优先（并发上传时总耗时最短）
+ORDER_ORIGINAL = 'original'
+ORDER_SMALLEST_FIRST = 'smallest'
+ORDER_LARGEST_FIRST = 'largest'
+SEND_ORDERS = (ORDER_ORIGINAL, ORDER_SMALLEST_FIRST, ORDER_LARGEST_FIRST)
+
+# 单本书的超时（秒）下限和上限，以及速率未知时假定的单路上传速率（字节/秒）
+MIN_UPLOAD_TIMEOUT = 30
+MAX_UPLOAD_TIMEOUT = 3600
+ASSUMED_UPLOAD_RATE = 256 * 1024
+# 超时取预计耗时的倍数，容忍速率波动和手机端写入存储的时间
+TIMEOUT_SAFETY_FACTOR = 3
+# 小于此大小的书耗时主要是延迟，不用来估计速率
+MIN_RATE_SAMPLE_BYTES = 1024 * 1024
+
+
+def upload_filename(book):
+    """设备上保存的文件名；转换得到的 EPUB 沿用原文件名并改为 .epub 扩展名。"""
+    return book.get('filename') or os.path.basename(book['path'])
+
+
+# 每次从书库批量读取的书籍数量
+PREPARE_BATCH_SIZE = 500
+
+
+def _book_entry(db, book_id, title, formats, convert, source_formats):
+    """一本书的书单条目；无法发送时条目中带 error 字段。"""
+    book = {'book_id': book_id, 'title': title, 'path': None}
+    epub_path = db.format_abspath(book_id, 'EPUB') if 'EPUB' in formats else None
+    if epub_path:
+        book['path'] = epub_path
+        return book
+    source_format = pick_source_format(formats, source_formats) if convert else None
+    if not source_format:
+        book['error'] = "没有EPUB格式"
+        return book
+    # 在后台转换为 EPUB，书库元数据以 OPF 形式传给转换进程；只有需要转换的
+    # 书才读取完整元数据
+    from calibre.ebooks.metadata.opf2 import metadata_to_opf
+    source_path = db.format_abspath(book_id, source_format)
+    if not source_path:
+        book['error'] = f'无法读取{source_format}格式文件'
+        return book
+    book.update(
+        path=source_path, convert_from=source_format,
+        opf=metadata_to_opf(db.get_metadata(book_id)),
+        filename=os.path.splitext(os.path.basename(source_path))[0] + '.epub')
+    return book
+
+
+def iter_book_batches(db, book_ids, convert=False, source_formats=DEFAULT_SOURCE_FORMATS,
+                      batch_size=PREPARE_BATCH_SIZE):
+    """分批整理待发送的书单，每批产出一个列表。
+
+    db 为书库的 new_api。书名和格式列表通过 all_field_for 按批读取，不构造
+    完整的 Metadata 对象。没有可发送格式或读取失败的书同样产出，条目中
+    带 error 字段（path 为 None）。可直接作为 BatchSender 的 books 参数，
+    前几批开始上传时后面的书仍在读取。
+    """
+    book_ids = list(book_ids)
+    for start in range(0, len(book_ids), batch_size):
+        chunk = book_ids[start:start + batch_size]
+        titles = db.all_field_for('title', chunk, default_value=None)
+        formats = db.all_field_for('formats', chunk, default_value=())
+        books = []
+        for book_id in chunk:
+            title = titles.get(book_id) or f'ID {book_id}'
+            try:
+                books.append(_book_entry(
+                    db, book_id, title, {fmt.upper() for fmt in formats.get(book_id) or ()},
+                    convert, source_formats))
+            except Exception as e:
+                import traceback
+                print(f"准备书籍 {title} 时出错:\n{traceback.format_exc()}")
+                books.append({'book_id': book_id, 'title': title, 'path': None,
+                              'error': f'错误类型: {type(e).__name__}\n错误信息: {str(e)}'})
+        yield books
+
+
+def collect_books(db, book_ids, address, manifest=None, convert=False,
+                  source_formats=DEFAULT_SOURCE_FORMATS):
+    """根据书籍 ID 整理待发送的书单。
+
+    返回 (books, failed_books, skipped_count)：没有可发送格式或读取失败的书
+    记入 failed_books；manifest 不为空时，已发送到 address 且内容未变化的书
+    计入 skipped_count。
+    """
+    books = []
+    failed_books = []
+    skipped_count = 0
+    for batch in iter_book_batches(db, book_ids, convert, source_formats):
+        for book in batch:
+            if book.get('error'):
+                failed_books.append((book['title'], book['error']))
+            # 已发送到该设备且内容未变化的书直接跳过
+            elif manifest is not None and manifest.is_unchanged(address, book['book_id'], book['path']):
+                skipped_count += 1
+            else:
+                books.append(book)
+    return books, failed_books, skipped_count
+
+
+def order_books(books, order=ORDER_ORIGINAL):
+    """按发送顺序排列书单，返回 [(原序号, book)]；大小相同时保持原顺序。"""
+    indexed = list(enumerate(books))
+    if order == ORDER_SMALLEST_FIRST:
+        indexed.sort(key=lambda item: item[1].get('size', 0))
+    elif order == ORDER_LARGEST_FIRST:
+        indexed.sort(key=lambda item: -item[1].get('size', 0))
+    return indexed
+
+
+class UploadTimeouts(object):
+    """按实测速率为每本书计算整本书的传输时限。
+
+    时限只约束整本书的上传（send_book 的 deadline），连接和每次读写仍用
+    minimum（设置 upload_timeout）作超时，设备休眠或断网时很快失败。
+    每本书上传成功后以 大小/耗时 更新该设备的单路速率（指数加权平均），
+    下一本书的时限取 大小/速率 的 TIMEOUT_SAFETY_FACTOR 倍，并限制在
+    [minimum, MAX_UPLOAD_TIMEOUT] 之间。同一设备地址的所有批次共用一个估计。
+    """
+
+    _estimates = {}
+    _estimates_lock = threading.Lock()
+
+    def __init__(self, minimum=MIN_UPLOAD_TIMEOUT, smoothing=0.3):
+        self.minimum = minimum
+        self.smoothing = smoothing
+        self.rate = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_address(cls, address, minimum=MIN_UPLOAD_TIMEOUT):
+        with cls._estimates_lock:
+            estimate = cls._estimates.get(address)
+            if estimate is None:
+                estimate = cls._estimates[address] = cls(minimum)
+            estimate.minimum = minimum
+            return estimate
+
+    def observe(self, nbytes, seconds):
+        if nbytes < MIN_RATE_SAMPLE_BYTES or seconds <= 0:
+            return
+        sample = nbytes / seconds
+        with self._lock:
+            if self.rate is None:
+                self.rate = sample
+            else:
+                self.rate += self.smoothing * (sample - self.rate)
+
+    def timeout_for(self, nbytes):
+        with self._lock:
+            rate = self.rate or ASSUMED_UPLOAD_RATE
+        expected = nbytes / max(rate, 1.0)
+        return max(self.minimum, min(MAX_UPLOAD_TIMEOUT, self.minimum + TIMEOUT_SAFETY_FACTOR * expected))
+
+
+# 没有本次会话的实测速率时，取传输历史中该设备最近多少次成功上传估计速率
+RECENT_RATE_SAMPLES = 50
+
+
+def estimate_rate(address, records=(), rate_limit=0):
+    """估计发送到 address 的速率（字节/秒），没有任何实测数据时返回 None。
+
+    优先使用本次会话中 UploadTimeouts 的实测速率，否则取传输历史（metrics
+    记录）中该设备最近 RECENT_RATE_SAMPLES 次成功上传的中位速率；rate_limit
+    （字节/秒或返回字节/秒的 RateSchedule，0 为不限速）不为 0 时不超过限速。
+    """
+    from calibre_plugins.duokan_wifi_transfer.metrics import median
+    with UploadTimeouts._estimates_lock:
+        estimate = UploadTimeouts._estimates.get(address)
+    rate = estimate.rate if estimate is not None else None
+    if rate is None:
+        samples = [r['bps'] for r in records
+                   if r.get('dev') == address and r.get('status') == 200 and r.get('bps')]
+        rate = median(samples[-RECENT_RATE_SAMPLES:])
+    limit = rate_limit() if callable(rate_limit) else rate_limit
+    if limit:
+        rate = min(rate, limit) if rate else limit
+    return rate
+
+
+def slimmer_settings(prefs):
+    """EpubSlimmer 的构造参数；插件据此判断设置变化后是否需要重新创建。"""
+    from calibre_plugins.duokan_wifi_transfer.slim import DEFAULT_SLIM_OPTIONS
+    return dict(
+        options={key: prefs.get('slim_' + key, default)
+                 for key, default in DEFAULT_SLIM_OPTIONS.items()},
+        max_workers=int(prefs.get('slim_processes', 2)),
+        cache_bytes=int(prefs.get('slim_cache_mb', 2048)) * 1024 * 1024)
+
+
+def slimmer_from_prefs(prefs):
+    from calibre_plugins.duokan_wifi_transfer.slim import EpubSlimmer
+    return EpubSlimmer(**slimmer_settings(prefs))
+
+
+def rate_limit_from_prefs(prefs):
+    """上传限速：rate_limit_mbps 为默认上限，rate_limit_schedule 为
+    [[开始 "HH:MM", 结束 "HH:MM", MB/s], ...] 形式的分时段上限；都未设置时返回 0。
+    """
+    from calibre_plugins.duokan_wifi_transfer.transfer import RateSchedule
+    default = float(prefs.get('rate_limit_mbps', 0) or 0)
+    rules = prefs.get('rate_limit_schedule') or []
+    if not default and not rules:
+        return 0
+    try:
+        return RateSchedule(default, rules)
+    except (TypeError, ValueError) as e:
+        print(f"限速时段设置无效，只使用默认上限: {e}")
+        return RateSchedule(default)
+
+
+def converter_settings(prefs):
+    """EpubConverter 的构造参数，用法同 slimmer_settings。"""
+    return dict(
+        max_workers=int(prefs.get('convert_processes', 2)),
+        cache_bytes=int(prefs.get('convert_cache_mb', 2048)) * 1024 * 1024)
+
+
+def converter_from_prefs(prefs):
+    from calibre_plugins.duokan_wifi_transfer.convert import EpubConverter
+    return EpubConverter(**converter_settings(prefs))
+
+
+class BatchSender(object):
+    """与 Qt 无关的批量发送引擎，SendBooksWorker 和命令行共用。
+
+    用线程池并发上传，同一设备上同时进行的上传数量受限。进度通过可选的
+    回调汇报，回调在后台线程中调用：
+
+    - on_progress(completed_count, total, title)
+    - on_bytes(title, book_sent, book_total, batch_sent, batch_total, rate, eta)
+    - on_synced(already_on_device_count, upload_count)
+    - on_result(book, success, error_message)
+    - on_start(book)：即将开始上传该书
+    - on_device_state(reachable)：设备连续连接失败而暂停（False）或恢复（True）
+
+    control 为 transfer.TransferControl 时可以暂停、继续和取消整个批次，
+    在当前分块发完之前生效。取消后尚未完成的书不计入失败列表，而是记入
+    cancelled_books，其结果（on_result）带 cancelled=True。
+    """
+
+    # 同一设备地址的所有批次共享一个信号量，避免多个批次叠加压垮手机端服务
+    _device_slots = {}
+    _device_slots_lock = threading.Lock()
+
+    def __init__(self, send, address, books, max_workers=DEFAULT_MAX_CONCURRENT_UPLOADS,
+                 ordered=False, manifest=None, sync=False, preparers=(), skip_sent=False,
+                 order=ORDER_ORIGINAL, min_timeout=MIN_UPLOAD_TIMEOUT, outage_wait=DEFAULT_OUTAGE_WAIT,
+                 on_progress=None, on_bytes=None, on_synced=None, on_result=None, on_start=None,
+                 on_device_state=None, control=None):
+        # send(path, title, address=, on_progress=, filename=, timeout=, deadline=) 上传一本书，
+        # 返回 (是否成功, 错误信息)，如 transfer.send_book 或插件的 send_book_to_duokan
+        self.send = send
+        self.address = address
+        self.books = books
+        # 发送成功的书记入已发送清单，下次发送时可跳过；skip_sent=True 时由本
+        # 引擎按本设备地址过滤清单中未变化的书（多设备发送时各设备分别过滤）
+        self.manifest = manifest
+        self.skip_sent = skip_sent
+        self.skipped_count = 0  # 按清单跳过的数量
+        self.synced_skipped = 0  # 同步模式下设备上已存在的数量
+        self.max_workers = max(1, int(max_workers))
+        # ordered=True 时按书单原顺序汇报进度和失败列表，否则按完成顺序
+        self.ordered = ordered
+        # 实际上传顺序（SEND_ORDERS 之一），与汇报顺序无关
+        self.order = order
+        # 每本书的传输时限由书的大小和该设备的实测速率决定，不低于 min_timeout；
+        # 连接和每次读写的超时固定为 min_timeout
+        self.timeouts = UploadTimeouts.for_address(address, min_timeout)
+        # 设备连续连接失败（熔断）时，开始下一本书之前最多等待 outage_wait 秒
+        # 让设备恢复；仍无应答时剩余的书立即计为失败，不再逐本等待超时
+        self.health = get_health(address)
+        self.outage_wait = outage_wait
+        self.control = control
+        self.cancelled_books = []  # 因取消而没有发送完的书名
+        # 同步模式下获取设备文件列表失败，整批没有上传也没有按清单过滤
+        self.listing_failed = False
+        # sync=True 时先获取设备文件列表，只上传缺失或大小不一致的书籍
+        self.sync = sync
+        # 依次执行的发送前处理阶段（格式转换、精简 EPUB），prepare(book) 返回
+        # 实际上传的文件路径；处理完一本就立即排队上传，与其他书的处理重叠进行
+        self.preparers = list(preparers)
+        self.on_progress = on_progress or (lambda *args: None)
+        self.on_bytes = on_bytes or (lambda *args: None)
+        self.on_synced = on_synced or (lambda *args: None)
+        self.on_result = on_result or (lambda *args: None)
+        self.on_start = on_start or (lambda *args: None)
+        self.on_device_state = on_device_state or (lambda *args: None)
+
+    @classmethod
+    def device_slots(cls, address, limit):
+        with cls._device_slots_lock:
+            slots = cls._device_slots.get(address)
+            if slots is None or slots[0] != limit:
+                slots = (limit, threading.BoundedSemaphore(limit))
+                cls._device_slots[address] = slots
+            return slots[1]
+
+    def wait_for_device(self):
+        """熔断时暂停等待设备恢复，返回是否可以继续发送。"""
+        if not self.health.tripped:
+            return True
+        self.on_device_state(False)
+        if not self.health.wait_until_reachable(self.outage_wait, cancelled=self.is_cancelled):
+            return False
+        self.on_device_state(True)
+        return True
+
+    def is_cancelled(self):
+        return self.control is not None and self.control.cancelled
+
+    def send_one(self, book, slots, batch):
+        title = book['title']
+        on_progress = batch.tracker(title, book['size'])
+        try:
+            if self.control is not None:
+                self.control.checkpoint()
+        except TransferCancelled:
+            batch.book_done(on_progress, title, book['size'])
+            return dict(book, cancelled=True), False, CANCELLED_MESSAGE
+        if not self.wait_for_device():
+            if self.is_cancelled():
+                batch.book_done(on_progress, title, book['size'])
+                return dict(book, cancelled=True), False, CANCELLED_MESSAGE
+            batch.book_done(on_progress, title, book['size'])
+            return book, False, (f'设备无应答（连续 {self.health.failures} 次连接失败），'
+                                 f'本书未发送')
+        try:
+            with slots:
+                if self.is_cancelled():
+                    raise TransferCancelled()
+                self.on_start(book)
+                started = time.monotonic()
+                extra = {} if self.control is None else {'control': self.control}
+                result = self.send(
+                    book.get('upload_path') or book['path'], title, address=self.address,
+                    on_progress=on_progress, filename=upload_filename(book),
+                    timeout=self.timeouts.minimum,
+                    deadline=self.timeouts.timeout_for(book['size']), **extra)
+                elapsed = time.monotonic() - started
+            if isinstance(result, tuple):
+                success, error_message = result
+            else:
+                success = bool(result)
+                error_message = None if success else '发送失败'
+            if success:
+                self.timeouts.observe(book['size'], elapsed)
+        except TransferCancelled:
+            success, error_message = False, CANCELLED_MESSAGE
+        except Exception as e:
+            import traceback
+            error_message = f'错误类型: {type(e).__name__}\n错误信息: {str(e)}\n\n详细追踪:\n{traceback.format_exc()}'
+            success = False
+        batch.book_done(on_progress, title, book['size'])
+        if not success and self.is_cancelled():
+            return dict(book, cancelled=True), False, CANCELLED_MESSAGE
+        if success and self.manifest is not None and book.get('book_id') is not None:
+            try:
+                self.manifest.record(self.address, book['book_id'], book['path'])
+            except OSError as e:
+                print(f"记录已发送书籍 {title} 失败: {e}")
+        return book, success, error_message or (None if success else '发送失败')
+
+    def prepare_one(self, book, batch):
+        """依次运行发送前处理阶段。
+
+        可选阶段失败时沿用上一阶段的文件；必需阶段（格式转换）失败时在
+        book['error'] 中记录原因，该书不再上传。读取处理结果的大小也属于该
+        阶段：缓存中的文件可能在返回后被其他线程淘汰。取消批次时正在运行
+        的阶段通过 abort 中止，该书随后在 send_one 中计为已取消。
+        """
+        abort = self.control.abort_event if self.control is not None else None
+        for preparer in self.preparers:
+            if self.is_cancelled():
+                break
+            current = book.get('upload_path') or book['path']
+            try:
+                prepared = book
+                upload_path = preparer.prepare(book, abort=abort)
+                if upload_path and upload_path != current:
+                    prepared = dict(book, upload_path=upload_path, size=os.path.getsize(upload_path))
+            except Exception as e:
+                if self.is_cancelled():
+                    break
+                if getattr(preparer, 'required', False):
+                    error_msg = f'处理失败：{type(e).__name__}: {e}'
+                    print(f"处理书籍 {book['title']} 失败: {error_msg}")
+                    return dict(book, error=error_msg)
+                print(f"处理书籍 {book['title']} 失败，将发送未处理的文件: {type(e).__name__}: {e}")
+                continue
+            if prepared is not book:
+                batch.adjust_total(prepared['size'] - book['size'])
+                book = prepared
+        return book
+
+    def filter_books(self, books, device_files=None):
+        """统计大小，并按已发送清单和设备文件列表过滤掉不需要上传的书。"""
+        selected = []
+        for book in books:
+            if book.get('error'):
+                book['size'] = 0
+                selected.append(book)
+                continue
+            try:
+                book['size'] = os.path.getsize(book['path'])
+            except OSError:
+                book['size'] = 0
+            if self.skip_sent and self.manifest is not None and book.get('book_id') is not None \
+                    and self.manifest.is_unchanged(self.address, book['book_id'], book['path']):
+                self.skipped_count += 1
+                continue
+            # 转换或精简后的大小与本地原文件不同，此时只按文件名比对
+            if device_files is not None and not needs_upload(
+                    device_files, upload_filename(book), None if self.preparers else book['size']):
+                self.synced_skipped += 1
+                continue
+            selected.append(book)
+        return selected
+
+    def run(self):
+        """发送整个批次，返回 (成功数量, [(书名, 失败原因)])。
+
+        books 可以是书单，也可以是逐批产出书单的可迭代对象（如
+        iter_book_batches()）：每读到一批就过滤、排序并开始上传，同时汇报
+        已完成的结果，此时进度中的总数随读取逐渐增加。
+        """
+        batches = [self.books] if isinstance(self.books, list) else self.books
+
+        device_files = None
+        if self.sync:
+            # 同步模式先获取一次设备文件列表，之后逐批比对
+            try:
+                device_files = fetch_device_files(self.address)
+            except Exception as e:
+                error_msg = f'无法获取设备上的文件列表：{type(e).__name__}: {e}'
+                print(error_msg)
+                close_pool(self.address)
+                self.listing_failed = True
+                failed_books = []
+                for books in batches:
+                    for book in books:
+                        failed_books.append((book['title'], error_msg))
+                        self.on_result(book, False, error_msg)
+                return 0, failed_books
+
+        success_count = 0
+        failed_books = []
+        total = 0  # 已排队的数量，书单读取完之前仍在增加
+        done = 0
+        pending = {}  # ordered 时暂存先完成的结果
+        next_index = 0
+        slots = self.device_slots(self.address, self.max_workers)
+        batch = BatchProgress(0, self.on_bytes)
+
+        results = queue.Queue()
+        prepare_workers = max([p.max_workers for p in self.preparers] or [1])
+
+        def handle(index, result):
+            nonlocal success_count, done, next_index
+            if self.ordered:
+                pending[index] = result
+                ready = []
+                while next_index in pending:
+                    ready.append(pending.pop(next_index))
+                    next_index += 1
+            else:
+                ready = [result]
+            for book, success, error_message in ready:
+                done += 1
+                if success:
+                    success_count += 1
+                elif book.get('cancelled'):
+                    self.cancelled_books.append(book['title'])
+                else:
+                    failed_books.append((book['title'], error_message))
+                self.on_result(book, success, error_message)
+                self.on_progress(done, total, book['title'])
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as uploads, \
+                ThreadPoolExecutor(max_workers=prepare_workers) as preparing:
+
+            # 每个序号都必须放入一个结果，否则下面等待结果的循环不会结束
+            def upload(index, book):
+                if not book.get('error'):
+                    try:
+                        results.put((index, self.send_one(book, slots, batch)))
+                        return
+                    except Exception as e:
+                        book = dict(book, error=f'发送失败：{type(e).__name__}: {e}')
+                        print(f"发送 {book['title']} 出错: {book['error']}")
+                batch.book_done(batch.tracker(book['title'], book['size']),
+                                book['title'], book['size'])
+                results.put((index, (book, False, book['error'])))
+
+            def prepare_then_upload(index, book):
+                try:
+                    book = self.prepare_one(book, batch)
+                except Exception as e:
+                    error_msg = f'处理失败：{type(e).__name__}: {e}'
+                    print(f"处理书籍 {book['title']} 失败: {error_msg}")
+                    book = dict(book, error=error_msg)
+                uploads.submit(upload, index, book)
+
+            for books in batches:
+                if self.is_cancelled():
+                    break  # 取消后不再读取剩余的书单
+                books = self.filter_books(books, device_files)
+                batch.adjust_total(sum(book['size'] for book in books))
+                # 调度顺序只影响提交次序；结果仍带原序号，ordered 时按原顺序汇报
+                for offset, book in order_books(books, self.order):
+                    if self.preparers and not book.get('error'):
+                        preparing.submit(prepare_then_upload, total + offset, book)
+                    else:
+                        uploads.submit(upload, total + offset, book)
+                total += len(books)
+                # 书单还在读取时先汇报已完成的结果
+                while True:
+                    try:
+                        handle(*results.get_nowait())
+                    except queue.Empty:
+                        break
+
+            if device_files is not None:
+                self.on_synced(self.synced_skipped, total)
+
+            while done < total:
+                handle(*results.get())
+
+        # 批次结束后释放到该设备的持久连接
+        close_pool(self.address)
+
+        if self.manifest is not None:
+            try:
+                self.manifest.save()
+            except OSError as e:
+                print(f"保存已发送书籍清单失败: {e}")
+
+        return success_count, failed_books
+
+
+class QueuedSender(object):
+    """在持久发送队列（sendqueue.TransferQueue）上运行 BatchSender。
+
+    books 不为空时（书单或 iter_book_batches() 这样逐批产出的书单）边读取边
+    写入队列的新批次，为空时继续该设备上所有未完成的书。每本书开始上传、
+    成功和失败都立即写入队列；失败的书（文件仍存在时）按指数退避等待后
+    自动重试，重试次数用尽才计为失败。无法发送的书（带 error 字段）不入队，
+    直接计为失败。进度和结果回调与 BatchSender 相同，on_result 只在一本书有
+    最终结果时调用；等待重试时调用 on_retry_wait(waiting_count, delay_seconds)。
+    cancelled() 返回真时不再开始新一轮重试，剩余的书留在队列中；batch_kwargs
+    中带 control（TransferControl）时默认以其取消状态为准，被取消的书放回
+    队列等待下次继续，书名记入 cancelled_books。同步模式下获取设备文件列表
+    失败时，下一轮重试重新获取列表并照常过滤。
+    """
+
+    def __init__(self, transfer_queue, send, address, books=None, on_retry_wait=None,
+                 cancelled=None, on_result=None, **batch_kwargs):
+        self.queue = transfer_queue
+        self.send = send
+        self.address = address
+        self.books = books
+        self.on_retry_wait = on_retry_wait or (lambda *args: None)
+        control = batch_kwargs.get('control')
+        if cancelled is None and control is not None:
+            cancelled = lambda: control.cancelled
+        self.cancelled = cancelled or (lambda: False)
+        self.on_result = on_result or (lambda *args: None)
+        self.batch_kwargs = batch_kwargs
+        self.batch = None
+        self.cancelled_books = []
+        self.skipped_count = 0
+        self.synced_skipped = 0
+
+    def record_result(self, book, success, error_message):
+        if 'queue_id' not in book:
+            self.on_result(book, success, error_message)
+            return
+        if success:
+            self.queue.mark_done(book['queue_id'])
+            self.on_result(book, success, error_message)
+            return
+        if book.get('cancelled'):
+            self.queue.mark_pending(book['queue_id'])
+            self.on_result(book, success, error_message)
+            return
+        # 处理失败或文件已不存在时重试没有意义
+        retry = not book.get('error') and os.path.exists(book['path'])
+        delay = self.queue.mark_failed(book['queue_id'], error_message, retry=retry)
+        if delay is None:
+            self.on_result(book, success, error_message)
+        else:
+            print(f"发送 {book['title']} 失败，{delay:.0f} 秒后重试: {error_message}")
+
+    def enqueue_batches(self, batches, queued):
+        """边产出边把书写入队列，写入的书同时记入 queued。"""
+        if isinstance(batches, list):
+            batches = [batches]
+        for books in batches:
+            valid = [book for book in books if not book.get('error')]
+            if valid:
+                self.batch = self.queue.enqueue(self.address, valid, self.batch)
+                queued.extend(valid)
+            yield books
+
+    def wait(self, delay):
+        deadline = time.monotonic() + delay
+        while not self.cancelled():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return True
+            time.sleep(min(0.5, remaining))
+        return False
+
+    def run(self):
+        """发送到队列中没有剩余可重试的书，返回 (成功数量, [(书名, 失败原因)])。"""
+        if self.books is None:
+            self.queue.resume(self.address)
+
+        success_count = 0
+        failed_books = []
+        first_round = True
+        # 上一轮同步时没能获取设备文件列表：重试时重新获取并照常过滤，而不是
+        # 把已在设备上的书全部重新发送
+        resync = False
+        while not self.cancelled():
+            queued = []
+            kwargs = dict(self.batch_kwargs)
+            filtering = first_round or resync
+            if first_round and self.books is not None:
+                books = self.enqueue_batches(self.books, queued)
+            else:
+                if self.books is not None and self.batch is None:
+                    break  # 书单中没有可以入队的书
+                books = queued = self.queue.due(self.address, self.batch)
+                if not books:
+                    next_due = self.queue.next_due(self.address, self.batch)
+                    if next_due is None:
+                        break
+                    waiting = len(self.queue.due(self.address, self.batch, now=float('inf')))
+                    delay = max(0.0, next_due - time.time())
+                    self.on_retry_wait(waiting, delay)
+                    if not self.wait(delay):
+                        break
+                    continue
+                if not filtering:
+                    # 重试时不再按清单或设备文件列表过滤
+                    kwargs.update(sync=False, skip_sent=False)
+            finished = set()
+
+            def on_result(book, success, error_message):
+                if 'queue_id' in book:
+                    finished.add(book['queue_id'])
+                elif not success:
+                    failed_books.append((book['title'], error_message))
+                self.record_result(book, success, error_message)
+
+            sender = BatchSender(
+                self.send, self.address, books, on_result=on_result,
+                on_start=lambda book: self.queue.mark_in_flight(book['queue_id']), **kwargs)
+            round_success, _ = sender.run()
+            success_count += round_success
+            self.cancelled_books.extend(sender.cancelled_books)
+            if filtering:
+                self.skipped_count += sender.skipped_count
+                self.synced_skipped += sender.synced_skipped
+            resync = sender.listing_failed
+            first_round = False
+            # 被清单或同步模式过滤掉的书不需要再发送
+            for book in queued:
+                if book['queue_id'] not in finished:
+                    self.queue.mark_done(book['queue_id'])
+
+        if self.books is None or self.batch is not None:
+            failed_books.extend(self.queue.failed(self.address, self.batch))
+        self.queue.prune()
+        return success_count, failed_books
+
+
+def split_addresses(text):
+    """把以逗号、分号或空白分隔的多个地址拆开，补全 http:// 前缀并去重。"""
+    import re
+    addresses = []
+    for address in re.split(r'[,;，；\s]+', text or ''):
+        if not address:
+            continue
+        if not address.startswith('http://'):
+            address = 'http://' + address
+        if address not in addresses:
+            addresses.append(address)
+    return addresses
+
+
+class FanoutSender(object):
+    """把同一批书同时发送到多台设备。
+
+    每台设备有独立的 BatchSender、连接池和并发上限，进度和失败分别汇报；
+    同一本书发往各设备时通过 TeeRegistry 共享一次磁盘读取。某台设备很慢或
+    离线时只影响它自己：它会被移出共享分块并自行读取文件。回调在后台线程
+    中调用，第一个参数都是设备地址：
+
+    - on_device_progress(address, completed_count, total, title)
+    - on_device_bytes(address, title, book_sent, book_total, batch_sent, batch_total, rate, eta)
+    - on_device_finished(address, success_count, failed_books, skipped_count)
+    """
+
+    def __init__(self, send, addresses, books, on_device_progress=None, on_device_bytes=None,
+                 on_device_finished=None, chunk_size=None, transfer_queue=None, **batch_kwargs):
+        # send 与 BatchSender 的 send 相同，但需额外接受 tee 参数
+        self.send = send
+        self.addresses = list(addresses)
+        self.books = books
+        self.on_device_progress = on_device_progress or (lambda *args: None)
+        self.on_device_bytes = on_device_bytes or (lambda *args: None)
+        self.on_device_finished = on_device_finished or (lambda *args: None)
+        self.batch_kwargs = batch_kwargs
+        # 不为空时各设备通过 QueuedSender 记录状态并自动重试；books 为空表示
+        # 继续队列中各设备未完成的书
+        self.transfer_queue = transfer_queue
+        self.cancelled_books = {}  # {地址: [因取消而没有发送完的书名]}
+        self.tees = TeeRegistry(consumers=self.addresses,
+                                **({'chunk_size': chunk_size} if chunk_size else {}))
+
+    def send_shared(self, path, title, address=None, **kwargs):
+        tee = self.tees.acquire(path, address)
+        try:
+            return self.send(path, title, address=address, tee=tee, **kwargs)
+        finally:
+            self.tees.release(path, address)
+
+    def run_device(self, address, results):
+        import functools
+        books = None if self.books is None else [dict(book) for book in self.books]
+        kwargs = dict(
+            self.batch_kwargs,
+            on_progress=functools.partial(self.on_device_progress, address),
+            on_bytes=functools.partial(self.on_device_bytes, address))
+        if self.transfer_queue is not None:
+            sender = QueuedSender(self.transfer_queue, self.send_shared, address, books, **kwargs)
+        else:
+            sender = BatchSender(self.send_shared, address, books, **kwargs)
+        try:
+            success_count, failed_books = sender.run()
+        except Exception as e:
+            error_msg = f'{type(e).__name__}: {e}'
+            success_count, failed_books = 0, [(book['title'], error_msg) for book in books or ()]
+        finally:
+            # 没有取过的书（已跳过或未发送）不再为该设备保留分块
+            self.tees.forget(address)
+        skipped_count = sender.skipped_count + sender.synced_skipped
+        self.cancelled_books[address] = list(sender.cancelled_books)
+        results[address] = (success_count, failed_books, skipped_count)
+        self.on_device_finished(address, success_count, failed_books, skipped_count)
+
+    def run(self):
+        """返回 {地址: (成功数量, [(书名, 失败原因)], 跳过数量)}。"""
+        if self.books is not None and not isinstance(self.books, list):
+            # 逐批产出的书单需要分给每台设备，先在本线程中读取完整
+            self.books = [book for books in self.books for book in books]
+        results = {}
+        threads = [threading.Thread(target=self.run_device, args=(address, results),
+                                    name=f'duokan-fanout-{address}', daemon=True)
+                   for address in self.addresses]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.tees.close()
+        return results
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2024, Your Name'
+__docformat__ = 'restructuredtext en'
+
+# 设备可达状态与熔断器。上传路径（transfer.send_book）记录每次连接的成败，
+# 连续失败达到阈值后熔断：批量发送在开始下一本书之前先用 GET {address}
+# 探测设备，设备恢复应答后自动继续，否则不再逐本等待超时。只依赖标准库，
+# 不导入 Qt。
+
+import http.client
+import threading
+import time
+from urllib.parse import urlsplit
+
+# 连续多少次连接失败后熔断
+FAILURE_THRESHOLD = 3
+# 探测超时（秒）；两次探测的最小间隔（秒），间隔内直接返回缓存的结果
+PROBE_TIMEOUT = 2.0
+PROBE_INTERVAL = 3.0
+# 熔断后批量发送最多暂停等待设备恢复的秒数，超过后剩余的书立即计为失败
+DEFAULT_OUTAGE_WAIT = 60.0
+
+
+def probe(address, timeout=PROBE_TIMEOUT):
+    """GET {address}，收到任何 HTTP 响应即认为设备可达。"""
+    from calibre_plugins.duokan_wifi_transfer.transfer import USER_AGENT
+    parts = urlsplit(address if '//' in address else 'http://' + address)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=timeout)
+    try:
+        conn.request('GET', parts.path or '/', headers={'User-Agent': USER_AGENT})
+        response = conn.getresponse()
+        response.read(64 * 1024)
+        return True
+    except (OSError, http.client.HTTPException):
+        return False
+    finally:
+        conn.close()
+
+
+class DeviceHealth(object):
+    """一台设备的可达状态。
+
+    record_success() / record_failure() 由上传路径在每次请求结束时调用；
+    连续 threshold 次连接失败后进入熔断状态（tripped），直到某次上传或
+    探测成功。探测结果缓存 probe_interval 秒，多个线程同时询问时只发出
+    一个探测请求。
+    """
+
+    def __init__(self, address, threshold=FAILURE_THRESHOLD, probe_interval=PROBE_INTERVAL):
+        self.address = address
+        self.threshold = max(1, int(threshold))
+        self.probe_interval = probe_interval
+        self.failures = 0
+        self.tripped_at = None
+        self.last_probe = None  # (monotonic 时间, 是否可达)
+        self._lock = threading.Lock()
+        self._probe_lock = threading.Lock()
+
+    @property
+    def tripped(self):
+        return self.tripped_at is not None
+
+    def record_success(self):
+        with self._lock:
+            if self.tripped_at is not None:
+                print(f"设备 {self.address} 已恢复应答，继续发送")
+            self.failures = 0
+            self.tripped_at = None
+            self.last_probe = (time.monotonic(), True)
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.last_probe = (time.monotonic(), False)
+            if self.failures >= self.threshold and self.tripped_at is None:
+                self.tripped_at = time.monotonic()
+                print(f"设备 {self.address} 连续 {self.failures} 次连接失败，暂停发送")
+
+    def reachable(self, max_age=None):
+        """返回设备是否可达；缓存的结果不超过 max_age 秒（默认 probe_interval）时直接使用。"""
+        max_age = self.probe_interval if max_age is None else max_age
+        with self._probe_lock:
+            cached = self.last_probe
+            if cached is not None and time.monotonic() - cached[0] < max_age:
+                return cached[1]
+            ok = probe(self.address)
+            if ok:
+                self.record_success()
+            else:
+                with self._lock:
+                    self.last_probe = (time.monotonic(), False)
+            return ok
+
+    def wait_until_reachable(self, max_wait=DEFAULT_OUTAGE_WAIT, cancelled=None):
+        """熔断时等待设备恢复，返回是否可以继续发送。
+
+        等待时间从熔断时刻算起，最多 max_wait 秒；超过之后只按（缓存的）
+        探测结果立即返回，因此同一次故障中剩余的书不会逐本等待。
+        """
+        cancelled = cancelled or (lambda: False)
+        while self.tripped:
+            if self.reachable():
+                return True
+            tripped_at = self.tripped_at
+            if tripped_at is None:
+                return True
+            remaining = tripped_at + max_wait - time.monotonic()
+            if remaining <= 0 or cancelled():
+                return False
+            time.sleep(min(self.probe_interval, remaining, 0.5))
+        return True
+
+
+_health = {}
+_health_lock = threading.Lock()
+
+
+def get_health(address):
+    """返回该设备地址共享的 DeviceHealth。"""
+    with _health_lock:
+        health = _health.get(address)
+        if health is None:
+            health = _health[address] = DeviceHealth(address)
+        return health
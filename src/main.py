@@ -13,11 +13,63 @@ from calibre.gui2 import error_dialog, info_dialog
 try:
     from qt.core import (QDialog, QVBoxLayout, QHBoxLayout, QPushButton, 
                         QLabel, QProgressBar, QLineEdit, QMessageBox,
-                        QThread, pyqtSignal)
+                        QThread, pyqtSignal, QSpinBox, QCheckBox, QInputDialog, QComboBox,
+                        QDoubleSpinBox, QTableWidget, QTableWidgetItem, QTableView,
+                        QAbstractTableModel, QModelIndex, QHeaderView, QTimer, Qt)
 except ImportError:
     from PyQt5.Qt import (QDialog, QVBoxLayout, QHBoxLayout, QPushButton, 
                          QLabel, QProgressBar, QLineEdit, QMessageBox,
-                         QThread, pyqtSignal)
+                         QThread, pyqtSignal, QSpinBox, QCheckBox, QInputDialog, QComboBox,
+                         QDoubleSpinBox, QTableWidget, QTableWidgetItem, QTableView,
+                         QAbstractTableModel, QModelIndex, QHeaderView, QTimer, Qt)
+
+from calibre_plugins.duokan_wifi_transfer.convert import DEFAULT_SOURCE_FORMATS
+from calibre_plugins.duokan_wifi_transfer.health import DEFAULT_OUTAGE_WAIT
+from calibre_plugins.duokan_wifi_transfer.service import RUNNING
+from calibre_plugins.duokan_wifi_transfer.transfer import TransferControl
+from calibre_plugins.duokan_wifi_transfer.engine import (
+    BatchSender, FanoutSender, QueuedSender, iter_book_batches, split_addresses, estimate_rate,
+    DEFAULT_MAX_CONCURRENT_UPLOADS, MIN_UPLOAD_TIMEOUT, ORDER_ORIGINAL, ORDER_SMALLEST_FIRST,
+    ORDER_LARGEST_FIRST)
+
+# 按字节显示进度时进度条的刻度数
+PROGRESS_SCALE = 1000
+
+# 发送顺序选项：(设置值, 显示名称)
+SEND_ORDER_CHOICES = (
+    (ORDER_ORIGINAL, '按选择顺序'),
+    (ORDER_SMALLEST_FIRST, '小书优先'),
+    (ORDER_LARGEST_FIRST, '大书优先'),
+)
+
+# 记住的最近使用地址数量，搜索设备时优先探测
+MAX_KNOWN_ADDRESSES = 8
+
+# 预览表格每次在后台读取的行数
+PREVIEW_CHUNK_SIZE = 500
+# 选中书籍变化后等待多少毫秒再刷新预览，拖动多选时只刷新一次
+SELECTION_REFRESH_DELAY = 300
+
+
+def format_size(nbytes):
+    """把字节数格式化为便于阅读的字符串。"""
+    for unit in ('B', 'KB', 'MB'):
+        if abs(nbytes) < 1024:
+            return f'{nbytes:.0f} {unit}' if unit == 'B' else f'{nbytes:.1f} {unit}'
+        nbytes /= 1024
+    return f'{nbytes:.2f} GB'
+
+
+def format_eta(seconds):
+    """把剩余秒数格式化为 时:分:秒，未知时返回 --。"""
+    if seconds < 0:
+        return '--'
+    seconds = int(seconds + 0.5)
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    if hours:
+        return f'{hours}:{minutes:02d}:{seconds:02d}'
+    return f'{minutes:02d}:{seconds:02d}'
 
 
 class ConnectionTestWorker(QThread):
@@ -47,48 +99,266 @@ class ConnectionTestWorker(QThread):
             self.finished.emit(False, 0, '', error_msg)
 
 
+class DiscoveryWorker(QThread):
+    """后台线程在局域网中搜索多看阅读WiFi传书服务。"""
+    found = pyqtSignal(str)  # address
+    finished = pyqtSignal(list)  # all found addresses
+
+    def __init__(self, known):
+        super(DiscoveryWorker, self).__init__()
+        self.known = known
+
+    def run(self):
+        from calibre_plugins.duokan_wifi_transfer.discovery import discover
+        try:
+            addresses = discover(self.known, on_found=self.found.emit,
+                                 cancelled=self.isInterruptionRequested)
+        except Exception as e:
+            print(f"搜索设备失败: {type(e).__name__}: {e}")
+            addresses = []
+        self.finished.emit(addresses)
+
+
 class SendBooksWorker(QThread):
-    """后台线程顺序发送书籍，减轻主线程压力。"""
-    progress = pyqtSignal(int, int, str)  # current_index, total, title
+    """后台线程运行 BatchSender，把进度回调转换为 Qt 信号。
+
+    传入 transfer_queue 时改用 QueuedSender：发送状态写入持久队列，失败的书
+    自动重试；此时 books 为 None 表示继续队列中该设备未完成的书。pause()、
+    resume() 和 cancel() 在当前分块发完之前生效；结束后 sent_titles 为已送达
+    的书名，sender.cancelled_books 为因取消而没有发送的书名。
+    """
+    progress = pyqtSignal(int, int, str)  # completed_count, total, title
+    # title, book_sent, book_total, batch_sent, batch_total, bytes_per_second, eta_seconds
+    # 字节数用 float 传递，避免超过 2 GB 时 int 信号参数溢出
+    bytes_progress = pyqtSignal(str, float, float, float, float, float, float)
+    synced = pyqtSignal(int, int)  # already_on_device_count, upload_count
+    skipped = pyqtSignal(int)  # already_sent_unchanged_count
+    retrying = pyqtSignal(int, float)  # waiting_count, delay_seconds
+    device_state = pyqtSignal(bool)  # reachable
     finished = pyqtSignal(int, list)  # success_count, failed_books
 
-    def __init__(self, plugin_action, books):
+    def __init__(self, plugin_action, books, address=None, transfer_queue=None, **kwargs):
         super(SendBooksWorker, self).__init__()
         self.plugin_action = plugin_action
-        self.books = books
+        address = address or plugin_action.duokan_wifi_address
+        self.control = TransferControl()
+        self.sent_titles = []
+        callbacks = dict(
+            on_progress=self.progress.emit,
+            on_bytes=self.bytes_progress.emit,
+            on_synced=self.synced.emit,
+            on_device_state=self.device_state.emit,
+            on_result=self.record_result,
+            control=self.control)
+        if transfer_queue is not None:
+            self.sender = QueuedSender(
+                transfer_queue, plugin_action.send_book_to_duokan, address, books,
+                on_retry_wait=self.retrying.emit, **callbacks, **kwargs)
+        else:
+            self.sender = BatchSender(
+                plugin_action.send_book_to_duokan, address, books, **callbacks, **kwargs)
+
+    def record_result(self, book, success, error_message):
+        if success:
+            self.sent_titles.append(book['title'])
+
+    def pause(self):
+        self.control.pause()
+
+    def resume(self):
+        self.control.resume()
+
+    def cancel(self):
+        self.control.cancel()
+
+    def summarize(self, success_count, failed_books):
+        """结果摘要，用于任务列表和状态栏"""
+        text = f'成功 {success_count} 本'
+        if failed_books:
+            text += f'，失败 {len(failed_books)} 本'
+        if self.sender.cancelled_books:
+            text += f'，取消 {len(self.sender.cancelled_books)} 本'
+        return text
+
+    def run(self):
+        # 传输服务靠 finished 信号启动下一个任务，发送出错时也必须发出
+        try:
+            success_count, failed_books = self.sender.run()
+        except Exception as e:
+            import traceback
+            print(f"发送出错:\n{traceback.format_exc()}")
+            success_count = len(self.sent_titles)
+            failed_books = [('发送中断', f'{type(e).__name__}: {e}')]
+        self.skipped.emit(self.sender.skipped_count)
+        self.finished.emit(success_count, failed_books)
+
+
+class FanoutWorker(QThread):
+    """后台线程运行 FanoutSender，信号的第一个参数为设备地址。"""
+    device_progress = pyqtSignal(str, int, int, str)  # address, completed_count, total, title
+    device_bytes = pyqtSignal(str, str, float, float, float, float, float, float)
+    device_finished = pyqtSignal(str, int, list, int)  # address, success_count, failed_books, skipped_count
+    finished = pyqtSignal(dict)  # {address: (success_count, failed_books, skipped_count)}
+
+    def __init__(self, plugin_action, addresses, books, **kwargs):
+        super(FanoutWorker, self).__init__()
+        self.control = TransferControl()
+        self.sender = FanoutSender(
+            plugin_action.send_book_to_duokan, addresses, books,
+            on_device_progress=self.device_progress.emit,
+            on_device_bytes=self.device_bytes.emit,
+            on_device_finished=self.device_finished.emit,
+            chunk_size=plugin_action.prefs.get('upload_chunk_size'),
+            control=self.control,
+            **kwargs)
+
+    def pause(self):
+        self.control.pause()
+
+    def resume(self):
+        self.control.resume()
+
+    def cancel(self):
+        self.control.cancel()
+
+    def summarize(self, results):
+        """结果摘要，用于任务列表和状态栏"""
+        parts = []
+        for address, (success_count, failed_books, skipped_count) in results.items():
+            text = f'{address} 成功 {success_count} 本'
+            if failed_books:
+                text += f'，失败 {len(failed_books)} 本'
+            parts.append(text)
+        return '；'.join(parts)
 
     def run(self):
-        success_count = 0
-        failed_books = []
-        total = len(self.books)
+        # 传输服务靠 finished 信号启动下一个任务，发送出错时也必须发出
+        try:
+            results = self.sender.run()
+        except Exception as e:
+            import traceback
+            print(f"发送出错:\n{traceback.format_exc()}")
+            error = [('发送中断', f'{type(e).__name__}: {e}')]
+            results = {address: (0, error, 0) for address in self.sender.addresses}
+        self.finished.emit(results)
 
-        for index, book in enumerate(self.books, start=1):
-            title = book['title']
-            epub_path = book['path']
+class BookPreviewLoader(QThread):
+    """后台线程按批读取选中书籍的书名、可发送格式和文件大小。
 
-            self.progress.emit(index, total, title)
+    每批发出 loaded(起始行, [(书名, 格式说明, 大小或 None)])；开始时先根据
+    实测速率和传输历史估计速率，发出 rate_estimated(字节/秒，未知时为 0)。
+    """
+    loaded = pyqtSignal(int, list)
+    rate_estimated = pyqtSignal(float)
 
+    def __init__(self, plugin_action, db, book_ids, address, convert, source_formats):
+        super(BookPreviewLoader, self).__init__()
+        self.plugin_action = plugin_action
+        self.db = db
+        self.book_ids = book_ids
+        self.address = address
+        self.convert = convert
+        self.source_formats = [fmt.upper() for fmt in source_formats]
+
+    def run(self):
+        try:
+            records = self.plugin_action.get_metrics().load()
+        except Exception:
+            records = []
+        self.rate_estimated.emit(
+            estimate_rate(self.address, records, self.plugin_action.get_rate_limit()) or 0.0)
+
+        for start in range(0, len(self.book_ids), PREVIEW_CHUNK_SIZE):
+            if self.isInterruptionRequested():
+                return
+            chunk = self.book_ids[start:start + PREVIEW_CHUNK_SIZE]
             try:
-                result = self.plugin_action.send_book_to_duokan(epub_path, title)
-                if isinstance(result, tuple):
-                    success, error_message = result
-                else:
-                    success = bool(result)
-                    error_message = None if success else '发送失败'
+                titles = self.db.all_field_for('title', chunk, default_value=None)
+                formats = self.db.all_field_for('formats', chunk, default_value=())
             except Exception as e:
-                import traceback
-                error_msg = f'错误类型: {type(e).__name__}\n错误信息: {str(e)}\n\n详细追踪:\n{traceback.format_exc()}'
-                failed_books.append((title, error_msg))
-                continue
+                print(f"读取书籍信息失败: {type(e).__name__}: {e}")
+                return
+            rows = []
+            for book_id in chunk:
+                rows.append(self.describe(book_id, titles.get(book_id) or f'ID {book_id}',
+                                          {fmt.upper() for fmt in formats.get(book_id) or ()}))
+            self.loaded.emit(start, rows)
 
-            if success:
-                success_count += 1
-            else:
-                failed_books.append((title, error_message or '发送失败'))
+    def describe(self, book_id, title, formats):
+        fmt = 'EPUB' if 'EPUB' in formats else None
+        if fmt is None and self.convert:
+            fmt = next((f for f in self.source_formats if f in formats), None)
+        if fmt is None:
+            return (title, '无EPUB', None)
+        try:
+            path = self.db.format_abspath(book_id, fmt)
+            size = os.path.getsize(path) if path else None
+        except OSError:
+            size = None
+        if size is None:
+            return (title, f'{fmt}（无法读取）', None)
+        return (title, 'EPUB' if fmt == 'EPUB' else f'{fmt}→EPUB', size)
+
+
+class BookPreviewModel(QAbstractTableModel):
+    """选中书籍的预览表格模型。
+
+    行数一开始就等于选中数量，内容由 BookPreviewLoader 分批填入，未读取的
+    行显示占位符，因此上万行时界面也不会卡顿。同时累计可发送的数量和字节数。
+    """
+    HEADERS = ('书名', '格式', '大小')
+
+    def __init__(self, count, parent=None):
+        QAbstractTableModel.__init__(self, parent)
+        self.rows = [None] * count
+        self.loaded_count = 0
+        self.sendable_count = 0
+        self.total_bytes = 0
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if role == Qt.ItemDataRole.DisplayRole and orientation == Qt.Orientation.Horizontal:
+            return self.HEADERS[section]
+        return None
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        row = self.rows[index.row()]
+        column = index.column()
+        if role == Qt.ItemDataRole.DisplayRole:
+            if row is None:
+                return '...' if column == 0 else ''
+            if column == 2:
+                return format_size(row[2]) if row[2] is not None else '--'
+            return row[column]
+        if role == Qt.ItemDataRole.TextAlignmentRole and column == 2:
+            return int(Qt.AlignmentFlag.AlignRight | Qt.AlignmentFlag.AlignVCenter)
+        return None
+
+    def set_rows(self, start, rows):
+        # 行数在创建时已告知视图，超出部分不能写入
+        rows = rows[:max(0, len(self.rows) - start)]
+        if not rows:
+            return
+        self.rows[start:start + len(rows)] = rows
+        self.loaded_count += len(rows)
+        for _, _, size in rows:
+            if size is not None:
+                self.sendable_count += 1
+                self.total_bytes += size
+        self.dataChanged.emit(self.index(start, 0), self.index(start + len(rows) - 1, len(self.HEADERS) - 1))
 
-        self.finished.emit(success_count, failed_books)
 
 class DuokanWiFiDialog(QDialog):
+    # EPUB 预检在发送线程中逐批完成时发出：checked_count, bad_count
+    preflight_checked = pyqtSignal(int, int)
+
     def __init__(self, gui, plugin_action):
         QDialog.__init__(self, gui)
         self.gui = gui
@@ -107,21 +377,88 @@ class DuokanWiFiDialog(QDialog):
         # WiFi地址设置部分
         wifi_group = QHBoxLayout()
         wifi_group.addWidget(QLabel('多看阅读WiFi地址:'))
-        self.wifi_address = QLineEdit(self.plugin_action.duokan_wifi_address)
+        addresses = self.plugin_action.prefs.get('wifi_addresses') or [self.plugin_action.duokan_wifi_address]
+        self.wifi_address = QLineEdit(', '.join(addresses))
+        self.wifi_address.setToolTip('同时发送到多台设备时，用逗号分隔多个地址')
         wifi_group.addWidget(self.wifi_address)
         self.test_button = QPushButton('测试连接')
         self.test_button.clicked.connect(self.test_connection)
         wifi_group.addWidget(self.test_button)
+        self.discover_button = QPushButton('搜索设备')
+        self.discover_button.setToolTip('在局域网中查找已开启WiFi传书的手机，先尝试上次使用的地址')
+        self.discover_button.clicked.connect(self.discover_devices)
+        wifi_group.addWidget(self.discover_button)
         layout.addLayout(wifi_group)
+
+        # 并发上传设置
+        concurrency_group = QHBoxLayout()
+        concurrency_group.addWidget(QLabel('同时上传数量:'))
+        self.max_workers = QSpinBox()
+        self.max_workers.setRange(1, 8)
+        self.max_workers.setValue(int(self.plugin_action.prefs.get(
+            'max_concurrent_uploads', DEFAULT_MAX_CONCURRENT_UPLOADS)))
+        concurrency_group.addWidget(self.max_workers)
+        concurrency_group.addWidget(QLabel('发送顺序:'))
+        self.send_order = QComboBox()
+        for value, label in SEND_ORDER_CHOICES:
+            self.send_order.addItem(label, value)
+        self.send_order.setToolTip('小书优先可以最快看到进度；同时上传多本时大书优先总耗时最短')
+        index = self.send_order.findData(self.plugin_action.prefs.get('send_order', ORDER_ORIGINAL))
+        self.send_order.setCurrentIndex(max(0, index))
+        concurrency_group.addWidget(self.send_order)
+        concurrency_group.addStretch()
+        self.skip_sent = QCheckBox('跳过已发送且未变化的书籍')
+        self.skip_sent.setChecked(bool(self.plugin_action.prefs.get('skip_sent_books', True)))
+        concurrency_group.addWidget(self.skip_sent)
+        layout.addLayout(concurrency_group)
+
+        # 发送前处理选项
+        options_group = QHBoxLayout()
+        self.slim_books = QCheckBox('发送前精简EPUB')
+        self.slim_books.setToolTip('重新压缩并缩小超大图片，结果缓存在本地，重复发送时不再处理')
+        self.slim_books.setChecked(bool(self.plugin_action.prefs.get('slim_enabled', False)))
+        options_group.addWidget(self.slim_books)
+        self.convert_books = QCheckBox('转换非EPUB格式')
+        self.convert_books.setToolTip('没有EPUB格式的书籍在后台转换为EPUB后发送，转换结果缓存在本地')
+        self.convert_books.setChecked(bool(self.plugin_action.prefs.get('convert_enabled', False)))
+        options_group.addWidget(self.convert_books)
+        options_group.addStretch()
+        options_group.addWidget(QLabel('限速:'))
+        self.rate_limit = QDoubleSpinBox()
+        self.rate_limit.setRange(0, 1000)
+        self.rate_limit.setDecimals(1)
+        self.rate_limit.setSingleStep(0.5)
+        self.rate_limit.setSuffix(' MB/s')
+        self.rate_limit.setSpecialValueText('不限')
+        self.rate_limit.setToolTip('同一设备的所有上传共用此上限；分时段限速见 rate_limit_schedule 设置')
+        self.rate_limit.setValue(float(self.plugin_action.prefs.get('rate_limit_mbps', 0) or 0))
+        self.rate_limit.valueChanged.connect(self.on_rate_limit_changed)
+        options_group.addWidget(self.rate_limit)
+        layout.addLayout(options_group)
         
         # 选中书籍信息
         self.book_info = QLabel()
         layout.addWidget(self.book_info)
+        self.book_table = QTableView()
+        self.book_table.setSelectionMode(QTableView.SelectionMode.NoSelection)
+        self.book_table.setWordWrap(False)
+        self.book_table.verticalHeader().setVisible(False)
+        # 固定行高，上万行时不用逐行计算尺寸
+        self.book_table.verticalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Fixed)
+        self.book_table.verticalHeader().setDefaultSectionSize(
+            self.book_table.fontMetrics().height() + 6)
+        self.book_table.setMinimumHeight(160)
+        layout.addWidget(self.book_table)
         
         # 进度条
         self.progress = QProgressBar()
         self.progress.setVisible(False)
         layout.addWidget(self.progress)
+
+        # 多设备发送时每台设备一个进度条
+        self.device_layout = QVBoxLayout()
+        layout.addLayout(self.device_layout)
+        self.device_bars = {}
         
         # 按钮区域
         button_box = QHBoxLayout()
@@ -130,6 +467,31 @@ class DuokanWiFiDialog(QDialog):
         self.send_button = QPushButton('发送选中的书籍')
         self.send_button.clicked.connect(self.send_books)
         button_box.addWidget(self.send_button)
+
+        # 同步按钮：与设备已有文件比对，只发送缺失或变化的书籍
+        self.sync_button = QPushButton('同步（仅发送缺失的书籍）')
+        self.sync_button.clicked.connect(self.sync_books)
+        button_box.addWidget(self.sync_button)
+
+        # 继续按钮：发送上次中断（或重试用尽）后留在队列中的书籍，无需重新选书
+        self.resume_button = QPushButton()
+        self.resume_button.clicked.connect(self.resume_queue)
+        button_box.addWidget(self.resume_button)
+
+        # 发送过程中的暂停/继续和取消，在当前分块发完之前生效
+        self.pause_button = QPushButton('暂停')
+        self.pause_button.clicked.connect(self.toggle_pause)
+        self.pause_button.setVisible(False)
+        button_box.addWidget(self.pause_button)
+        self.cancel_button = QPushButton('取消发送')
+        self.cancel_button.clicked.connect(self.cancel_send)
+        self.cancel_button.setVisible(False)
+        button_box.addWidget(self.cancel_button)
+        
+        # 传输服务中的全部任务，包括关闭对话框后仍在进行的发送
+        jobs_button = QPushButton('传输任务')
+        jobs_button.clicked.connect(self.plugin_action.show_jobs)
+        button_box.addWidget(jobs_button)
         
         # 保存设置按钮
         save_button = QPushButton('保存设置')
@@ -144,33 +506,234 @@ class DuokanWiFiDialog(QDialog):
         layout.addLayout(button_box)
         
         # 更新书籍信息
+        self.preview_thread = None
+        # 尚未结束的预览线程；结束前保留引用，避免运行中被销毁
+        self.running_previews = set()
+        self.preview_rate = 0.0
         self.update_book_info()
+        # 是否转换决定哪些书可以发送，切换时重新统计
+        self.convert_books.toggled.connect(self.update_book_info)
         self.connection_thread = None
+        self.discovery_thread = None
+        # 对话框显示进度的发送任务及其信号连接；任务由传输服务运行，关闭对话框时
+        # 只断开连接
+        self.send_job = None
         self.send_thread = None
-        self.initial_failed_books = []
+        self.worker_connections = []
+        self.plugin_action.get_service().job_finished.connect(self.on_job_finished)
+        self.selection_timer = QTimer(self)
+        self.selection_timer.setSingleShot(True)
+        self.selection_timer.setInterval(SELECTION_REFRESH_DELAY)
+        self.selection_timer.timeout.connect(self.on_selection_settled)
+        self.gui.library_view.selectionModel().selectionChanged.connect(self.selection_timer.start)
+        self.update_resume_button()
+        self.skipped_count = 0
+        self.device_skipped_count = 0
+        self.books_done = ''
+        self.preflight_checked.connect(self.on_preflight_checked)
     
-    def update_book_info(self):
-        """更新选中书籍的信息"""
+    def closeEvent(self, event):
+        self.stop_background_threads()
+        QDialog.closeEvent(self, event)
+
+    def reject(self):
+        # 按 Esc 关闭时不经过 closeEvent
+        self.stop_background_threads()
+        QDialog.reject(self)
+
+    def stop_background_threads(self):
+        # 扫描网段最多需要几秒，关闭对话框时让搜索线程尽快结束
+        if self.discovery_thread and self.discovery_thread.isRunning():
+            self.discovery_thread.requestInterruption()
+            self.discovery_thread.wait()
+        self.stop_preview()
+        # 发送任务由传输服务继续运行，结果显示在状态栏和传输任务列表中
+        self.detach()
+
+    def attach(self, job, connections):
+        """显示 job 的进度；connections 为 [(worker 信号, 对话框槽)]。"""
+        self.send_job = job
+        self.send_thread = job.worker
+        self.skipped_count = 0
+        self.device_skipped_count = 0
+        for signal, slot in connections:
+            signal.connect(slot)
+        self.worker_connections = connections
+        ahead = self.plugin_action.get_service().pending_ahead(job)
+        if ahead:
+            self.progress.setFormat(f'已加入队列，前面还有 {ahead} 个任务')
+            for bar in self.device_bars.values():
+                bar.setFormat(f'已加入队列，前面还有 {ahead} 个任务')
+
+    def detach(self):
+        """断开与当前发送任务的信号连接并复位进度显示，返回该任务的线程。"""
+        for signal, slot in self.worker_connections:
+            try:
+                signal.disconnect(slot)
+            except (TypeError, RuntimeError):
+                pass
+        self.worker_connections = []
+        worker, self.send_thread, self.send_job = self.send_thread, None, None
+        self.progress.setVisible(False)
+        self.progress.setValue(0)
+        self.progress.setFormat('')
+        for bar in self.device_bars.values():
+            self.device_layout.removeWidget(bar)
+            bar.deleteLater()
+        self.device_bars = {}
+        self.test_button.setEnabled(True)
+        self.show_send_controls(False)
+        self.update_resume_button()
+        return worker
+
+    def on_job_finished(self, job):
+        # 排队时被取消的任务不会发出 finished 信号
+        if job is self.send_job and not job.started:
+            self.detach()
+        else:
+            self.update_resume_button()
+
+    def toggle_pause(self):
+        if not self.send_job:
+            return
+        service = self.plugin_action.get_service()
+        if self.send_thread.control.paused:
+            service.resume(self.send_job)
+            self.pause_button.setText('暂停')
+        else:
+            service.pause(self.send_job)
+            self.pause_button.setText('继续')
+            self.progress.setFormat(f'{self.books_done} 已暂停')
+
+    def cancel_send(self):
+        if not self.send_job:
+            return
+        self.plugin_action.get_service().cancel(self.send_job)
+        self.pause_button.setEnabled(False)
+        self.cancel_button.setEnabled(False)
+        self.progress.setFormat('正在取消...')
+
+    def show_send_controls(self, visible):
+        self.pause_button.setText('暂停')
+        for button in (self.pause_button, self.cancel_button):
+            button.setVisible(visible)
+            button.setEnabled(visible)
+
+    def on_rate_limit_changed(self, value):
+        """限速立即生效，包括正在进行的上传"""
+        self.plugin_action.prefs['rate_limit_mbps'] = value
+        from calibre_plugins.duokan_wifi_transfer.transfer import get_limiter
+        for address in split_addresses(self.wifi_address.text()):
+            get_limiter(address, self.plugin_action.get_rate_limit())
+
+    def on_selection_settled(self):
+        # 对话框不是模态的，用户可以在打开时改选书籍
+        if self.isVisible():
+            self.update_book_info()
+
+    def update_book_info(self, checked=False):
+        """更新选中书籍的预览表格，书名、格式和大小在后台线程中读取"""
+        self.stop_preview()
         rows = self.gui.library_view.selectionModel().selectedRows()
-        count = len(rows)
-        if count == 0:
+        ids = list(map(self.gui.library_view.model().id, rows))
+        self.book_model = BookPreviewModel(len(ids), self)
+        self.book_table.setModel(self.book_model)
+        header = self.book_table.horizontalHeader()
+        header.setSectionResizeMode(0, QHeaderView.ResizeMode.Stretch)
+        header.setSectionResizeMode(1, QHeaderView.ResizeMode.ResizeToContents)
+        header.setSectionResizeMode(2, QHeaderView.ResizeMode.ResizeToContents)
+        self.book_table.setVisible(bool(ids))
+        self.send_button.setEnabled(bool(ids))
+        self.sync_button.setEnabled(bool(ids))
+        if not ids:
             self.book_info.setText('未选择任何书籍')
-            self.send_button.setEnabled(False)
-        else:
-            self.book_info.setText(f'已选择 {count} 本书籍')
-            self.send_button.setEnabled(True)
+            return
+
+        addresses = self.read_addresses()
+        self.preview_thread = BookPreviewLoader(
+            self.plugin_action, self.gui.current_db.new_api, ids,
+            addresses[0] if addresses else self.plugin_action.duokan_wifi_address,
+            self.convert_books.isChecked(),
+            self.plugin_action.prefs.get('convert_source_formats', DEFAULT_SOURCE_FORMATS))
+        self.preview_thread.loaded.connect(self.on_preview_loaded)
+        self.preview_thread.rate_estimated.connect(self.on_preview_rate)
+        self.preview_thread.finished.connect(self.on_preview_finished)
+        self.running_previews.add(self.preview_thread)
+        self.update_book_totals()
+        self.preview_thread.start()
+
+    def stop_preview(self):
+        thread, self.preview_thread = self.preview_thread, None
+        if thread is None:
+            return
+        # 先断开信号：已经排队的 loaded 不能写入下一次选择的模型
+        thread.loaded.disconnect(self.on_preview_loaded)
+        thread.rate_estimated.disconnect(self.on_preview_rate)
+        # 不在界面线程中等待：线程读完当前一批后自行结束，之后在
+        # on_preview_finished 中释放
+        thread.requestInterruption()
+
+    def on_preview_finished(self):
+        thread = self.sender()
+        self.running_previews.discard(thread)
+        if thread is not self.preview_thread:
+            thread.deleteLater()
+
+    def on_preview_loaded(self, start, rows):
+        # 断开前已经投递的信号也可能在之后送达，只接受当前加载线程的结果
+        if self.sender() is not self.preview_thread:
+            return
+        self.book_model.set_rows(start, rows)
+        self.update_book_totals()
+
+    def on_preview_rate(self, rate):
+        if self.sender() is not self.preview_thread:
+            return
+        self.preview_rate = rate
+        self.update_book_totals()
+
+    def update_book_totals(self):
+        """显示已读取部分的可发送数量、总大小和按实测速率估计的耗时"""
+        model = self.book_model
+        text = f'已选择 {len(model.rows)} 本书籍'
+        if model.loaded_count < len(model.rows):
+            text += f'（已读取 {model.loaded_count} 本）'
+        text += f'，可发送 {model.sendable_count} 本，共 {format_size(model.total_bytes)}'
+        missing = model.loaded_count - model.sendable_count
+        if missing:
+            text += f'，{missing} 本无法发送'
+        if self.preview_rate > 0:
+            text += (f'，预计 {format_eta(model.total_bytes / self.preview_rate)}'
+                     f'（{format_size(self.preview_rate)}/s）')
+        self.book_info.setText(text)
     
+    def update_resume_button(self):
+        """根据发送队列中未完成的书籍数量显示继续按钮"""
+        try:
+            count = self.plugin_action.get_queue().unfinished()
+        except Exception as e:
+            print(f"读取发送队列失败: {type(e).__name__}: {e}")
+            count = 0
+        self.resume_button.setText(f'继续未完成的发送（{count} 本）')
+        self.resume_button.setVisible(count > 0)
+        # 队列中的任务启动后才把书写入发送队列，忙时继续会重复发送
+        self.resume_button.setEnabled(not self.plugin_action.get_service().busy)
+
+    def read_addresses(self):
+        """解析地址输入框中的一个或多个地址，为空时返回空列表。"""
+        addresses = split_addresses(self.wifi_address.text())
+        if addresses:
+            self.wifi_address.setText(', '.join(addresses))
+        return addresses
+
     def test_connection(self):
         """测试与多看阅读WiFi服务的连接"""
-        raw_address = self.wifi_address.text().strip()
-        if not raw_address:
+        addresses = self.read_addresses()
+        if not addresses:
             return error_dialog(self, '错误', '请输入多看阅读WiFi地址', show=True)
-        
-        address = raw_address
-        if not address.startswith('http://'):
-            address = 'http://' + address
-            self.wifi_address.setText(address)
-        
+        # 多个地址时测试第一个
+        address = addresses[0]
+
         if self.connection_thread and self.connection_thread.isRunning():
             return
 
@@ -194,6 +757,7 @@ class DuokanWiFiDialog(QDialog):
         self.connection_thread = None
 
         if success:
+            self.remember_addresses(self.read_addresses()[:1])
             QMessageBox.information(self, '成功', '成功连接到多看阅读WiFi服务')
         else:
             if error_message:
@@ -204,69 +768,160 @@ class DuokanWiFiDialog(QDialog):
                     f'无法连接到多看阅读WiFi服务。\n状态码: {status_code}\n响应: {content}'
                 )
 
-    def on_send_progress(self, current, total, title):
-        """Update progress bar from background thread."""
-        self.progress.setMaximum(total)
-        self.progress.setValue(current)
-        self.progress.setFormat(f'正在处理: {title}')
+    def remember_addresses(self, addresses):
+        """把连接成功的地址放到最近使用列表的最前面。"""
+        prefs = self.plugin_action.prefs
+        known = [a for a in prefs.get('known_addresses', []) if a not in addresses]
+        prefs['known_addresses'] = (list(addresses) + known)[:MAX_KNOWN_ADDRESSES]
 
-    def on_send_finished(self, success_count, worker_failed_books):
-        """Handle completion of book sending."""
+    def discover_devices(self):
+        """在局域网中搜索多看阅读WiFi传书服务"""
+        if self.discovery_thread and self.discovery_thread.isRunning():
+            return
+        prefs = self.plugin_action.prefs
+        known = self.read_addresses() + [
+            a for a in prefs.get('known_addresses', []) if a not in self.read_addresses()]
+
+        self.discover_button.setEnabled(False)
+        self.progress.setVisible(True)
+        self.progress.setMaximum(0)
+        self.progress.setFormat('正在搜索设备...')
+
+        self.discovery_thread = DiscoveryWorker(known)
+        self.discovery_thread.found.connect(self.on_device_found)
+        self.discovery_thread.finished.connect(self.on_discovery_finished)
+        self.discovery_thread.start()
+
+    def on_device_found(self, address):
+        """Show each hit while the scan continues."""
+        self.progress.setFormat(f'正在搜索设备... 已找到 {address}')
+
+    def on_discovery_finished(self, addresses):
+        """Offer the discovered addresses to the user."""
         self.progress.setVisible(False)
+        self.progress.setMaximum(1)
         self.progress.setValue(0)
         self.progress.setFormat('')
+        self.discover_button.setEnabled(True)
+        self.discovery_thread = None
 
-        self.send_button.setEnabled(True)
-        self.test_button.setEnabled(True)
+        if not addresses:
+            return QMessageBox.warning(
+                self, '未找到设备', '局域网中没有找到多看阅读WiFi传书服务。\n'
+                '请确认手机已开启WiFi传书，并与电脑连接到同一网络。')
+        if len(addresses) == 1:
+            choice = addresses[0]
+        else:
+            all_devices = '全部（同时发送到 {} 台设备）'.format(len(addresses))
+            choice, ok = QInputDialog.getItem(
+                self, '选择设备', '找到以下多看阅读WiFi传书服务:',
+                addresses + [all_devices], 0, False)
+            if not ok:
+                return
+            if choice == all_devices:
+                choice = ', '.join(addresses)
+        self.wifi_address.setText(choice)
+        self.remember_addresses(split_addresses(choice))
 
-        self.send_thread = None
+    def on_send_progress(self, current, total, title):
+        """Record finished-book count from background thread."""
+        self.books_done = f'{current}/{total}'
 
-        failed_books = list(self.initial_failed_books)
-        failed_books.extend(worker_failed_books)
-        self.initial_failed_books = []
+    def on_bytes_progress(self, title, book_sent, book_total, batch_sent, batch_total, rate, eta):
+        """Update progress bar with byte-level progress, throughput and ETA."""
+        self.progress.setMaximum(PROGRESS_SCALE)
+        self.progress.setValue(int(PROGRESS_SCALE * batch_sent / batch_total) if batch_total else 0)
+        book_percent = int(100 * book_sent / book_total) if book_total else 100
+        self.progress.setFormat(
+            f'{self.books_done} {title} {book_percent}% | '
+            f'{format_size(batch_sent)}/{format_size(batch_total)} | '
+            f'{format_size(rate)}/s | 剩余 {format_eta(eta)}'
+        )
 
+    def on_send_synced(self, device_skipped_count, upload_count):
+        """Record the result of diffing against the device's file list."""
+        self.device_skipped_count = device_skipped_count
+
+    def on_send_skipped(self, skipped_count):
+        """Record how many books were skipped as already sent and unchanged."""
+        self.skipped_count = skipped_count
+
+    def on_send_retrying(self, waiting_count, delay):
+        """Show that failed books are waiting for an automatic retry."""
+        self.progress.setFormat(f'{waiting_count} 本发送失败，{format_eta(delay)} 后自动重试')
+
+    def on_preflight_checked(self, checked_count, bad_count):
+        """Report corrupt EPUBs as soon as the preflight finds them."""
+        if bad_count:
+            self.gui.status_bar.show_message(
+                f'已检查 {checked_count} 本，{bad_count} 本 EPUB 文件损坏，将不会发送', 10000)
+
+    def on_device_state(self, reachable):
+        """Show that the batch is paused while the device does not answer."""
+        if not reachable:
+            self.progress.setFormat('设备无应答，等待重新连接...')
+
+    def on_send_finished(self, success_count, worker_failed_books):
+        """Handle completion of book sending."""
+        worker = self.detach()
+        if success_count:
+            self.remember_addresses([self.plugin_action.duokan_wifi_address])
+
+        failed_books = list(worker_failed_books)
+        skipped_count, self.skipped_count = self.skipped_count, 0
+        device_skipped_count, self.device_skipped_count = self.device_skipped_count, 0
+        skipped_count += device_skipped_count
+        if worker is not None and worker.control.cancelled:
+            return self.show_cancelled(worker.sent_titles, worker.sender.cancelled_books, failed_books)
+
+        if not success_count and not failed_books and skipped_count == device_skipped_count == 0:
+            return QMessageBox.information(self, '完成', '没有需要发送的书籍')
         result_message = f'成功发送 {success_count} 本书籍到多看阅读\n'
+        if skipped_count - device_skipped_count:
+            result_message += f'跳过 {skipped_count - device_skipped_count} 本已发送且未变化的书籍\n'
+        if device_skipped_count:
+            result_message += f'跳过 {device_skipped_count} 本设备上已存在的书籍\n'
         if failed_books:
             result_message += '\n发送失败的书籍：\n'
             for book, reason in failed_books:
                 result_message += f'- {book}: {reason}\n'
 
-        if success_count > 0:
+        if success_count > 0 or (skipped_count and not failed_books):
             QMessageBox.information(self, '完成', result_message)
         else:
             QMessageBox.warning(self, '失败', result_message)
 
     def save_settings(self):
         """保存WiFi地址设置"""
-        raw_address = self.wifi_address.text().strip()
-        if not raw_address:
+        addresses = self.read_addresses()
+        if not addresses:
             return error_dialog(self, '错误', '请输入多看阅读WiFi地址', show=True)
-        
-        address = raw_address
-        if not address.startswith('http://'):
-            address = 'http://' + address
-            self.wifi_address.setText(address)
-        
-        self.plugin_action.duokan_wifi_address = address
-        self.plugin_action.prefs['wifi_address'] = address
+
+        self.plugin_action.duokan_wifi_address = addresses[0]
+        self.plugin_action.prefs['wifi_address'] = addresses[0]
+        self.plugin_action.prefs['wifi_addresses'] = addresses
+        self.plugin_action.prefs['max_concurrent_uploads'] = self.max_workers.value()
+        self.plugin_action.prefs['send_order'] = self.send_order.currentData()
+        self.plugin_action.prefs['rate_limit_mbps'] = self.rate_limit.value()
+        self.plugin_action.prefs['skip_sent_books'] = self.skip_sent.isChecked()
+        self.plugin_action.prefs['slim_enabled'] = self.slim_books.isChecked()
+        self.plugin_action.prefs['convert_enabled'] = self.convert_books.isChecked()
         QMessageBox.information(self, '成功', '设置已保存')
     
-    def send_books(self):
-        """发送选中的书籍到多看阅读"""
-        if self.send_thread and self.send_thread.isRunning():
-            return QMessageBox.information(self, '提示', '正在发送书籍，请稍候')
+    def sync_books(self):
+        """只发送设备上缺失或已变化的书籍"""
+        return self.send_books(sync=True)
 
+    def send_books(self, checked=False, sync=False):
+        """发送选中的书籍到多看阅读，已有任务在进行时排在其后"""
         # 确保目标地址有效
-        raw_address = self.wifi_address.text().strip()
-        if not raw_address:
+        addresses = self.read_addresses()
+        if not addresses:
             return error_dialog(self, '错误', '请输入多看阅读WiFi地址', show=True)
 
-        current_address = raw_address
-        if not current_address.startswith('http://'):
-            current_address = 'http://' + current_address
-            self.wifi_address.setText(current_address)
-
+        current_address = addresses[0]
         self.plugin_action.duokan_wifi_address = current_address
+        fanout = len(addresses) > 1
 
         # 获取选中的书籍
         rows = self.gui.library_view.selectionModel().selectedRows()
@@ -277,51 +932,329 @@ class DuokanWiFiDialog(QDialog):
         ids = list(map(self.gui.library_view.model().id, rows))
         db = self.gui.current_db.new_api
 
-        books_to_send = []
-        self.initial_failed_books = []
+        convert = self.convert_books.isChecked()
+        manifest = self.plugin_action.get_manifest()
+        # 书名和格式在后台线程中按批读取，读到第一批即开始上传；已发送清单
+        # 由各设备的 BatchSender 分别过滤
+        book_batches = iter_book_batches(
+            db, ids, convert=convert,
+            source_formats=self.plugin_action.prefs.get('convert_source_formats', DEFAULT_SOURCE_FORMATS))
 
-        for book_id in ids:
-            metadata = None
-            title = f'ID {book_id}'
-            try:
-                metadata = db.get_metadata(book_id)
-                if metadata:
-                    title = metadata.title or title
-            except Exception as e:
-                import traceback
-                error_msg = f'错误类型: {type(e).__name__}\n错误信息: {str(e)}'
-                self.initial_failed_books.append((title, error_msg))
-                print(f"准备书籍 {title} 时出错:\n{traceback.format_exc()}")
-                continue
-
-            epub_path = db.format_abspath(book_id, 'EPUB')
-            if not epub_path:
-                self.initial_failed_books.append((title, "没有EPUB格式"))
-                continue
-
-            books_to_send.append({'title': title, 'path': epub_path})
-
-        if not books_to_send:
-            result_message = '没有可发送的书籍。\n'
-            if self.initial_failed_books:
-                result_message += '\n发送失败的书籍：\n'
-                for book, reason in self.initial_failed_books:
-                    result_message += f'- {book}: {reason}\n'
-            QMessageBox.warning(self, '失败', result_message)
-            return
+        # 准备进度条和按钮；之前显示的任务在传输服务中继续运行
+        self.detach()
+        self.progress.setMaximum(PROGRESS_SCALE)
+        self.progress.setValue(0)
+        self.progress.setFormat('正在获取设备文件列表...' if sync else '准备发送...')
+        self.progress.setVisible(True)
+
+        self.disable_send_buttons()
+
+        # 损坏的 EPUB 在每批交给发送引擎之前检出，直接计为失败
+        if self.plugin_action.prefs.get('preflight_enabled', True):
+            book_batches = self.plugin_action.get_preflight().check_batches(
+                book_batches, on_checked=self.preflight_checked.emit)
+
+        # 发送前处理：先转换非 EPUB 格式，再精简
+        preparers = self.build_preparers(convert)
+
+        if fanout:
+            return self.start_fanout(addresses, book_batches, manifest, sync, preparers)
+        self.start_send(current_address, book_batches, len(ids), manifest, sync, preparers,
+                        skip_sent=self.skip_sent.isChecked())
+
+    def disable_send_buttons(self):
+        # 发送和同步按钮保持可用：再次发送的任务在传输服务中排队
+        self.test_button.setEnabled(False)
+        self.resume_button.setEnabled(False)
+        self.show_send_controls(True)
 
-        # 准备进度条和按钮
-        total = len(books_to_send)
-        self.progress.setMaximum(total)
+    def build_preparers(self, convert):
+        preparers = []
+        if convert:
+            preparers.append(self.plugin_action.get_converter())
+        if self.slim_books.isChecked():
+            preparers.append(self.plugin_action.get_slimmer())
+        return preparers
+
+    def batch_options(self):
+        """对话框和设置中与调度有关的 BatchSender 参数"""
+        prefs = self.plugin_action.prefs
+        return dict(
+            max_workers=self.max_workers.value(),
+            ordered=prefs.get('preserve_send_order', False),
+            order=self.send_order.currentData(),
+            min_timeout=int(prefs.get('upload_timeout', MIN_UPLOAD_TIMEOUT)),
+            outage_wait=float(prefs.get('device_outage_wait', DEFAULT_OUTAGE_WAIT)))
+
+    def start_send(self, address, books, total, manifest, sync, preparers, skip_sent=False):
+        """把发送到单台设备的任务提交给传输服务；books 为 None 时继续队列中的书。"""
+        worker = SendBooksWorker(
+            self.plugin_action, books, address=address,
+            transfer_queue=self.plugin_action.get_queue(),
+            manifest=manifest, sync=sync, preparers=preparers, skip_sent=skip_sent,
+            **self.batch_options())
+        action = '同步' if sync else ('继续发送' if books is None else '发送')
+        job = self.plugin_action.get_service().submit(worker, f'{action} {total} 本书到 {address}')
+        self.attach(job, [
+            (worker.progress, self.on_send_progress),
+            (worker.bytes_progress, self.on_bytes_progress),
+            (worker.synced, self.on_send_synced),
+            (worker.skipped, self.on_send_skipped),
+            (worker.retrying, self.on_send_retrying),
+            (worker.device_state, self.on_device_state),
+            (worker.finished, self.on_send_finished),
+        ])
+        self.books_done = f'0/{total}'
+
+
+    def resume_queue(self):
+        """继续发送队列中未完成的书籍，不重新读取书库"""
+        if self.plugin_action.get_service().busy:
+            return QMessageBox.information(self, '提示', '正在发送书籍，请稍候')
+        transfer_queue = self.plugin_action.get_queue()
+        addresses = transfer_queue.addresses()
+        if not addresses:
+            return self.update_resume_button()
+
+        self.detach()
+        self.progress.setMaximum(PROGRESS_SCALE)
         self.progress.setValue(0)
         self.progress.setFormat('准备发送...')
         self.progress.setVisible(True)
+        self.disable_send_buttons()
 
-        self.send_button.setEnabled(False)
-        self.test_button.setEnabled(False)
+        # 队列中可能有需要转换的书，转换器对其他书直接返回原路径
+        preparers = self.build_preparers(convert=True)
+        manifest = self.plugin_action.get_manifest()
+        if len(addresses) > 1:
+            return self.start_fanout(addresses, None, manifest, False, preparers, skip_sent=False)
+        self.start_send(addresses[0], None, transfer_queue.unfinished(addresses[0]),
+                        manifest, False, preparers)
+
+    def start_fanout(self, addresses, books, manifest, sync, preparers, skip_sent=None):
+        """把同时发送到多台设备的任务提交给传输服务，每台设备单独显示进度。"""
+        worker = FanoutWorker(
+            self.plugin_action, addresses, books,
+            manifest=manifest, sync=sync, preparers=preparers,
+            **self.batch_options(),
+            transfer_queue=self.plugin_action.get_queue(),
+            skip_sent=self.skip_sent.isChecked() if skip_sent is None else skip_sent)
+        action = '同步' if sync else ('继续发送' if books is None else '发送')
+        job = self.plugin_action.get_service().submit(
+            worker, f'{action}到 {len(addresses)} 台设备')
+        self.progress.setVisible(False)
+        for address in addresses:
+            bar = QProgressBar()
+            bar.setMaximum(PROGRESS_SCALE)
+            bar.setValue(0)
+            bar.setFormat(f'{address} 准备发送...')
+            self.device_layout.addWidget(bar)
+            self.device_bars[address] = bar
+        self.attach(job, [
+            (worker.device_bytes, self.on_device_bytes),
+            (worker.device_finished, self.on_device_finished),
+            (worker.finished, self.on_fanout_finished),
+        ])
+
+    def on_device_bytes(self, address, title, book_sent, book_total, batch_sent, batch_total, rate, eta):
+        """Update one device's progress bar."""
+        bar = self.device_bars.get(address)
+        if bar is None:
+            return
+        bar.setValue(int(PROGRESS_SCALE * batch_sent / batch_total) if batch_total else 0)
+        bar.setFormat(
+            f'{address} {title} | {format_size(batch_sent)}/{format_size(batch_total)} | '
+            f'{format_size(rate)}/s | 剩余 {format_eta(eta)}')
+
+    def on_device_finished(self, address, success_count, failed_books, skipped_count):
+        """Show a device's result on its bar while the others keep going."""
+        bar = self.device_bars.get(address)
+        if bar is None:
+            return
+        bar.setValue(PROGRESS_SCALE)
+        bar.setFormat(f'{address} 完成：成功 {success_count}，失败 {len(failed_books)}，跳过 {skipped_count}')
 
-        # 启动后台线程
-        self.send_thread = SendBooksWorker(self.plugin_action, books_to_send)
-        self.send_thread.progress.connect(self.on_send_progress)
-        self.send_thread.finished.connect(self.on_send_finished)
-        self.send_thread.start()
+    def on_fanout_finished(self, results):
+        """Handle completion of a multi-device send."""
+        worker = self.detach()
+        cancelled_books = worker.sender.cancelled_books if worker is not None else {}
+
+        any_success = False
+        any_failed = False
+        result_message = ''
+        for address, (success_count, failed_books, skipped_count) in results.items():
+            any_success = any_success or success_count > 0
+            any_failed = any_failed or bool(failed_books)
+            result_message += f'{address}: 成功 {success_count} 本'
+            if skipped_count:
+                result_message += f'，跳过 {skipped_count} 本'
+            if cancelled_books.get(address):
+                result_message += f'，已取消 {len(cancelled_books[address])} 本'
+            result_message += '\n'
+            for book, reason in failed_books:
+                result_message += f'- {book}: {reason}\n'
+
+        if any_success or not any_failed:
+            QMessageBox.information(self, '完成', result_message)
+        else:
+            QMessageBox.warning(self, '失败', result_message)
+
+
+    def show_cancelled(self, sent_titles, cancelled_titles, failed_books):
+        """Report which books were delivered before the send was cancelled."""
+        message = f'已取消发送。取消前成功发送 {len(sent_titles)} 本'
+        if cancelled_titles:
+            message += f'，{len(cancelled_titles)} 本未发送（已留在发送队列中，可稍后继续）'
+        message += '\n'
+        if sent_titles:
+            message += '\n已发送的书籍：\n' + ''.join(f'- {title}\n' for title in sent_titles)
+        if failed_books:
+            message += '\n发送失败的书籍：\n' + ''.join(
+                f'- {title}: {reason}\n' for title, reason in failed_books)
+        QMessageBox.information(self, '已取消', message)
+
+
+class TransferJobsDialog(QDialog):
+    """传输服务中的任务列表，不阻塞 calibre 主窗口，可以暂停、继续和取消任务。"""
+
+    COLUMNS = ('任务', '状态', '进度')
+
+    def __init__(self, gui, service):
+        QDialog.__init__(self, gui)
+        self.service = service
+        self.jobs = []
+        self.setWindowTitle('传输任务')
+        self.resize(600, 300)
+
+        layout = QVBoxLayout(self)
+        self.table = QTableWidget(0, len(self.COLUMNS))
+        self.table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.table.verticalHeader().setVisible(False)
+        self.table.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
+        self.table.setSelectionBehavior(QTableWidget.SelectionBehavior.SelectRows)
+        self.table.setSelectionMode(QTableWidget.SelectionMode.SingleSelection)
+        self.table.horizontalHeader().setSectionResizeMode(0, QHeaderView.ResizeMode.Stretch)
+        self.table.itemSelectionChanged.connect(self.update_buttons)
+        layout.addWidget(self.table)
+
+        button_box = QHBoxLayout()
+        button_box.addStretch()
+        self.pause_button = QPushButton('暂停')
+        self.pause_button.clicked.connect(self.toggle_pause)
+        button_box.addWidget(self.pause_button)
+        self.cancel_button = QPushButton('取消')
+        self.cancel_button.clicked.connect(self.cancel_job)
+        button_box.addWidget(self.cancel_button)
+        close_button = QPushButton('关闭')
+        close_button.clicked.connect(self.close)
+        button_box.addWidget(close_button)
+        layout.addLayout(button_box)
+
+        self.service.changed.connect(self.refresh)
+        self.refresh()
+
+    def selected_job(self):
+        rows = self.table.selectionModel().selectedRows()
+        if not rows or rows[0].row() >= len(self.jobs):
+            return None
+        return self.jobs[rows[0].row()]
+
+    def refresh(self):
+        # 进度每个分块都会变化，窗口隐藏时不更新
+        if not self.isVisible():
+            return
+        selected = self.selected_job()
+        self.jobs = list(self.service.jobs)
+        self.table.setRowCount(len(self.jobs))
+        for row_index, job in enumerate(self.jobs):
+            values = (job.title, job.state_label, job.status if job.active else job.summary)
+            for column, value in enumerate(values):
+                self.table.setItem(row_index, column, QTableWidgetItem(value))
+            if job is selected:
+                self.table.selectRow(row_index)
+        self.update_buttons()
+
+    def update_buttons(self):
+        job = self.selected_job()
+        running = job is not None and job.state == RUNNING
+        self.pause_button.setEnabled(running and not job.worker.control.cancelled)
+        self.pause_button.setText('继续' if running and job.worker.control.paused else '暂停')
+        self.cancel_button.setEnabled(
+            job is not None and job.active and not job.worker.control.cancelled)
+
+    def toggle_pause(self):
+        job = self.selected_job()
+        if job is None:
+            return
+        if job.worker.control.paused:
+            self.service.resume(job)
+        else:
+            self.service.pause(job)
+
+    def cancel_job(self):
+        job = self.selected_job()
+        if job is not None:
+            self.service.cancel(job)
+
+
+class TransferStatsDialog(QDialog):
+    """按设备和日期汇总的传输统计。"""
+
+    COLUMNS = ('日期', '设备', '次数', '失败率', '中位速率', '中位响应时间', '总量', '最慢的书')
+
+    def __init__(self, gui, plugin_action):
+        QDialog.__init__(self, gui)
+        self.plugin_action = plugin_action
+        self.setWindowTitle('传输统计')
+        self.resize(900, 400)
+
+        layout = QVBoxLayout(self)
+        self.table = QTableWidget(0, len(self.COLUMNS))
+        self.table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.table.verticalHeader().setVisible(False)
+        self.table.setEditTriggers(QTableWidget.EditTrigger.NoEditTriggers)
+        layout.addWidget(self.table)
+
+        self.summary = QLabel()
+        layout.addWidget(self.summary)
+
+        button_box = QHBoxLayout()
+        button_box.addStretch()
+        clear_button = QPushButton('清除记录')
+        clear_button.clicked.connect(self.clear_history)
+        button_box.addWidget(clear_button)
+        close_button = QPushButton('关闭')
+        close_button.clicked.connect(self.close)
+        button_box.addWidget(close_button)
+        layout.addLayout(button_box)
+
+        self.refresh()
+
+    def refresh(self):
+        from calibre_plugins.duokan_wifi_transfer.metrics import aggregate
+        records = self.plugin_action.get_metrics().load()
+        rows = aggregate(records)
+        self.table.setRowCount(len(rows))
+        for row_index, row in enumerate(rows):
+            median_mbps = row['median_mbps']
+            median_ttfb = row['median_ttfb']
+            values = (
+                row['day'],
+                row['device'],
+                str(row['count']),
+                f"{row['failure_rate']:.0%}",
+                f'{median_mbps:.2f} MB/s' if median_mbps is not None else '--',
+                f'{median_ttfb * 1000:.0f} ms' if median_ttfb is not None else '--',
+                format_size(row['bytes']),
+                '；'.join(f'{title} ({seconds:.1f}s)' for title, seconds in row['slowest']),
+            )
+            for column, value in enumerate(values):
+                self.table.setItem(row_index, column, QTableWidgetItem(value))
+        self.table.resizeColumnsToContents()
+        self.summary.setText(f'共 {len(records)} 条传输记录')
+
+    def clear_history(self):
+        if QMessageBox.question(self, '清除记录', '确定要清除所有传输记录吗？') != QMessageBox.StandardButton.Yes:
+            return
+        self.plugin_action.get_metrics().clear()
+        self.refresh()
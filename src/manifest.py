@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2024, Your Name'
+__docformat__ = 'restructuredtext en'
+
+import hashlib
+import json
+import os
+import threading
+
+MANIFEST_NAME = 'duokan_wifi_transfer_manifest.json'
+
+# cached_file_hash 的结果：(路径, 大小, mtime_ns) -> SHA-1，本会话内共享
+_hashes = {}
+_hashes_lock = threading.Lock()
+
+
+def file_hash(path, chunk_size=1024 * 1024):
+    """计算文件内容的 SHA-1。"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cached_file_hash(path):
+    """同 file_hash，路径、大小和 mtime 都未变化时不再读取文件。
+
+    精简和转换阶段都用它计算缓存键，同一本书每次发送只在文件变化后
+    重新计算。
+    """
+    st = os.stat(path)
+    key = (path, st.st_size, st.st_mtime_ns)
+    with _hashes_lock:
+        digest = _hashes.get(key)
+    if digest is None:
+        digest = file_hash(path)
+        with _hashes_lock:
+            _hashes[key] = digest
+    return digest
+
+
+def default_manifest_path():
+    from calibre.utils.config import config_dir
+    return os.path.join(config_dir, 'plugins', MANIFEST_NAME)
+
+
+class SentManifest(object):
+    """按设备地址记录已送达的书籍，再次发送时跳过内容未变化的书。
+
+    每条记录保存 book_id、EPUB 路径、大小、mtime 和内容哈希。路径、大小和
+    mtime 都一致时直接判定为未变化，不读取文件；只有大小不变而 mtime 变化
+    时才重新计算哈希。
+    """
+
+    def __init__(self, path=None):
+        self.path = path or default_manifest_path()
+        self._devices = {}
+        self._lock = threading.Lock()
+        # 多设备发送时各设备的批次分别在结束时保存，写盘需串行
+        self._save_lock = threading.Lock()
+        self._dirty = False
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                data = json.loads(f.read().decode('utf-8'))
+        except (OSError, ValueError):
+            data = {}
+        with self._lock:
+            self._devices = data.get('devices', {}) if isinstance(data, dict) else {}
+            self._dirty = False
+
+    def save(self):
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                raw = json.dumps({'devices': self._devices}, ensure_ascii=False).encode('utf-8')
+                self._dirty = False
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = self.path + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(raw)
+            os.replace(tmp, self.path)
+
+    def _entry(self, address, book_id):
+        return self._devices.get(address, {}).get(str(book_id))
+
+    def is_unchanged(self, address, book_id, path):
+        """该书是否已发送到此设备且内容未变化。"""
+        with self._lock:
+            entry = self._entry(address, book_id)
+        if not entry:
+            return False
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        if st.st_size != entry['size']:
+            return False
+        if path == entry['path'] and st.st_mtime_ns == entry['mtime']:
+            return True
+        # 大小相同但 mtime 或路径变化（例如仅写回了元数据），用哈希确认
+        try:
+            digest = file_hash(path)
+        except OSError:
+            return False
+        if digest != entry['hash']:
+            return False
+        with self._lock:
+            entry.update(path=path, mtime=st.st_mtime_ns)
+            self._dirty = True
+        return True
+
+    def record(self, address, book_id, path):
+        """记录一本已成功发送的书。"""
+        st = os.stat(path)
+        digest = file_hash(path)
+        with self._lock:
+            self._devices.setdefault(address, {})[str(book_id)] = {
+                'path': path,
+                'size': st.st_size,
+                'mtime': st.st_mtime_ns,
+                'hash': digest,
+            }
+            self._dirty = True
+
+    def forget(self, address, book_id):
+        with self._lock:
+            if self._devices.get(address, {}).pop(str(book_id), None) is not None:
+                self._dirty = True
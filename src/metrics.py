@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2024, Your Name'
+__docformat__ = 'restructuredtext en'
+
+# 传输耗时历史：每次上传追加一行 JSON（由 transfer.transfer_record() 生成），
+# 文件超过大小上限时丢弃最旧的一半。只依赖标准库，不导入 Qt。
+
+import json
+import os
+import threading
+import time
+
+HISTORY_NAME = 'duokan_wifi_transfer_history.jsonl'
+DEFAULT_HISTORY_BYTES = 1024 * 1024
+
+# 统计视图中每组列出的最慢书籍数量
+SLOWEST_BOOKS = 3
+
+
+def default_history_path():
+    from calibre.utils.config import config_dir
+    return os.path.join(config_dir, 'plugins', HISTORY_NAME)
+
+
+def median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+
+class MetricsHistory(object):
+    """按行追加的传输记录文件，总大小不超过 max_bytes。"""
+
+    def __init__(self, path=None, max_bytes=DEFAULT_HISTORY_BYTES):
+        self.path = path or default_history_path()
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._size = None
+
+    def append(self, record):
+        line = (json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8')
+        with self._lock:
+            if self._size is None:
+                try:
+                    self._size = os.path.getsize(self.path)
+                except OSError:
+                    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                    self._size = 0
+            with open(self.path, 'ab') as f:
+                f.write(line)
+            self._size += len(line)
+            if self._size > self.max_bytes:
+                self._truncate()
+
+    def _truncate(self):
+        """只保留最新的一半记录。"""
+        with open(self.path, 'rb') as f:
+            lines = f.read().splitlines(keepends=True)
+        kept = []
+        size = 0
+        for line in reversed(lines):
+            if size + len(line) > self.max_bytes // 2:
+                break
+            kept.append(line)
+            size += len(line)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.writelines(reversed(kept))
+        os.replace(tmp, self.path)
+        self._size = size
+
+    def load(self):
+        """读取所有记录，跳过损坏的行。"""
+        with self._lock:
+            try:
+                with open(self.path, 'rb') as f:
+                    raw = f.read()
+            except OSError:
+                return []
+        records = []
+        for line in raw.splitlines():
+            try:
+                record = json.loads(line.decode('utf-8'))
+            except ValueError:
+                continue
+            if isinstance(record, dict):
+                records.append(record)
+        return records
+
+    def clear(self):
+        with self._lock:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            self._size = 0
+
+
+def aggregate(records):
+    """按设备和日期汇总，返回按日期倒序排列的统计行（字典）。
+
+    每行包含 device、day、count、failures、failure_rate、median_mbps（成功
+    上传的中位速率，MB/s）、bytes、median_ttfb 和 slowest（[(书名, 秒)]）。
+    """
+    groups = {}
+    for record in records:
+        day = time.strftime('%Y-%m-%d', time.localtime(record.get('t', 0)))
+        groups.setdefault((record.get('dev') or '', day), []).append(record)
+
+    rows = []
+    for (device, day), items in groups.items():
+        ok = [r for r in items if r.get('status') == 200 and not r.get('error')]
+        rates = [r['bps'] / (1024 * 1024) for r in ok if r.get('bps')]
+        ttfbs = [r['ttfb'] for r in ok if r.get('ttfb') is not None]
+        slowest = sorted(ok, key=lambda r: r.get('total') or 0, reverse=True)[:SLOWEST_BOOKS]
+        rows.append({
+            'device': device,
+            'day': day,
+            'count': len(items),
+            'failures': len(items) - len(ok),
+            'failure_rate': (len(items) - len(ok)) / len(items),
+            'median_mbps': median(rates),
+            'median_ttfb': median(ttfbs),
+            'bytes': sum(r.get('bytes') or 0 for r in ok),
+            'slowest': [(r.get('title') or '', r.get('total') or 0) for r in slowest],
+        })
+    rows.sort(key=lambda row: (row['day'], row['device']), reverse=True)
+    return rows
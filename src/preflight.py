@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2024, Your Name'
+__docformat__ = 'restructuredtext en'
+
+# 发送前检查 EPUB 是否完整：zip 中央目录、mimetype、container.xml 和 OPF。
+# 只读取中央目录和这三个条目，不解压整本书；结论按路径、大小和 mtime
+# 缓存。本模块不导入 Qt。
+
+import json
+import os
+import posixpath
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+PREFLIGHT_NAME = 'duokan_wifi_transfer_preflight.json'
+EPUB_MIMETYPE = b'application/epub+zip'
+DEFAULT_PREFLIGHT_WORKERS = 4
+# 缓存条目上限，超过时丢弃最早写入的一半
+MAX_CACHE_ENTRIES = 20000
+
+
+def default_cache_path():
+    from calibre.utils.config import config_dir
+    return os.path.join(config_dir, 'plugins', PREFLIGHT_NAME)
+
+
+def check_epub(path):
+    """检查一个 EPUB 文件，完好时返回 None，否则返回问题描述。"""
+    from lxml import etree
+    try:
+        size = os.path.getsize(path)
+        with zipfile.ZipFile(path) as zf:
+            infos = zf.infolist()
+            # 中央目录记录的条目超出文件末尾说明文件被截断
+            for info in infos:
+                if info.header_offset + info.compress_size > size:
+                    return f'文件不完整：{info.filename} 超出文件末尾'
+            names = {info.filename for info in infos}
+            if 'mimetype' not in names:
+                return '缺少 mimetype'
+            if zf.read('mimetype').strip() != EPUB_MIMETYPE:
+                return 'mimetype 不是 application/epub+zip'
+            if 'META-INF/container.xml' not in names:
+                return '缺少 META-INF/container.xml'
+            try:
+                root = etree.fromstring(zf.read('META-INF/container.xml'))
+            except etree.XMLSyntaxError as e:
+                return f'container.xml 无法解析：{e}'
+            opf_path = None
+            for rootfile in root.iter('{*}rootfile'):
+                opf_path = rootfile.get('full-path')
+                if opf_path:
+                    break
+            if not opf_path:
+                return 'container.xml 中没有 OPF 路径'
+            opf_path = posixpath.normpath(opf_path)
+            if opf_path not in names:
+                return f'缺少 OPF 文件 {opf_path}'
+            try:
+                etree.fromstring(zf.read(opf_path))
+            except etree.XMLSyntaxError as e:
+                return f'OPF 无法解析：{e}'
+    except zipfile.BadZipFile as e:
+        return f'不是有效的 zip 文件：{e}'
+    except (zipfile.LargeZipFile, NotImplementedError, EOFError) as e:
+        return f'无法读取：{type(e).__name__}: {e}'
+    except (FileNotFoundError, PermissionError, IsADirectoryError) as e:
+        return f'无法读取：{e}'
+    except OSError as e:
+        # 中央目录指向文件之外等情况在 seek 时失败
+        return f'文件不完整：{e}'
+    except Exception as e:
+        # zlib.error 等解压错误
+        return f'条目已损坏：{type(e).__name__}: {e}'
+    return None
+
+
+class EpubPreflight(object):
+    """并发检查书单中的 EPUB，结论保存在 calibre 配置目录中。
+
+    缓存以路径为键，保存大小、mtime 和结论；文件未变化时不再打开。
+    """
+
+    def __init__(self, path=None, max_workers=DEFAULT_PREFLIGHT_WORKERS):
+        self.path = path or default_cache_path()
+        self.max_workers = max(1, int(max_workers))
+        self._verdicts = {}
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._dirty = False
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as f:
+                data = json.loads(f.read().decode('utf-8'))
+        except (OSError, ValueError):
+            data = {}
+        with self._lock:
+            self._verdicts = data if isinstance(data, dict) else {}
+            self._dirty = False
+
+    def save(self):
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                if len(self._verdicts) > MAX_CACHE_ENTRIES:
+                    keys = list(self._verdicts)
+                    for key in keys[:len(keys) // 2]:
+                        del self._verdicts[key]
+                raw = json.dumps(self._verdicts, ensure_ascii=False).encode('utf-8')
+                self._dirty = False
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = self.path + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(raw)
+            os.replace(tmp, self.path)
+
+    def verdict(self, path):
+        """返回缓存或新检查得到的结论（None 表示完好）。"""
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            return f'无法读取：{e}'
+        with self._lock:
+            cached = self._verdicts.get(path)
+        if cached and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+            return cached[2]
+        error = check_epub(path)
+        with self._lock:
+            self._verdicts[path] = [st.st_size, st.st_mtime_ns, error]
+            self._dirty = True
+        return error
+
+    def check_books(self, books):
+        """检查书单中的 EPUB，损坏的书写入 error 字段，返回损坏的数量。
+
+        需要转换的书（convert_from）和已带 error 的书不检查。
+        """
+        targets = [book for book in books if book.get('path') and not book.get('error')
+                   and not book.get('convert_from')]
+        if not targets:
+            return 0
+        bad = 0
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(targets))) as pool:
+            for book, error in zip(targets, pool.map(lambda b: self.verdict(b['path']), targets)):
+                if error:
+                    bad += 1
+                    book['error'] = f'EPUB 文件损坏：{error}'
+                    print(f"预检 {book['title']} 未通过: {error}")
+        return bad
+
+    def check_batches(self, batches, on_checked=None):
+        """逐批检查 iter_book_batches() 产出的书单并原样产出。
+
+        每批在交给发送引擎之前检查完毕，损坏的书作为失败条目直接汇报，不
+        占用上传带宽。on_checked(checked_count, bad_count) 在每批之后调用。
+        """
+        if isinstance(batches, list):
+            batches = [batches]
+        checked = bad = 0
+        try:
+            for books in batches:
+                bad += self.check_books(books)
+                checked += len(books)
+                if on_checked is not None:
+                    on_checked(checked, bad)
+                yield books
+        finally:
+            try:
+                self.save()
+            except OSError as e:
+                print(f"保存预检结果失败: {e}")
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2024, Your Name'
+__docformat__ = 'restructuredtext en'
+
+# 持久化的发送队列：记录每本书在每台设备上的发送状态，calibre 重启后可以
+# 继续发送剩余的书。只依赖标准库，不导入 Qt。
+
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+QUEUE_NAME = 'duokan_wifi_transfer_queue.sqlite'
+
+PENDING = 'pending'
+IN_FLIGHT = 'in_flight'
+DONE = 'done'
+FAILED = 'failed'
+
+# 自动重试：第 n 次失败后等待 RETRY_BASE_DELAY * 2 ** (n - 1) 秒，最多 RETRY_MAX_DELAY
+DEFAULT_MAX_ATTEMPTS = 4
+RETRY_BASE_DELAY = 5.0
+RETRY_MAX_DELAY = 120.0
+
+# 队列中保存的书籍字段，对应 collect_books() 产生的书单条目
+BOOK_FIELDS = ('book_id', 'title', 'path', 'filename', 'convert_from', 'opf')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS items (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    batch TEXT NOT NULL,
+    address TEXT NOT NULL,
+    book_id INTEGER,
+    title TEXT NOT NULL,
+    path TEXT NOT NULL,
+    filename TEXT,
+    convert_from TEXT,
+    opf BLOB,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL DEFAULT 0,
+    error TEXT,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS items_state ON items (address, state);
+'''
+
+
+def default_queue_path():
+    from calibre.utils.config import config_dir
+    return os.path.join(config_dir, 'plugins', QUEUE_NAME)
+
+
+def retry_delay(attempts, base=RETRY_BASE_DELAY, maximum=RETRY_MAX_DELAY):
+    """第 attempts 次失败后到下次重试的等待秒数。"""
+    return min(maximum, base * 2 ** max(0, attempts - 1))
+
+
+class TransferQueue(object):
+    """保存在 calibre 配置目录中的 SQLite 发送队列。
+
+    每条记录是一本书发往一个设备地址，状态为 pending（等待发送或等待重试）、
+    in_flight（正在上传）、done 或 failed（重试次数用尽）。状态变化立即提交，
+    calibre 异常退出时仍处于 in_flight 的记录在下次打开队列时恢复为 pending。
+    """
+
+    def __init__(self, path=None, max_attempts=DEFAULT_MAX_ATTEMPTS, base_delay=RETRY_BASE_DELAY):
+        self.path = path or default_queue_path()
+        self.max_attempts = max(1, int(max_attempts))
+        self.base_delay = base_delay
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.executescript(SCHEMA)
+            self._conn.execute(
+                'UPDATE items SET state=?, updated=? WHERE state=?', (PENDING, time.time(), IN_FLIGHT))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _execute(self, sql, args=()):
+        with self._lock:
+            return self._conn.execute(sql, args).fetchall()
+
+    def enqueue(self, address, books, batch=None):
+        """把书加入批次，返回批次 ID；batch 为空时新建批次。
+
+        books 中各条目会写入 queue_id。同一设备上尚未完成的同一本书由新记录
+        取代，避免重复发送。
+        """
+        batch = batch or uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN')
+            try:
+                for book in books:
+                    if book.get('book_id') is not None:
+                        self._conn.execute(
+                            'DELETE FROM items WHERE address=? AND book_id=? AND state!=?',
+                            (address, book['book_id'], DONE))
+                    cursor = self._conn.execute(
+                        'INSERT INTO items (batch, address, book_id, title, path, filename, '
+                        'convert_from, opf, state, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (batch, address, book.get('book_id'), book['title'], book['path'],
+                         book.get('filename'), book.get('convert_from'), book.get('opf'),
+                         PENDING, now))
+                    book['queue_id'] = cursor.lastrowid
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        return batch
+
+    def unfinished(self, address=None):
+        """尚未完成的记录数（pending、in_flight 和 failed），address 为空时统计所有设备。"""
+        sql = 'SELECT COUNT(*) FROM items WHERE state!=?'
+        args = [DONE]
+        if address is not None:
+            sql += ' AND address=?'
+            args.append(address)
+        return self._execute(sql, args)[0][0]
+
+    def addresses(self):
+        """有未完成记录的设备地址。"""
+        rows = self._execute(
+            'SELECT DISTINCT address FROM items WHERE state!=? ORDER BY address', (DONE,))
+        return [row[0] for row in rows]
+
+    def resume(self, address):
+        """把该设备上所有未完成的记录（含重试用尽的）重新置为立即发送。"""
+        self._execute(
+            'UPDATE items SET state=?, attempts=0, next_attempt=0, updated=? '
+            'WHERE address=? AND state!=?', (PENDING, time.time(), address, DONE))
+
+    def due(self, address, batch=None, now=None):
+        """返回到期可发送的书单，batch 为空时包含该设备的所有批次。"""
+        now = time.time() if now is None else now
+        sql = 'SELECT * FROM items WHERE address=? AND state=? AND next_attempt<=?'
+        args = [address, PENDING, now]
+        if batch is not None:
+            sql += ' AND batch=?'
+            args.append(batch)
+        books = []
+        for row in self._execute(sql + ' ORDER BY id', args):
+            book = {field: row[field] for field in BOOK_FIELDS if row[field] is not None}
+            book['queue_id'] = row['id']
+            books.append(book)
+        return books
+
+    def next_due(self, address, batch=None):
+        """最早一条等待重试记录的时间戳，没有时返回 None。"""
+        sql = 'SELECT MIN(next_attempt) FROM items WHERE address=? AND state=?'
+        args = [address, PENDING]
+        if batch is not None:
+            sql += ' AND batch=?'
+            args.append(batch)
+        return self._execute(sql, args)[0][0]
+
+    def mark_in_flight(self, queue_id):
+        self._execute('UPDATE items SET state=?, updated=? WHERE id=?',
+                      (IN_FLIGHT, time.time(), queue_id))
+
+    def mark_pending(self, queue_id):
+        """放回等待发送状态，不计为一次失败（如批次被取消）。"""
+        self._execute('UPDATE items SET state=?, updated=? WHERE id=?',
+                      (PENDING, time.time(), queue_id))
+
+    def mark_done(self, queue_id):
+        self._execute('UPDATE items SET state=?, error=NULL, updated=? WHERE id=?',
+                      (DONE, time.time(), queue_id))
+
+    def mark_failed(self, queue_id, error, retry=True):
+        """记录一次失败；还有重试次数时返回下次重试的等待秒数，否则返回 None。"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute('SELECT attempts FROM items WHERE id=?', (queue_id,)).fetchone()
+            attempts = (row[0] if row else 0) + 1
+            if retry and attempts < self.max_attempts:
+                delay = retry_delay(attempts, self.base_delay)
+                self._conn.execute(
+                    'UPDATE items SET state=?, attempts=?, next_attempt=?, error=?, updated=? '
+                    'WHERE id=?', (PENDING, attempts, now + delay, error, now, queue_id))
+                return delay
+            self._conn.execute(
+                'UPDATE items SET state=?, attempts=?, error=?, updated=? WHERE id=?',
+                (FAILED, attempts, error, now, queue_id))
+            return None
+
+    def failed(self, address, batch=None):
+        """返回 [(书名, 失败原因)]。"""
+        sql = 'SELECT title, error FROM items WHERE address=? AND state=?'
+        args = [address, FAILED]
+        if batch is not None:
+            sql += ' AND batch=?'
+            args.append(batch)
+        return [(row[0], row[1]) for row in self._execute(sql + ' ORDER BY id', args)]
+
+    def prune(self):
+        """删除已全部完成的批次。"""
+        self._execute(
+            'DELETE FROM items WHERE batch NOT IN '
+            '(SELECT DISTINCT batch FROM items WHERE state!=?)', (DONE,))
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2024, Your Name'
+__docformat__ = 'restructuredtext en'
+
+# 插件级的传输服务：对话框、菜单和自动发送提交的发送任务都在这里排队，
+# 一次只运行一个批次，关闭对话框后继续运行。
+
+import time
+
+try:
+    from qt.core import QObject, QTimer, pyqtSignal
+except ImportError:
+    from PyQt5.Qt import QObject, QTimer, pyqtSignal
+
+QUEUED = 'queued'
+RUNNING = 'running'
+FINISHED = 'finished'
+CANCELLED = 'cancelled'
+
+STATE_LABELS = {
+    QUEUED: '排队中',
+    RUNNING: '发送中',
+    FINISHED: '已完成',
+    CANCELLED: '已取消',
+}
+
+# 任务列表中保留的已结束任务数量
+MAX_FINISHED_JOBS = 20
+
+
+class TransferJob(object):
+    """一个发送任务：包装尚未启动的 SendBooksWorker 或 FanoutWorker。"""
+
+    def __init__(self, worker, title):
+        self.worker = worker
+        self.title = title
+        self.state = QUEUED
+        self.status = ''
+        self.summary = ''
+        self.started = False
+        self.created = time.time()
+
+    @property
+    def state_label(self):
+        if self.state == RUNNING and self.worker.control.paused:
+            return '已暂停'
+        return STATE_LABELS[self.state]
+
+    @property
+    def active(self):
+        return self.state in (QUEUED, RUNNING)
+
+
+class TransferService(QObject):
+    """按提交顺序逐个运行发送任务。
+
+    任务由插件（InterfacePlugin.get_service()）持有，与对话框的生命周期无关；
+    前一个任务结束后自动启动下一个，因此重复发送不会产生互相争抢的线程。
+    worker 的信号仍可由提交任务的对话框连接，用于显示详细进度。
+    """
+    changed = pyqtSignal()  # 任务列表或某个任务的状态变化
+    job_finished = pyqtSignal(object)  # TransferJob
+
+    def __init__(self, parent=None):
+        QObject.__init__(self, parent)
+        self.jobs = []
+
+    @property
+    def current(self):
+        for job in self.jobs:
+            if job.state == RUNNING:
+                return job
+        return None
+
+    @property
+    def busy(self):
+        return any(job.active for job in self.jobs)
+
+    def pending_ahead(self, job):
+        """排在 job 之前、尚未结束的任务数量。"""
+        count = 0
+        for other in self.jobs:
+            if other is job:
+                break
+            if other.active:
+                count += 1
+        return count
+
+    def submit(self, worker, title):
+        """加入任务队列并返回 TransferJob。
+
+        没有正在运行的任务时在下一次事件循环中启动，调用方可以在此之前连接
+        worker 的信号而不会漏掉任何进度；本服务的结束处理先于调用方的连接执行。
+        """
+        job = TransferJob(worker, title)
+        worker.finished.connect(lambda *args: self._on_finished(job, *args))
+        if hasattr(worker, 'device_bytes'):
+            worker.device_bytes.connect(
+                lambda address, title, book_sent, book_total, sent, total, rate, eta:
+                self._on_bytes(job, f'{address} {title}', sent, total))
+        else:
+            worker.bytes_progress.connect(
+                lambda title, book_sent, book_total, sent, total, rate, eta:
+                self._on_bytes(job, title, sent, total))
+        self.jobs.append(job)
+        QTimer.singleShot(0, self._start_next)
+        self.changed.emit()
+        return job
+
+    def _start_next(self):
+        if self.current is not None:
+            return
+        for job in self.jobs:
+            if job.state == QUEUED:
+                job.state = RUNNING
+                job.started = True
+                job.worker.start()
+                return
+
+    def _on_bytes(self, job, title, sent, total):
+        percent = int(100 * sent / total) if total else 0
+        job.status = f'{percent}% {title}'
+        self.changed.emit()
+
+    def _on_finished(self, job, *args):
+        job.state = CANCELLED if job.worker.control.cancelled else FINISHED
+        job.summary = job.worker.summarize(*args)
+        job.status = ''
+        self._prune()
+        self._start_next()
+        self.changed.emit()
+        self.job_finished.emit(job)
+
+    def _prune(self):
+        finished = [job for job in self.jobs if not job.active]
+        for job in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            self.jobs.remove(job)
+
+    def pause(self, job):
+        if job.state == RUNNING:
+            job.worker.pause()
+            self.changed.emit()
+
+    def resume(self, job):
+        if job.state == RUNNING:
+            job.worker.resume()
+            self.changed.emit()
+
+    def cancel(self, job):
+        """取消任务：排队中的直接移出队列，运行中的在当前分块之后停止。"""
+        if job.state == QUEUED:
+            job.state = CANCELLED
+            job.summary = '未开始'
+            self.changed.emit()
+            self.job_finished.emit(job)
+        elif job.state == RUNNING:
+            job.worker.cancel()
+            self.changed.emit()
+
+    def shutdown(self):
+        """calibre 退出时取消所有任务。
+
+        不在界面线程中等待正在运行的批次：取消会关闭它的 socket 并中止精简、
+        转换的工作进程，线程随即自行结束，未发送的书留在持久队列中。
+        """
+        for job in self.jobs:
+            if job.state == QUEUED:
+                job.state = CANCELLED
+        current = self.current
+        if current is not None:
+            current.worker.cancel()
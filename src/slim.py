@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2024, Your Name'
+__docformat__ = 'restructuredtext en'
+
+# 发送前精简 EPUB：重新压缩、缩小超大图片、可选去除内嵌字体。
+# slim_epub() 在 calibre 的工作进程中运行，本模块顶层不能导入 Qt。
+
+import hashlib
+import json
+import os
+import posixpath
+import threading
+import zipfile
+
+FONT_EXTENSIONS = ('.ttf', '.otf', '.woff', '.woff2')
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+DEFAULT_SLIM_OPTIONS = {
+    'max_image_size': 1600,  # 图片最长边（像素）
+    'jpeg_quality': 80,
+    'drop_fonts': False,
+}
+
+
+def _opf_path(zf):
+    from lxml import etree
+    root = etree.fromstring(zf.read('META-INF/container.xml'))
+    for rootfile in root.iter('{*}rootfile'):
+        path = rootfile.get('full-path')
+        if path:
+            return path
+    return None
+
+
+def _strip_font_items(opf_data, opf_path, dropped):
+    """从 OPF manifest 中删除指向已移除字体文件的条目。"""
+    from lxml import etree
+    root = etree.fromstring(opf_data)
+    base = posixpath.dirname(opf_path)
+    for item in list(root.iter('{*}item')):
+        href = item.get('href') or ''
+        if posixpath.normpath(posixpath.join(base, href)) in dropped:
+            item.getparent().remove(item)
+    return etree.tostring(root, xml_declaration=True, encoding='utf-8')
+
+
+def _shrink_image(data, max_size, quality):
+    """图片最长边超过 max_size 时按比例缩小，结果不比原图小则保留原图。"""
+    from calibre.utils.imghdr import identify
+    from calibre.utils.img import scale_image
+
+    fmt, width, height = identify(data)
+    if fmt not in ('jpeg', 'png') or max(width, height) <= max_size:
+        return data
+    w, h, scaled = scale_image(
+        data, width=max_size, height=max_size,
+        compression_quality=quality, as_png=(fmt == 'png'))
+    return scaled if len(scaled) < len(data) else data
+
+
+def slim_epub(src, dst, max_image_size=1600, jpeg_quality=80, drop_fonts=False):
+    """精简 src 并写入 dst，返回 (原大小, 新大小)。"""
+    with zipfile.ZipFile(src) as zin:
+        names = zin.namelist()
+        opf_path = None
+        dropped = set()
+        if drop_fonts:
+            dropped = {n for n in names if n.lower().endswith(FONT_EXTENSIONS)}
+            if dropped:
+                opf_path = _opf_path(zin)
+
+        with zipfile.ZipFile(dst, 'w', zipfile.ZIP_DEFLATED, compresslevel=9) as zout:
+            # mimetype 必须是第一个条目且不压缩
+            if 'mimetype' in names:
+                zout.writestr('mimetype', zin.read('mimetype'), compress_type=zipfile.ZIP_STORED)
+            for info in zin.infolist():
+                name = info.filename
+                if name == 'mimetype' or name in dropped or name.endswith('/'):
+                    continue
+                data = zin.read(name)
+                if name == opf_path:
+                    data = _strip_font_items(data, opf_path, dropped)
+                elif max_image_size and name.lower().endswith(IMAGE_EXTENSIONS):
+                    try:
+                        data = _shrink_image(data, max_image_size, jpeg_quality)
+                    except Exception as e:
+                        print(f"缩小图片 {name} 失败: {e}")
+                zout.writestr(name, data)
+    return os.path.getsize(src), os.path.getsize(dst)
+
+
+def slim_cache_key(content_hash, options):
+    raw = content_hash + json.dumps(options, sort_keys=True)
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+class EpubSlimmer(object):
+    """发送前的精简阶段。
+
+    每本书在 calibre 工作进程（fork_job）中精简，max_workers 个线程各自等待
+    一个工作进程，相当于一个进程池；结果按源文件内容哈希加设置缓存在磁盘上。
+    """
+
+    # 精简失败时可以退回上传未精简的文件
+    required = False
+
+    def __init__(self, options=None, max_workers=2, cache_bytes=2 * 1024 ** 3, cache=None):
+        from calibre_plugins.duokan_wifi_transfer.cache import OutputCache, plugin_cache_dir
+        self.options = dict(DEFAULT_SLIM_OPTIONS, **(options or {}))
+        self.max_workers = max_workers
+        self.cache = cache or OutputCache(plugin_cache_dir('slim'), cache_bytes)
+        self._no_gain = set()  # 精简后没有变小的缓存键
+        self._lock = threading.Lock()
+
+    def prepare(self, book, abort=None):
+        """返回精简后的文件路径，没有收益时返回原路径；失败时抛出异常。
+
+        abort 为 threading.Event，set() 后结束正在运行的工作进程。
+        """
+        from calibre.utils.ipc.simple_worker import fork_job
+        from calibre_plugins.duokan_wifi_transfer.manifest import cached_file_hash
+
+        src = book.get('upload_path') or book['path']
+        key = slim_cache_key(cached_file_hash(src), self.options)
+        with self.cache.lock_for(key):
+            if key in self._no_gain:
+                return src
+            cached = self.cache.get(key)
+            if cached:
+                return cached
+
+            tmp = self.cache.temp_path(key)
+            try:
+                result = fork_job(
+                    'calibre_plugins.duokan_wifi_transfer.slim', 'slim_epub',
+                    args=(src, tmp), kwargs=self.options, no_output=True, abort=abort)
+                old_size, new_size = result['result']
+                if new_size >= old_size:
+                    # 没有收益时上传原文件，并记住该键避免本会话内重复精简
+                    with self._lock:
+                        self._no_gain.add(key)
+                    return src
+                print(f"精简 {book['title']}: {old_size} -> {new_size} 字节")
+                return self.cache.put(key, tmp)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
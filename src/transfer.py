@@ -0,0 +1,965 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from __future__ import (unicode_literals, division, absolute_import, print_function)
+
+__license__ = 'GPL v3'
+__copyright__ = '2024, Your Name'
+__docformat__ = 'restructuredtext en'
+
+# 传输层：只依赖标准库，不导入 Qt 和 calibre.gui2，便于在后台线程中使用。
+
+import http.client
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import deque
+from urllib.parse import urlsplit
+
+from calibre_plugins.duokan_wifi_transfer.health import get_health
+
+USER_AGENT = 'Calibre Duokan Plugin/1.0'
+
+# 每次 sendfile / send 调用发送的字节数；os.sendfile 不可用时同时也是复用缓冲区的大小
+DEFAULT_CHUNK_SIZE = 512 * 1024
+
+# 操作系统是否提供零拷贝的 sendfile（Windows 上没有）
+HAS_SENDFILE = hasattr(os, 'sendfile')
+
+# 字节进度回调的最小间隔（秒），避免信号过多拖慢传输
+PROGRESS_INTERVAL = 0.1
+
+
+class ThroughputMeter(object):
+    """滑动时间窗口内的平均吞吐量（字节/秒）。"""
+
+    def __init__(self, window=5.0):
+        self.window = window
+        self._samples = deque()  # [(timestamp, nbytes)]
+        self._window_bytes = 0
+        self._started = None
+        self._lock = threading.Lock()
+
+    def start(self, now=None):
+        """从此刻开始计时；不调用时以第一个样本的时间为起点。"""
+        with self._lock:
+            self._started = time.monotonic() if now is None else now
+
+    def add(self, nbytes, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if self._started is None:
+                self._started = now
+            self._samples.append((now, nbytes))
+            self._window_bytes += nbytes
+            self._trim(now)
+
+    def _trim(self, now):
+        while self._samples and now - self._samples[0][0] > self.window:
+            self._window_bytes -= self._samples.popleft()[1]
+
+    def rate(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if self._started is None:
+                return 0.0
+            self._trim(now)
+            span = min(self.window, now - self._started)
+            return self._window_bytes / span if span > 0 else 0.0
+
+    def eta(self, remaining_bytes, now=None):
+        """按当前速率估算剩余秒数，速率未知时返回 -1。"""
+        rate = self.rate(now)
+        return remaining_bytes / rate if rate > 0 else -1.0
+
+
+class BatchProgress(object):
+    """汇总整个批次的字节进度，并按时间节流地调用 callback。
+
+    callback(title, book_sent, book_total, batch_sent, batch_total, rate, eta)
+    在上传线程中调用；多本书并发上传时 title 为触发本次汇报的那本书。
+    """
+
+    def __init__(self, total_bytes, callback, interval=PROGRESS_INTERVAL):
+        self.total_bytes = total_bytes
+        self.callback = callback
+        self.interval = interval
+        self.meter = ThroughputMeter()
+        self.meter.start()
+        self.sent_bytes = 0
+        self._last_report = 0.0
+        self._lock = threading.Lock()
+
+    def tracker(self, title, book_total):
+        """返回单本书的进度回调 on_progress(delta)。"""
+        state = {'sent': 0}
+
+        def on_progress(delta):
+            state['sent'] += delta
+            self._advance(title, state['sent'], book_total, delta)
+
+        on_progress.state = state
+        return on_progress
+
+    def adjust_total(self, delta):
+        """批次中某本书的实际上传大小改变时（如精简后）修正总字节数。"""
+        with self._lock:
+            self.total_bytes += delta
+
+    def book_done(self, on_progress, title, book_total):
+        """一本书结束（无论成败），把未发送的部分计为已处理并立即汇报。"""
+        delta = book_total - on_progress.state['sent']
+        on_progress.state['sent'] = book_total
+        with self._lock:
+            self.sent_bytes += delta
+        self._report(title, book_total, book_total, force=True)
+
+    def _advance(self, title, book_sent, book_total, delta):
+        with self._lock:
+            self.sent_bytes += delta
+        if delta > 0:
+            self.meter.add(delta)
+        self._report(title, book_sent, book_total)
+
+    def _report(self, title, book_sent, book_total, force=False):
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._last_report < self.interval:
+                return
+            self._last_report = now
+            batch_sent = self.sent_bytes
+        remaining = max(self.total_bytes - batch_sent, 0)
+        self.callback(title, book_sent, book_total, batch_sent, self.total_bytes,
+                      self.meter.rate(now), self.meter.eta(remaining, now))
+
+
+# 限速时每次发送约 LIMITED_CHUNK_SECONDS 秒的数据，使速率平稳而等待次数不多
+LIMITED_CHUNK_SECONDS = 0.1
+MIN_LIMITED_CHUNK = 16 * 1024
+# 令牌桶最多积攒的时长（秒），空闲后恢复发送时的突发量
+BURST_SECONDS = 0.25
+# 按时段限速时重新计算速率的间隔（秒）
+RATE_REFRESH_INTERVAL = 1.0
+
+
+def _parse_clock(value):
+    hours, minutes = value.strip().split(':')
+    return int(hours) * 60 + int(minutes)
+
+
+class RateSchedule(object):
+    """按一天中的时段决定上传速率上限。
+
+    rules 为 [(开始 "HH:MM", 结束 "HH:MM", MB/s)]，结束早于开始表示跨越午夜；
+    不在任何时段内时使用 default_mbps。调用时返回字节/秒，0 表示不限速。
+    """
+
+    def __init__(self, default_mbps=0, rules=()):
+        self.default = float(default_mbps or 0) * 1024 * 1024
+        self.rules = []
+        for start, end, mbps in rules:
+            self.rules.append((_parse_clock(start), _parse_clock(end), float(mbps) * 1024 * 1024))
+
+    def __call__(self, now=None):
+        local = time.localtime(now)
+        minute = local.tm_hour * 60 + local.tm_min
+        for start, end, rate in self.rules:
+            if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+                return rate
+        return self.default
+
+    def __eq__(self, other):
+        return isinstance(other, RateSchedule) and (self.default, self.rules) == (other.default, other.rules)
+
+    def __ne__(self, other):
+        return not self == other
+
+
+class TokenBucket(object):
+    """上传限速用的令牌桶，同一设备的所有并发上传共用一个。
+
+    consume(n) 预先扣除 n 个令牌，不足时按欠额休眠一次；令牌可以为负，
+    多个线程同时发送时等待时间自然排开，长期平均速率精确等于上限。
+    rate 为字节/秒或返回字节/秒的可调用对象（如 RateSchedule），0 表示不限速。
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._current = 0.0
+        self._checked = None
+        self._tokens = 0.0
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _rate(self, now):
+        if not callable(self.rate):
+            return self.rate
+        if self._checked is None or now - self._checked >= RATE_REFRESH_INTERVAL:
+            self._current = self.rate()
+            self._checked = now
+        return self._current
+
+    def set_rate(self, rate):
+        with self._lock:
+            self.rate = rate
+            self._checked = None
+
+    def current_rate(self):
+        with self._lock:
+            return self._rate(time.monotonic())
+
+    def chunk_size(self, default):
+        """限速时把每次发送的数据量缩小到约 LIMITED_CHUNK_SECONDS 秒。"""
+        rate = self.current_rate()
+        if not rate:
+            return default
+        return max(MIN_LIMITED_CHUNK, min(default, int(rate * LIMITED_CHUNK_SECONDS)))
+
+    def consume(self, nbytes):
+        now = time.monotonic()
+        with self._lock:
+            rate = self._rate(now)
+            if not rate:
+                self._tokens = 0.0
+                self._last = now
+                return
+            self._tokens = min(rate * BURST_SECONDS, self._tokens + (now - self._last) * rate)
+            self._last = now
+            self._tokens -= nbytes
+            wait = -self._tokens / rate if self._tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(address, rate):
+    """返回该设备地址共享的令牌桶；rate 变化时更新，为 0 时返回 None。"""
+    if not rate:
+        with _limiters_lock:
+            limiter = _limiters.pop(address, None)
+        if limiter is not None:
+            # 正在进行的上传仍持有该令牌桶，置为不限速
+            limiter.set_rate(0)
+        return None
+    with _limiters_lock:
+        limiter = _limiters.get(address)
+        if limiter is None:
+            limiter = _limiters[address] = TokenBucket(rate)
+        elif limiter.rate != rate:
+            limiter.set_rate(rate)
+        return limiter
+
+
+# 连接空闲超过该时间后不再复用，手机端服务通常会更早地关闭空闲连接
+IDLE_TIMEOUT = 15
+
+# 复用连接时出现这些错误，说明服务端已经关闭了连接，可以换新连接重试一次
+_STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.CannotSendRequest,
+    ConnectionResetError,
+    ConnectionAbortedError,
+    BrokenPipeError,
+)
+
+
+class TeeFile(object):
+    """把同一个文件的分块分发给发往多台设备的上传流，文件只从磁盘读一次。
+
+    分块按顺序读取并保留在内存中，直到所有仍在跟随的设备都发送过为止；
+    内存中最多保留 window 个分块。领先的设备需要新分块而窗口已满时，最慢
+    的设备被移出共享（detach），之后自行从文件中读取剩余部分，因此一台慢
+    设备或离线设备不会拖住其他设备。
+
+    consumers 为预期会读取该文件的设备，创建时即登记在第 0 块，因此领先的
+    设备不会在其他设备取第一个分块之前就把分块丢弃。
+    """
+
+    def __init__(self, path, chunk_size=DEFAULT_CHUNK_SIZE, window=32, consumers=()):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.window = window
+        self._file = None
+        self._next_read = 0
+        self._chunks = {}  # index -> bytes
+        self._positions = dict.fromkeys(consumers, 0)  # consumer -> 下一个要取的分块序号
+        self._detached = set()
+        self._lock = threading.Lock()
+
+    def chunk(self, consumer, index):
+        """返回第 index 个分块；返回 None 表示该设备需改为自行读取文件。"""
+        with self._lock:
+            if consumer in self._detached:
+                return None
+            if index not in self._chunks:
+                if index != self._next_read:
+                    # 所需分块已被丢弃（例如加入太晚或换连接重发）
+                    self._detach(consumer)
+                    return None
+                while len(self._chunks) >= self.window and self._detach_slowest(consumer):
+                    pass
+                if self._file is None:
+                    self._file = open(self.path, 'rb')
+                self._file.seek(index * self.chunk_size)
+                self._chunks[index] = self._file.read(self.chunk_size)
+                self._next_read += 1
+            data = self._chunks[index]
+            self._positions[consumer] = index + 1
+            self._trim()
+            return data
+
+    def done(self, consumer):
+        """该设备不再需要分块（发送完成或失败）。"""
+        with self._lock:
+            self._positions.pop(consumer, None)
+            self._detached.discard(consumer)
+            self._trim()
+
+    def waiting(self):
+        """是否还有仍在跟随的设备。"""
+        with self._lock:
+            return bool(self._positions)
+
+    def cached(self):
+        """内存中保留的分块数。"""
+        with self._lock:
+            return len(self._chunks)
+
+    def close(self):
+        with self._lock:
+            self._chunks.clear()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _detach(self, consumer):
+        self._positions.pop(consumer, None)
+        self._detached.add(consumer)
+        self._trim()
+
+    def _detach_slowest(self, current):
+        others = [(pos, c) for c, pos in self._positions.items() if c != current]
+        if not others:
+            return False
+        self._detach(min(others)[1])
+        return True
+
+    def _trim(self):
+        low = min(self._positions.values()) if self._positions else self._next_read
+        for index in [i for i in self._chunks if i < low]:
+            del self._chunks[index]
+
+
+class TeeRegistry(object):
+    """按文件路径共享 TeeFile。
+
+    consumers 为参与发送的全部设备。某本书已没有设备在读、但还有设备没有
+    取过它时，先保留该 TeeFile 等落后的设备赶上；这样保留的分块合计不超过
+    window 个，超出时关闭最早的，落后的设备随后自行读取文件。
+    """
+
+    def __init__(self, chunk_size=DEFAULT_CHUNK_SIZE, window=32, consumers=()):
+        self.chunk_size = chunk_size
+        self.window = window
+        self.consumers = tuple(consumers)
+        self._tees = {}  # path -> [TeeFile, 尚未释放的设备集合, 正在读取的设备数]
+        self._idle = []  # 没有设备在读、仍在等待其他设备的路径，按先后顺序
+        self._lock = threading.Lock()
+
+    def acquire(self, path, consumer):
+        with self._lock:
+            entry = self._tees.get(path)
+            if entry is None:
+                consumers = set(self.consumers)
+                consumers.add(consumer)
+                tee = TeeFile(path, self.chunk_size, self.window, consumers=consumers)
+                entry = self._tees[path] = [tee, consumers, 0]
+            elif path in self._idle:
+                self._idle.remove(path)
+            entry[2] += 1
+            return entry[0]
+
+    def release(self, path, consumer):
+        with self._lock:
+            entry = self._tees.get(path)
+            if entry is None:
+                return
+            entry[0].done(consumer)
+            entry[1].discard(consumer)
+            entry[2] -= 1
+            closing = self._settle(path, entry)
+        for tee in closing:
+            tee.close()
+
+    def forget(self, consumer):
+        """该设备不会再取任何文件（其批次已结束），不再为它保留分块。"""
+        closing = []
+        with self._lock:
+            for path, entry in list(self._tees.items()):
+                if consumer in entry[1]:
+                    entry[0].done(consumer)
+                    entry[1].discard(consumer)
+                    closing.extend(self._settle(path, entry))
+        for tee in closing:
+            tee.close()
+
+    def _settle(self, path, entry):
+        """在锁内调用，返回需要关闭的 TeeFile。"""
+        if entry[2] > 0:
+            return []
+        if not entry[1]:
+            del self._tees[path]
+            if path in self._idle:
+                self._idle.remove(path)
+            return [entry[0]]
+        if not entry[0].waiting():
+            # 尚未取过的设备都已被移出共享，不必再保留
+            del self._tees[path]
+            if path in self._idle:
+                self._idle.remove(path)
+            return [entry[0]]
+        if path not in self._idle:
+            self._idle.append(path)
+        closing = []
+        while sum(self._tees[p][0].cached() for p in self._idle) > self.window:
+            closing.append(self._tees.pop(self._idle.pop(0))[0])
+        return closing
+
+    def close(self):
+        with self._lock:
+            tees, self._tees, self._idle = self._tees, {}, []
+        for tee, _, _ in tees.values():
+            tee.close()
+
+
+# 被取消的书的结果说明
+CANCELLED_MESSAGE = '已取消'
+
+
+class TransferCancelled(Exception):
+    """上传被 TransferControl.cancel() 取消。"""
+
+
+class TransferTimeout(TimeoutError):
+    """整本书的上传超过了按大小计算的传输时限（send_book 的 deadline）。"""
+
+
+class TransferControl(object):
+    """一个批次的暂停、继续和取消，在每个分块发送之前生效。
+
+    checkpoint() 在暂停时阻塞到继续或取消，已取消时抛出 TransferCancelled。
+    正在使用的 socket 通过 attach() 登记，cancel() 会立即关闭它们的读写，
+    使阻塞在发送或等待响应中的请求马上失败。cancel() 同时 set() abort_event，
+    作为 fork_job 的 abort 参数传给发送前处理阶段，结束正在运行的工作进程。
+    """
+
+    def __init__(self):
+        self._running = threading.Event()
+        self._running.set()
+        self.cancelled = False
+        self.abort_event = threading.Event()
+        self._sockets = set()
+        self._lock = threading.Lock()
+
+    @property
+    def paused(self):
+        return not self._running.is_set()
+
+    def pause(self):
+        self._running.clear()
+
+    def resume(self):
+        self._running.set()
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            sockets = list(self._sockets)
+        self.abort_event.set()
+        self._running.set()
+        for sock in sockets:
+            _shutdown(sock)
+
+    def checkpoint(self):
+        self._running.wait()
+        if self.cancelled:
+            raise TransferCancelled()
+
+    def attach(self, sock):
+        with self._lock:
+            if not self.cancelled:
+                self._sockets.add(sock)
+                return
+        _shutdown(sock)
+
+    def detach(self, sock):
+        with self._lock:
+            self._sockets.discard(sock)
+
+
+def _shutdown(sock):
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+class MultipartFile(object):
+    """multipart/form-data 请求体：前导和结尾直接写入 socket，文件内容用
+    sendfile 零拷贝发送；没有 sendfile 时退回到基于 memoryview 的分块循环，
+    始终复用同一块缓冲区，不为每个分块分配新的字节串。
+    """
+
+    def __init__(self, path, field='newfile', content_type='application/epub+zip',
+                 chunk_size=DEFAULT_CHUNK_SIZE, send_buffer=None, use_sendfile=HAS_SENDFILE,
+                 on_progress=None, filename=None, tee=None, consumer=None, limiter=None,
+                 control=None, deadline=None):
+        self.path = path
+        # 限速时每个分块发送前向共享的 TokenBucket 申请令牌
+        self.limiter = limiter
+        # 每个分块发送前检查暂停和取消（TransferControl）
+        self.control = control
+        # 整本书的截止时刻（time.monotonic()），每个分块发送前检查
+        self.deadline = deadline
+        # 多设备同时发送时，文件内容从共享的 TeeFile 中获取，consumer 标识本设备
+        self.tee = tee
+        self.consumer = consumer
+        # on_progress(delta) 在每个分块发送后调用，delta 为新发送的文件字节数
+        self.on_progress = on_progress
+        self.sent = 0
+        self.chunk_size = chunk_size
+        self.send_buffer = send_buffer
+        self.use_sendfile = use_sendfile
+        self.boundary = str(uuid.uuid4())
+        # 上传精简或转换后的文件时，filename 保持设备上看到的原文件名
+        filename = filename or os.path.basename(path)
+        self.head = (
+            f'--{self.boundary}\r\n'
+            f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+            f'Content-Type: {content_type}\r\n'
+            '\r\n'
+        ).encode()
+        self.tail = f'\r\n--{self.boundary}--\r\n'.encode()
+        self.file_size = os.path.getsize(path)
+
+    @property
+    def content_length(self):
+        return len(self.head) + self.file_size + len(self.tail)
+
+    @property
+    def headers(self):
+        return {
+            'Content-Type': f'multipart/form-data; boundary={self.boundary}',
+            'Content-Length': str(self.content_length),
+        }
+
+    def send_to(self, sock):
+        """把完整的请求体写入已连接的 socket。"""
+        if self.send_buffer:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer)
+        if self.sent:
+            # 换新连接重发时撤销上一次尝试汇报的进度
+            self._advance(-self.sent)
+        chunk_size = self.chunk_size
+        if self.limiter is not None:
+            chunk_size = self.limiter.chunk_size(chunk_size)
+        sock.sendall(self.head)
+        offset = self._send_tee(sock) if self.tee is not None else 0
+        if offset < self.file_size:
+            with open(self.path, 'rb') as f:
+                if self.use_sendfile:
+                    self._sendfile(sock, f, offset, chunk_size)
+                else:
+                    self._send_chunks(sock, f, offset, chunk_size)
+        sock.sendall(self.tail)
+
+    def _send_tee(self, sock):
+        """从共享分块发送，返回已发送的字节数；被移出共享时由调用方接着读文件。"""
+        offset = 0
+        index = 0
+        while offset < self.file_size:
+            data = self.tee.chunk(self.consumer, index)
+            if data is None:
+                break
+            if not data:
+                raise EOFError(f'文件在发送过程中被截断: {self.path}')
+            self._checkpoint()
+            if self.limiter is not None:
+                self.limiter.consume(len(data))
+            sock.sendall(data)
+            offset += len(data)
+            index += 1
+            self._advance(len(data))
+        return offset
+
+    def _sendfile(self, sock, f, offset=0, chunk_size=None):
+        chunk_size = chunk_size or self.chunk_size
+        while offset < self.file_size:
+            count = min(chunk_size, self.file_size - offset)
+            self._checkpoint()
+            if self.limiter is not None:
+                self.limiter.consume(count)
+            sent = sock.sendfile(f, offset, count)
+            if not sent:
+                raise EOFError(f'文件在发送过程中被截断: {self.path}')
+            offset += sent
+            self._advance(sent)
+
+    def _send_chunks(self, sock, f, offset=0, chunk_size=None):
+        chunk_size = chunk_size or self.chunk_size
+        buf = bytearray(chunk_size)
+        view = memoryview(buf)
+        f.seek(offset)
+        remaining = self.file_size - offset
+        while remaining > 0:
+            n = f.readinto(view[:min(chunk_size, remaining)])
+            if not n:
+                raise EOFError(f'文件在发送过程中被截断: {self.path}')
+            self._checkpoint()
+            if self.limiter is not None:
+                self.limiter.consume(n)
+            sock.sendall(view[:n])
+            remaining -= n
+            self._advance(n)
+
+    def _checkpoint(self):
+        if self.control is not None:
+            self.control.checkpoint()
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise TransferTimeout('超过本书的传输时限')
+
+    def _advance(self, delta):
+        self.sent += delta
+        if self.on_progress is not None:
+            self.on_progress(delta)
+
+
+class DeviceConnectionPool(object):
+    """到单个设备地址的持久 HTTP 连接池，整个批次共用，减少 TCP 握手。"""
+
+    def __init__(self, address, max_idle=4, blocksize=64 * 1024):
+        parts = urlsplit(address if '://' in address else 'http://' + address)
+        self.address = address
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.base_path = parts.path.rstrip('/')
+        self.max_idle = max_idle
+        self.blocksize = blocksize
+        self._idle = []  # [(connection, last_used)]
+        self._lock = threading.Lock()
+
+    def url_path(self, path):
+        return self.base_path + path
+
+    def _new_connection(self, timeout):
+        return http.client.HTTPConnection(
+            self.host, self.port, timeout=timeout, blocksize=self.blocksize)
+
+    def acquire(self, timeout):
+        """取出一个空闲连接，没有则新建；返回 (connection, reused)。"""
+        now = time.monotonic()
+        with self._lock:
+            while self._idle:
+                conn, last_used = self._idle.pop()
+                if now - last_used < IDLE_TIMEOUT and conn.sock is not None:
+                    conn.timeout = timeout
+                    conn.sock.settimeout(timeout)
+                    return conn, True
+                conn.close()
+        return self._new_connection(timeout), False
+
+    def release(self, conn, reusable=True):
+        if reusable and conn.sock is not None:
+            with self._lock:
+                if len(self._idle) < self.max_idle:
+                    self._idle.append((conn, time.monotonic()))
+                    return
+        conn.close()
+
+    def request(self, method, path, body=None, headers=None, timeout=30, timing=None, control=None,
+                deadline=None):
+        """发送请求并读取完整响应，返回 (status, reason, headers, data)。
+
+        body 可以是字节串、带 send_to(sock) 方法的对象（如 MultipartFile），
+        也可以是返回新文件对象的可调用对象；后两者使得复用的连接被服务端
+        关闭时能重新发送请求体并透明地重试。timing 为字典时写入各阶段耗时
+        （秒）：connect（复用连接时为 0）、upload（发送请求）、ttfb（请求发完到
+        收到响应头）以及 reused。control 为 TransferControl 时，取消会关闭
+        正在使用的连接，请求随即以 TransferCancelled 结束。
+
+        timeout 是连接和每次阻塞读写的超时；deadline（time.monotonic() 时刻）
+        限制整个请求，等待响应时超过截止时刻抛出 TransferTimeout。
+        """
+        headers = dict(headers or {})
+        headers.setdefault('User-Agent', USER_AGENT)
+        timing = {} if timing is None else timing
+
+        attempts = 0
+        while True:
+            attempts += 1
+            if control is not None:
+                control.checkpoint()
+            started = time.monotonic()
+            conn, reused = self.acquire(timeout)
+            stream = body() if callable(body) else body
+            sock = None
+            try:
+                if not reused:
+                    conn.connect()
+                connected = time.monotonic()
+                if control is not None:
+                    sock = conn.sock
+                    control.attach(sock)
+                if hasattr(stream, 'send_to'):
+                    conn.putrequest(method, self.url_path(path), skip_accept_encoding=True)
+                    for name, value in headers.items():
+                        conn.putheader(name, value)
+                    conn.endheaders()
+                    stream.send_to(conn.sock)
+                else:
+                    conn.request(method, self.url_path(path), body=stream, headers=headers)
+                sent = time.monotonic()
+                if deadline is not None:
+                    remaining = deadline - sent
+                    if remaining <= 0:
+                        raise TransferTimeout('超过本书的传输时限')
+                    conn.sock.settimeout(min(timeout, remaining))
+                try:
+                    response = conn.getresponse()
+                except socket.timeout:
+                    if deadline is not None and time.monotonic() >= deadline:
+                        raise TransferTimeout('超过本书的传输时限') from None
+                    raise
+                timing.update(connect=connected - started, upload=sent - connected,
+                              ttfb=time.monotonic() - sent, reused=reused)
+                data = response.read()
+            except _STALE_CONNECTION_ERRORS:
+                conn.close()
+                if reused and attempts == 1:
+                    continue
+                raise
+            except BaseException:
+                conn.close()
+                raise
+            finally:
+                if sock is not None:
+                    control.detach(sock)
+                if stream is not body and hasattr(stream, 'close'):  # 由工厂创建的流用完即关
+                    stream.close()
+            self.release(conn, not response.will_close)
+            return response.status, response.reason, response.msg, data
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            conn.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(address):
+    """返回该设备地址共享的连接池。"""
+    with _pools_lock:
+        pool = _pools.get(address)
+        if pool is None:
+            pool = _pools[address] = DeviceConnectionPool(address)
+        return pool
+
+
+def close_pool(address):
+    with _pools_lock:
+        pool = _pools.pop(address, None)
+    if pool is not None:
+        pool.close()
+
+
+def _parse_size(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return int(value)
+    if isinstance(value, str) and value.strip().isdigit():
+        return int(value.strip())
+    return None
+
+
+def parse_file_listing(data):
+    """解析设备返回的文件列表，返回 {文件名: 字节数或 None}。
+
+    多看 WiFi 服务返回 JSON 数组，不同版本的字段名略有差异，这里逐个尝试。
+    """
+    import json
+
+    listing = json.loads(data.decode('utf-8', errors='replace'))
+    if isinstance(listing, dict):
+        listing = listing.get('files') or listing.get('data') or []
+    files = {}
+    for item in listing:
+        if isinstance(item, str):
+            files[item] = None
+            continue
+        if not isinstance(item, dict):
+            continue
+        name = item.get('name') or item.get('fileName') or item.get('filename')
+        if not name:
+            continue
+        size = None
+        for key in ('size', 'fileSize', 'length'):
+            if key in item:
+                size = _parse_size(item[key])
+                break
+        files[name] = size
+    return files
+
+
+def fetch_device_files(address, timeout=10):
+    """GET {address}/files，获取设备上已有的书籍文件。"""
+    status, reason, headers, data = get_pool(address).request('GET', '/files', timeout=timeout)
+    if status != 200:
+        raise http.client.HTTPException(f'HTTP状态码: {status}')
+    return parse_file_listing(data)
+
+
+def needs_upload(device_files, filename, size):
+    """设备上没有同名文件，或两边大小都已知且不一致时需要上传。"""
+    if filename not in device_files:
+        return True
+    remote_size = device_files[filename]
+    return remote_size is not None and size is not None and remote_size != size
+
+
+def transfer_record(address, title, nbytes, elapsed, timing, status=None, error=None):
+    """一次上传的结构化记录，供 metrics.MetricsHistory 保存。"""
+    upload = timing.get('upload')
+    # 速率按发送请求到收到响应头计算，包含手机端接收最后一批数据的时间
+    transfer_time = upload + timing['ttfb'] if upload is not None else None
+    return {
+        't': round(time.time(), 3),
+        'dev': address,
+        'title': title,
+        'bytes': nbytes,
+        'connect': round(timing['connect'], 4) if 'connect' in timing else None,
+        'ttfb': round(timing['ttfb'], 4) if 'ttfb' in timing else None,
+        'upload': round(upload, 4) if upload is not None else None,
+        'total': round(elapsed, 4),
+        'bps': round(nbytes / transfer_time) if transfer_time else None,
+        'status': status,
+        'error': error,
+        'reused': timing.get('reused'),
+    }
+
+
+def send_book(epub_path, title, address, on_progress=None, filename=None,
+              chunk_size=DEFAULT_CHUNK_SIZE, send_buffer=None, timeout=30, tee=None, on_record=None,
+              limiter=None, control=None, deadline=None):
+    """把一本书 POST 到 {address}/files，返回 (是否成功, 错误信息或 None)。
+
+    对话框和命令行共用的上传入口。on_progress(delta) 在每个分块
+    发出后以新发送的字节数调用；filename 为设备上保存的文件名，默认取
+    epub_path 的文件名；tee 为多设备发送时共享的 TeeFile；on_record(record)
+    在结束时以 transfer_record() 生成的耗时记录调用，成功和失败都会调用；
+    limiter 为该设备共享的 TokenBucket，不为空时按其速率上限发送。连接的
+    成败记入该设备的 health.DeviceHealth。control 为批次的 TransferControl，
+    暂停和取消在下一个分块之前生效，取消时返回 (False, CANCELLED_MESSAGE)。
+    timeout 为连接和每次读写的超时；deadline 为整本书的传输时限（秒），批量
+    发送时按书的大小和实测速率计算，超过时返回传输超时。
+    """
+    started = time.monotonic()
+    deadline_at = started + deadline if deadline else None
+    timing = {}
+    nbytes = 0
+    status = None
+    error_class = None
+    try:
+        print(f"正在发送书籍: {title} -> {address}/files ({epub_path})")
+
+        # 前导/结尾直接写入 socket，书籍内容用 sendfile 零拷贝发送
+        body = MultipartFile(
+            epub_path,
+            chunk_size=chunk_size,
+            send_buffer=send_buffer,
+            on_progress=on_progress,
+            filename=filename,
+            tee=tee,
+            consumer=address,
+            limiter=limiter,
+            control=control,
+            deadline=deadline_at
+        )
+        nbytes = body.file_size
+
+        # 复用到该设备的持久连接；服务端断开时连接池会重新发送请求体并重试
+        status, reason, response_headers, raw_content = get_pool(address).request(
+            'POST', '/files',
+            body=body,
+            headers=body.headers,
+            timeout=timeout,
+            timing=timing,
+            control=control,
+            deadline=deadline_at
+        )
+        # 收到任何响应都说明设备在线
+        get_health(address).record_success()
+
+        if status == 200:
+            return True, None
+
+        # 只在失败时输出（截断的）响应内容
+        encoding = response_headers.get_content_charset() or 'utf-8'
+        try:
+            response_content = raw_content.decode(encoding)
+        except UnicodeDecodeError:
+            response_content = raw_content.decode('utf-8', errors='replace')
+        print(f"发送书籍 {title} 失败，响应状态码: {status}，响应内容: {response_content[:200]}")
+        error_class = f'HTTP {status}'
+        return False, f'HTTP状态码: {status}'
+
+    except TransferCancelled:
+        error_class = 'cancelled'
+        print(f"已取消发送书籍: {title}")
+        return False, CANCELLED_MESSAGE
+    except TransferTimeout as e:
+        # 设备仍在接收，只是太慢，不计入设备熔断
+        error_class = 'deadline'
+        error_msg = f'传输超时：{e}（{deadline:.0f} 秒）'
+        print(f"发送书籍 {title} 超时: {error_msg}")
+        return False, error_msg
+    except (FileNotFoundError, PermissionError, IsADirectoryError) as e:
+        error_class = type(e).__name__
+        error_msg = f'无法读取书籍文件：{e}'
+        print(f"发送书籍 {title} 时读取文件失败: {error_msg}")
+        return False, error_msg
+    except (OSError, http.client.HTTPException) as e:
+        if control is not None and control.cancelled:
+            # 取消时关闭 socket 引起的错误，不计入设备故障
+            error_class = 'cancelled'
+            print(f"已取消发送书籍: {title}")
+            return False, CANCELLED_MESSAGE
+        error_class = type(e).__name__
+        get_health(address).record_failure()
+        if isinstance(e, ConnectionRefusedError):
+            error_msg = '无法连接到多看阅读WiFi服务（连接被拒绝）'
+        else:
+            error_msg = f'无法连接到多看阅读WiFi服务：{e}'
+        print(f"发送书籍 {title} 发生网络错误: {error_msg}")
+        return False, error_msg
+    except Exception as e:
+        import traceback
+        error_class = type(e).__name__
+        error_msg = f'发送书籍 {title} 时出现未预期错误：{type(e).__name__}: {str(e)}'
+        print(f"{error_msg}\n{traceback.format_exc()}")
+        return False, error_msg
+    finally:
+        # 被取消的上传不计入耗时历史
+        if on_record is not None and error_class != 'cancelled':
+            try:
+                on_record(transfer_record(
+                    address, title, nbytes, time.monotonic() - started, timing, status, error_class))
+            except Exception as e:
+                print(f"记录传输耗时失败: {type(e).__name__}: {e}")
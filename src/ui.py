@@ -12,67 +12,115 @@ from calibre.gui2.actions import InterfaceAction
 from calibre.gui2 import error_dialog, info_dialog
 
 try:
-    from qt.core import QMenu, QInputDialog, QLineEdit
-    from qt.gui import QIcon
+    from qt.core import QMenu, QInputDialog, QLineEdit, QTimer, pyqtSignal
 except ImportError:
-    from PyQt5.Qt import QMenu, QInputDialog, QLineEdit, QIcon
+    from PyQt5.Qt import QMenu, QInputDialog, QLineEdit, QTimer, pyqtSignal
+
+PREFS_NAME = 'plugins/duokan_wifi_transfer'
+DEFAULT_ADDRESS = 'http://192.168.1.100:8080'
+
+# get_icons() 注册的图标名称，都指向 images/icon.png
+ICON_NAMES = ('images/icon.png', 'icon', 'icon.png', 'default')
+# 图标数据，第一次调用 get_icons() 时从磁盘读取
+_icons = None
+# calibre 启动完成后等待多久（毫秒）再读取设置、恢复自动发送
+AUTO_SEND_RESTORE_DELAY = 2000
 
 class InterfacePlugin(InterfaceAction):
     name = '多看阅读WiFi传书'
     action_spec = ('多看阅读WiFi传书', 'images/icon.png', '一键传书到多看阅读', 'Ctrl+Shift+D')
     
+    # 自动发送合并出一批书籍 ID 和这批结束时 set() 的 threading.Event；从自动
+    # 发送线程发出，在界面线程中提交给传输服务
+    auto_send_requested = pyqtSignal(list, object)
+    
     def get_icons(self):
         """
         Return all icons for this plugin.
         Calibre will call this method to get icons.
         """
-        import os
-        icons = {}
-        base = os.path.dirname(os.path.abspath(__file__))
-        
-        # 定义所有可能的图标名称映射到同一个图标文件
-        icon_path = os.path.join(base, 'images', 'icon.png')
-        
-        # 检查图标文件是否存在
-        if os.path.exists(icon_path):
-            with open(icon_path, 'rb') as f:
-                icon_data = f.read()
+        global _icons
+        if _icons is None:
+            _icons = {}
+            icon_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'images', 'icon.png')
+            # 检查图标文件是否存在
+            if os.path.exists(icon_path):
+                with open(icon_path, 'rb') as f:
+                    icon_data = f.read()
                 # 注册多个可能的名称，确保Calibre能找到图标
-                icons['images/icon.png'] = icon_data
-                icons['icon'] = icon_data
-                icons['icon.png'] = icon_data
-                icons['default'] = icon_data
-        
-        return icons
+                _icons = dict.fromkeys(ICON_NAMES, icon_data)
+        return dict(_icons)
     
     def genesis(self):
+        # calibre 启动时只连接工具栏动作；菜单在第一次展开时创建，设置、图标
+        # 和对话框、传输等模块都在第一次使用时加载
         self.qaction.triggered.connect(self.show_dialog)
-        
-        # 创建菜单
         self.menu = QMenu(self.gui)
+        self.menu.aboutToShow.connect(self.build_menu)
         self.qaction.setMenu(self.menu)
-        
-        # 添加菜单项
-        try:
-            # 尝试获取图标并添加到菜单项
-            icon = self.get_icon('images/icon.png')
-            if icon:
-                self.send_action = self.menu.addAction(icon, '发送选中的书籍', self.show_dialog)
-            else:
-                self.send_action = self.menu.addAction('发送选中的书籍', self.show_dialog)
-        except:
-            # 如果获取图标失败，添加无图标的菜单项
-            self.send_action = self.menu.addAction('发送选中的书籍', self.show_dialog)
+        self._prefs = None
+        self._address = None
+        self.auto_sender = None
+        self.auto_send_waiters = {}  # {TransferJob: 自动发送线程等待的 Event}
+    
+    def build_menu(self):
+        """第一次展开菜单时添加菜单项"""
+        self.menu.aboutToShow.disconnect(self.build_menu)
+        # 菜单项沿用 calibre 已为工具栏动作加载的图标
+        self.send_action = self.menu.addAction(self.qaction.icon(), '发送选中的书籍', self.show_dialog)
+        self.quick_send_action = self.menu.addAction('按保存的设置直接发送', self.quick_send)
+        self.jobs_action = self.menu.addAction('传输任务', self.show_jobs)
         self.config_action = self.menu.addAction('配置WiFi地址', self.configure)
-        
-        # 从设置加载WiFi地址
-        from calibre.utils.config import JSONConfig
-        self.prefs = JSONConfig('plugins/duokan_wifi_transfer')
-        self.duokan_wifi_address = self.prefs.get('wifi_address', 'http://192.168.1.100:8080')
+        self.stats_action = self.menu.addAction('传输统计', self.show_stats)
+        self.auto_send_action = self.menu.addAction('自动发送新书', self.toggle_auto_send)
+        self.auto_send_action.setCheckable(True)
+        self.auto_send_action.setChecked(bool(self.prefs.get('auto_send', False)))
+    
+    @property
+    def prefs(self):
+        """插件设置（JSONConfig），第一次使用时加载"""
+        if self._prefs is None:
+            from calibre.utils.config import JSONConfig
+            self._prefs = JSONConfig(PREFS_NAME)
+        return self._prefs
+    
+    @property
+    def duokan_wifi_address(self):
+        """当前发送地址：对话框中最近使用的地址，否则为设置中保存的地址"""
+        if self._address is None:
+            self._address = self.prefs.get('wifi_address', DEFAULT_ADDRESS)
+        return self._address
+    
+    @duokan_wifi_address.setter
+    def duokan_wifi_address(self, address):
+        self._address = address
+    
+    def initialization_complete(self):
+        # 是否恢复自动发送要读取设置，推迟到启动之后，不计入 calibre 的启动时间
+        QTimer.singleShot(AUTO_SEND_RESTORE_DELAY, self.restore_auto_send)
+    
+    def restore_auto_send(self):
+        if self.prefs.get('auto_send', False):
+            self.start_auto_send()
+    
+    def library_changed(self, db):
+        # 监听器绑定在书库上，切换书库后重新注册；自动发送已关闭时不再启动
+        if self.auto_sender is not None and self.prefs.get('auto_send', False):
+            self.auto_sender.start(db.new_api)
+    
+    def shutting_down(self):
+        if self.auto_sender is not None:
+            self.auto_sender.stop()
+        if getattr(self, 'service', None) is not None:
+            self.service.shutdown()
+        for done in self.auto_send_waiters.values():
+            done.set()
+        self.auto_send_waiters = {}
+        return True
     
     def configure(self):
-        self.prefs = self.load_settings()
-        current_address = self.prefs.get('wifi_address', 'http://192.168.1.100:8080')
+        self.load_settings()
+        current_address = self.prefs.get('wifi_address', DEFAULT_ADDRESS)
         
         new_address, ok = QInputDialog.getText(
             self.gui, '配置多看阅读WiFi地址',
@@ -85,163 +133,239 @@ class InterfacePlugin(InterfaceAction):
                 new_address = 'http://' + new_address
             
             self.prefs['wifi_address'] = new_address
+            # 菜单中只配置单个地址，覆盖对话框中保存的多设备地址
+            self.prefs['wifi_addresses'] = [new_address]
             self.duokan_wifi_address = new_address
             info_dialog(self.gui, '成功', '多看阅读WiFi地址已更新为: %s' % new_address, show=True)
     
     def load_settings(self):
-        from calibre.utils.config import JSONConfig
-        self.prefs = JSONConfig('plugins/duokan_wifi_transfer')
+        """重新从磁盘读取设置"""
+        self._prefs = None
         return self.prefs
     
+    def get_manifest(self):
+        """已发送书籍清单，首次使用时才从磁盘加载。"""
+        if getattr(self, 'manifest', None) is None:
+            from calibre_plugins.duokan_wifi_transfer.manifest import SentManifest
+            self.manifest = SentManifest()
+        return self.manifest
+    
+    def get_queue(self):
+        """持久发送队列，首次使用时打开。"""
+        if getattr(self, 'transfer_queue', None) is None:
+            from calibre_plugins.duokan_wifi_transfer.sendqueue import TransferQueue, DEFAULT_MAX_ATTEMPTS
+            self.transfer_queue = TransferQueue(
+                max_attempts=int(self.prefs.get('retry_attempts', DEFAULT_MAX_ATTEMPTS)))
+        return self.transfer_queue
+    
+    def get_metrics(self):
+        """传输耗时历史，首次使用时创建。"""
+        if getattr(self, 'metrics', None) is None:
+            from calibre_plugins.duokan_wifi_transfer.metrics import MetricsHistory
+            self.metrics = MetricsHistory(
+                max_bytes=int(self.prefs.get('history_max_kb', 1024)) * 1024)
+        return self.metrics
+    
+    def get_slimmer(self):
+        """发送前精简 EPUB 的处理器，精简选项、进程数或缓存上限变化时重新创建。"""
+        from calibre_plugins.duokan_wifi_transfer.engine import slimmer_settings
+        settings = slimmer_settings(self.prefs)
+        if getattr(self, 'slimmer', None) is None or self.slimmer_settings != settings:
+            from calibre_plugins.duokan_wifi_transfer.slim import EpubSlimmer
+            self.slimmer = EpubSlimmer(**settings)
+            self.slimmer_settings = settings
+        return self.slimmer
+    
+    def get_preflight(self):
+        """EPUB 完整性预检，首次使用时加载缓存的结论。"""
+        if getattr(self, 'preflight', None) is None:
+            from calibre_plugins.duokan_wifi_transfer.preflight import (
+                EpubPreflight, DEFAULT_PREFLIGHT_WORKERS)
+            self.preflight = EpubPreflight(
+                max_workers=int(self.prefs.get('preflight_workers', DEFAULT_PREFLIGHT_WORKERS)))
+        return self.preflight
+    
+    def get_service(self):
+        """插件级的传输服务，所有发送任务在这里排队，首次使用时创建。"""
+        if getattr(self, 'service', None) is None:
+            from calibre_plugins.duokan_wifi_transfer.service import TransferService
+            self.service = TransferService(self.gui)
+            self.service.job_finished.connect(self.on_job_finished)
+        return self.service
+    
+    def on_job_finished(self, job):
+        done = self.auto_send_waiters.pop(job, None)
+        if done is not None:
+            done.set()
+        self.gui.status_bar.show_message(
+            f'多看阅读: {job.title} {job.state_label}，{job.summary}', 10000)
+    
+    def get_converter(self):
+        """把非 EPUB 格式转换为 EPUB 的处理器，进程数或缓存上限变化时重新创建。"""
+        from calibre_plugins.duokan_wifi_transfer.engine import converter_settings
+        settings = converter_settings(self.prefs)
+        if getattr(self, 'converter', None) is None or self.converter_settings != settings:
+            from calibre_plugins.duokan_wifi_transfer.convert import EpubConverter
+            self.converter = EpubConverter(**settings)
+            self.converter_settings = settings
+        return self.converter
+    
+    def toggle_auto_send(self, checked=False):
+        self.prefs['auto_send'] = bool(checked)
+        if checked:
+            self.start_auto_send()
+        elif self.auto_sender is not None:
+            # 保留实例以便再次打开时复用其后台线程；library_changed 按设置判断
+            self.auto_sender.stop()
+    
+    def start_auto_send(self):
+        """监听书库中新增的 EPUB（启用转换时还包括可转换的格式），合并后在后台发送。"""
+        if self.auto_sender is None:
+            from calibre_plugins.duokan_wifi_transfer.autosend import (
+                AutoSender, DEFAULT_DELAY, DEFAULT_MAX_DELAY)
+            from calibre_plugins.duokan_wifi_transfer.convert import DEFAULT_SOURCE_FORMATS
+            formats = ['EPUB']
+            if self.prefs.get('convert_enabled', False):
+                formats.extend(self.prefs.get('convert_source_formats', DEFAULT_SOURCE_FORMATS))
+            self.auto_sender = AutoSender(
+                self.auto_send_books,
+                delay=float(self.prefs.get('auto_send_delay', DEFAULT_DELAY)),
+                max_delay=float(self.prefs.get('auto_send_max_delay', DEFAULT_MAX_DELAY)),
+                formats=formats)
+            self.auto_send_requested.connect(self.on_auto_send_requested)
+        self.auto_sender.start(self.gui.current_db.new_api)
+    
+    def auto_send_books(self, book_ids):
+        """在自动发送线程中调用：把这批书转交界面线程提交给传输服务，并等待
+        任务结束，其间到达的书由 AutoSender 合并为下一批。"""
+        import threading
+        done = threading.Event()
+        self.auto_send_requested.emit(list(book_ids), done)
+        done.wait()
+    
+    def on_auto_send_requested(self, book_ids, done):
+        db = self.auto_sender.db if self.auto_sender is not None else None
+        if db is None:
+            done.set()
+            return
+        print(f"自动发送 {len(book_ids)} 本书")
+        try:
+            job = self.submit_books(db, book_ids, f'自动发送 {len(book_ids)} 本书')
+        except Exception:
+            done.set()
+            raise
+        self.auto_send_waiters[job] = done
+    
+    def make_send_worker(self, db, book_ids):
+        """按保存的设置为一批书创建发送线程（尚未启动）。
+
+        配置了多个地址时同时发送到各台设备。书名和格式在发送线程中按批读取，
+        发送状态写入持久队列。
+        """
+        from calibre_plugins.duokan_wifi_transfer.main import SendBooksWorker, FanoutWorker
+        from calibre_plugins.duokan_wifi_transfer.engine import (
+            iter_book_batches, DEFAULT_SOURCE_FORMATS, DEFAULT_MAX_CONCURRENT_UPLOADS,
+            ORDER_ORIGINAL, MIN_UPLOAD_TIMEOUT)
+        from calibre_plugins.duokan_wifi_transfer.health import DEFAULT_OUTAGE_WAIT
+        prefs = self.prefs
+        convert = bool(prefs.get('convert_enabled', False))
+        preparers = []
+        if convert:
+            preparers.append(self.get_converter())
+        if prefs.get('slim_enabled', False):
+            preparers.append(self.get_slimmer())
+        books = iter_book_batches(db, book_ids, convert=convert, source_formats=prefs.get(
+            'convert_source_formats', DEFAULT_SOURCE_FORMATS))
+        if prefs.get('preflight_enabled', True):
+            books = self.get_preflight().check_batches(books)
+        options = dict(
+            transfer_queue=self.get_queue(), manifest=self.get_manifest(),
+            skip_sent=bool(prefs.get('skip_sent_books', True)), preparers=preparers,
+            max_workers=int(prefs.get('max_concurrent_uploads', DEFAULT_MAX_CONCURRENT_UPLOADS)),
+            ordered=prefs.get('preserve_send_order', False),
+            order=prefs.get('send_order', ORDER_ORIGINAL),
+            min_timeout=int(prefs.get('upload_timeout', MIN_UPLOAD_TIMEOUT)),
+            outage_wait=float(prefs.get('device_outage_wait', DEFAULT_OUTAGE_WAIT)))
+        addresses = prefs.get('wifi_addresses') or [self.duokan_wifi_address]
+        if len(addresses) > 1:
+            return FanoutWorker(self, addresses, books, **options)
+        return SendBooksWorker(self, books, address=addresses[0], **options)
+    
+    def submit_books(self, db, book_ids, title):
+        """按保存的设置发送一批书，排在正在进行的任务之后，返回 TransferJob。"""
+        return self.get_service().submit(self.make_send_worker(db, book_ids), title)
+    
+    def quick_send(self):
+        """不打开对话框，把选中的书按保存的设置加入发送队列"""
+        rows = self.gui.library_view.selectionModel().selectedRows()
+        if not rows:
+            return error_dialog(self.gui, '错误', '请先选择要发送的书籍', show=True)
+        ids = list(map(self.gui.library_view.model().id, rows))
+        job = self.submit_books(self.gui.current_db.new_api, ids, f'发送 {len(ids)} 本书')
+        message = f'多看阅读: 已将 {len(ids)} 本书加入发送队列'
+        ahead = self.get_service().pending_ahead(job)
+        if ahead:
+            message += f'，前面还有 {ahead} 个任务'
+        self.gui.status_bar.show_message(message, 5000)
+    
     def show_dialog(self):
-        from calibre_plugins.duokan_wifi_transfer.main import DuokanWiFiDialog
-        dialog = DuokanWiFiDialog(self.gui, self)
+        # 对话框不是模态的，发送期间可以继续使用 calibre；重复打开时复用同一个
+        # 对话框并刷新选中的书籍
+        if getattr(self, 'dialog', None) is None:
+            from calibre_plugins.duokan_wifi_transfer.main import DuokanWiFiDialog
+            self.dialog = DuokanWiFiDialog(self.gui, self)
+        else:
+            self.dialog.update_book_info()
+            self.dialog.update_resume_button()
+        self.dialog.show()
+        self.dialog.raise_()
+        self.dialog.activateWindow()
+    
+    def show_jobs(self):
+        if getattr(self, 'jobs_dialog', None) is None:
+            from calibre_plugins.duokan_wifi_transfer.main import TransferJobsDialog
+            self.jobs_dialog = TransferJobsDialog(self.gui, self.get_service())
+        self.jobs_dialog.show()
+        self.jobs_dialog.refresh()
+        self.jobs_dialog.raise_()
+        self.jobs_dialog.activateWindow()
+    
+    def show_stats(self):
+        from calibre_plugins.duokan_wifi_transfer.main import TransferStatsDialog
+        dialog = TransferStatsDialog(self.gui, self)
         exec_method = getattr(dialog, 'exec', dialog.exec_)
         exec_method()
     
-    def send_book_to_duokan(self, epub_path, title):
-        """发送书籍到多看阅读"""
-        try:
-            import urllib.request
-            import urllib.error
-            import mimetypes
-            import uuid
-            
-            # 打印调试信息
-            print(f"正在发送书籍: {title}")
-            print(f"目标地址: {self.duokan_wifi_address}/files")
-            print(f"文件路径: {epub_path}")
-            
-            # 生成分隔符
-            boundary = str(uuid.uuid4())
-            
-            # 构建multipart表单数据
-            content_type = mimetypes.guess_type(epub_path)[0] or 'application/epub+zip'
-            filename = os.path.basename(epub_path)
-            preamble = (
-                f'--{boundary}\r\n'
-                f'Content-Disposition: form-data; name="newfile"; filename="{filename}"\r\n'
-                f'Content-Type: {content_type}\r\n'
-                '\r\n'
-            ).encode()
-            epilogue = f'\r\n--{boundary}--\r\n'.encode()
-            file_size = os.path.getsize(epub_path)
-            content_length = len(preamble) + file_size + len(epilogue)
-
-            headers = {
-                'User-Agent': 'Calibre Duokan Plugin/1.0',
-                'Content-Type': f'multipart/form-data; boundary={boundary}',
-                'Content-Length': str(content_length)
-            }
-
-            class MultipartStream:
-                """按需读取 multipart 内容，避免一次性加载整本书。"""
+    def send_book_to_duokan(self, epub_path, title, address=None, on_progress=None, filename=None,
+                            tee=None, timeout=None, control=None, deadline=None):
+        """发送书籍到多看阅读
 
-                def __init__(self, path, head, tail, chunk_size=64 * 1024):
-                    self.path = path
-                    self.head = head
-                    self.tail = tail
-                    self.chunk_size = chunk_size
-                    self._head_pos = 0
-                    self._tail_pos = 0
-                    self._stage = 'head'
-                    self._file = None
-
-                def read(self, size=-1):
-                    if size == 0:
-                        return b''
-
-                    chunks = bytearray()
-                    remaining = size
-
-                    while size < 0 or remaining > 0:
-                        if self._stage == 'head':
-                            data = self.head[self._head_pos:]
-                            if not data:
-                                self._stage = 'file'
-                                continue
-                            if size >= 0:
-                                data = data[:remaining]
-                            self._head_pos += len(data)
-                            chunks.extend(data)
-                        elif self._stage == 'file':
-                            if self._file is None:
-                                self._file = open(self.path, 'rb')
-                            to_read = self.chunk_size if size < 0 else min(self.chunk_size, remaining)
-                            data = self._file.read(to_read)
-                            if data:
-                                chunks.extend(data)
-                            else:
-                                self._file.close()
-                                self._file = None
-                                self._stage = 'tail'
-                                continue
-                        elif self._stage == 'tail':
-                            data = self.tail[self._tail_pos:]
-                            if not data:
-                                self._stage = 'done'
-                                break
-                            if size >= 0:
-                                data = data[:remaining]
-                            self._tail_pos += len(data)
-                            chunks.extend(data)
-                        else:
-                            break
-
-                        if size >= 0:
-                            remaining -= len(data)
-                            if remaining <= 0:
-                                break
-
-                    return bytes(chunks)
-
-                def close(self):
-                    if self._file:
-                        self._file.close()
-                        self._file = None
-
-            stream = MultipartStream(epub_path, preamble, epilogue)
-
-            try:
-                request = urllib.request.Request(
-                    self.duokan_wifi_address + '/files',  # 修改为正确的URL
-                    data=stream,
-                    headers=headers,
-                    method='POST'
-                )
-                
-                # 发送请求
-                response = urllib.request.urlopen(request, timeout=30)
-            finally:
-                stream.close()
-            
-            # 打印响应信息
-            raw_content = response.read()
-            encoding = response.headers.get_content_charset() or 'utf-8'
-            try:
-                response_content = raw_content.decode(encoding)
-            except UnicodeDecodeError:
-                response_content = raw_content.decode('utf-8', errors='replace')
-            
-            print(f"响应状态码: {response.status}")
-            print(f"响应内容: {response_content}")
-            
-            if response.status == 200:
-                return True, None
-            else:
-                error_msg = f'HTTP状态码: {response.status}'
-                return False, error_msg
-                
-        except urllib.error.URLError as e:
-            reason = getattr(e, 'reason', e)
-            if isinstance(reason, ConnectionRefusedError):
-                error_msg = '无法连接到多看阅读WiFi服务（连接被拒绝）'
-            else:
-                error_msg = f'无法连接到多看阅读WiFi服务：{reason}'
-            print(f"发送书籍 {title} 发生网络错误: {error_msg}")
-            return False, error_msg
-        except Exception as e:
-            import traceback
-            error_msg = f'发送书籍 {title} 时出现未预期错误：{type(e).__name__}: {str(e)}'
-            print(f"{error_msg}\n{traceback.format_exc()}")
-            return False, error_msg
+        address 为空时使用当前配置的地址；并发发送时由调用方显式传入，
+        避免批次进行中修改设置影响正在上传的书籍。on_progress(delta) 在每个
+        分块发出后以新发送的字节数调用。filename 为设备上保存的文件名，
+        默认取 epub_path 的文件名；tee 为多设备发送时共享的文件分块；timeout
+        为连接和每次读写的超时秒数，默认取设置 upload_timeout；deadline 为整本
+        书的传输时限，批量发送时按书的大小和实测速率计算；control 为批次
+        的 TransferControl，用于暂停和取消。
+        """
+        from calibre_plugins.duokan_wifi_transfer.transfer import send_book, get_limiter, DEFAULT_CHUNK_SIZE
+        from calibre_plugins.duokan_wifi_transfer.engine import MIN_UPLOAD_TIMEOUT
+        address = address or self.duokan_wifi_address
+        return send_book(
+            epub_path, title, address,
+            on_progress=on_progress,
+            filename=filename,
+            chunk_size=int(self.prefs.get('upload_chunk_size', DEFAULT_CHUNK_SIZE)),
+            send_buffer=self.prefs.get('socket_send_buffer') or None,
+            tee=tee,
+            timeout=timeout or int(self.prefs.get('upload_timeout', MIN_UPLOAD_TIMEOUT)),
+            on_record=self.get_metrics().append if self.prefs.get('record_history', True) else None,
+            limiter=get_limiter(address, self.get_rate_limit()),
+            control=control,
+            deadline=deadline
+        )
+    
+    def get_rate_limit(self):
+        """按设置生成上传限速（RateSchedule），未启用时返回 0。"""
+        from calibre_plugins.duokan_wifi_transfer.engine import rate_limit_from_prefs
+        return rate_limit_from_prefs(self.prefs)
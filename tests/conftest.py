@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+
+# 不执行插件的 __init__.py（依赖 calibre），把 src/ 注册为
+# calibre_plugins.duokan_wifi_transfer 包，只测试不依赖 Qt 的模块。
+
+import os
+import sys
+import types
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+if 'calibre_plugins.duokan_wifi_transfer' not in sys.modules:
+    namespace = sys.modules.setdefault('calibre_plugins', types.ModuleType('calibre_plugins'))
+    namespace.__path__ = getattr(namespace, '__path__', [])
+    package = types.ModuleType('calibre_plugins.duokan_wifi_transfer')
+    package.__path__ = [SRC]
+    sys.modules['calibre_plugins.duokan_wifi_transfer'] = package
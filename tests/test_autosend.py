@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+
+from calibre_plugins.duokan_wifi_transfer import autosend
+
+
+class Flushes(object):
+    def __init__(self):
+        self.batches = []
+        self.event = threading.Event()
+
+    def __call__(self, book_ids):
+        self.batches.append((time.monotonic(), book_ids))
+        self.event.set()
+
+
+def test_debouncer_merges_events_and_keeps_order():
+    flushes = Flushes()
+    debouncer = autosend.Debouncer(flushes, delay=0.1, max_delay=5)
+    debouncer.add([3, 1])
+    debouncer.add([2, 3])
+    assert flushes.batches == []
+    assert flushes.event.wait(2)
+    assert [ids for _, ids in flushes.batches] == [[3, 1, 2]]
+
+
+def test_debouncer_flushes_by_max_delay_while_events_continue():
+    flushes = Flushes()
+    debouncer = autosend.Debouncer(flushes, delay=0.2, max_delay=0.3)
+    started = time.monotonic()
+    for book_id in range(10):
+        debouncer.add([book_id])
+        time.sleep(0.05)
+    debouncer.cancel()
+    assert flushes.batches, '持续有事件时仍应在 max_delay 后发送'
+    flushed_at, ids = flushes.batches[0]
+    assert flushed_at - started < 0.45
+    assert ids == list(range(len(ids)))
+
+
+def test_debouncer_cancel_drops_pending_ids():
+    flushes = Flushes()
+    debouncer = autosend.Debouncer(flushes, delay=0.05, max_delay=1)
+    debouncer.add([1])
+    debouncer.cancel()
+    assert not flushes.event.wait(0.2)
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+import itertools
+import os
+
+import pytest
+
+from calibre_plugins.duokan_wifi_transfer import engine, sendqueue
+
+# 每个测试使用不同的设备地址，避免共享的连接槽、熔断和超时状态互相影响
+_addresses = itertools.count(1)
+
+
+@pytest.fixture
+def address():
+    return f'http://192.0.2.{next(_addresses)}:12121'
+
+
+@pytest.fixture
+def transfer_queue(tmp_path):
+    queue = sendqueue.TransferQueue(str(tmp_path / 'queue.sqlite'), max_attempts=3, base_delay=0.05)
+    yield queue
+    queue.close()
+
+
+@pytest.fixture
+def books(tmp_path):
+    books = []
+    for i in range(3):
+        path = str(tmp_path / f'{i}.epub')
+        with open(path, 'wb') as f:
+            f.write(b'x' * 100)
+        books.append({'book_id': i, 'title': f'book {i}', 'path': path})
+    return books
+
+
+class FlakySend(object):
+    """每本书前 failures[书名] 次发送失败，之后成功。"""
+
+    def __init__(self, failures):
+        self.failures = dict(failures)
+        self.calls = []
+
+    def __call__(self, path, title, address=None, **kwargs):
+        self.calls.append(title)
+        if self.failures.get(title, 0) > 0:
+            self.failures[title] -= 1
+            return False, 'HTTP 503'
+        return True, ''
+
+
+def test_retry_delay_backs_off_exponentially():
+    assert [sendqueue.retry_delay(n, base=5, maximum=30) for n in range(1, 6)] == [5, 10, 20, 30, 30]
+
+
+def test_mark_failed_returns_none_when_attempts_run_out(transfer_queue, address, books):
+    transfer_queue.enqueue(address, books[:1])
+    queue_id = books[0]['queue_id']
+    assert transfer_queue.mark_failed(queue_id, 'e1') == pytest.approx(0.05)
+    assert transfer_queue.mark_failed(queue_id, 'e2') == pytest.approx(0.1)
+    assert transfer_queue.mark_failed(queue_id, 'e3') is None
+    assert transfer_queue.failed(address) == [('book 0', 'e3')]
+
+
+def test_queued_sender_retries_with_backoff(transfer_queue, address, books):
+    send = FlakySend({'book 1': 2})
+    waits = []
+    results = []
+    sender = engine.QueuedSender(
+        transfer_queue, send, address, [dict(book) for book in books],
+        on_retry_wait=lambda count, delay: waits.append((count, delay)),
+        on_result=lambda book, success, error: results.append((book['title'], success)))
+    success_count, failed_books = sender.run()
+    assert (success_count, failed_books) == (3, [])
+    assert send.calls.count('book 1') == 3
+    assert send.calls.count('book 0') == send.calls.count('book 2') == 1
+    # 两次等待都只剩 book 1，第二次的退避时间约为第一次的两倍
+    assert [count for count, _ in waits] == [1, 1]
+    assert waits[0][1] <= 0.05 + 0.01
+    assert 0.05 < waits[1][1] <= 0.1 + 0.01
+    assert sorted(results) == [('book 0', True), ('book 1', True), ('book 2', True)]
+
+
+def test_queued_sender_reports_failure_after_max_attempts(transfer_queue, address, books):
+    send = FlakySend({'book 0': 10})
+    results = []
+    sender = engine.QueuedSender(
+        transfer_queue, send, address, [dict(book) for book in books[:1]],
+        on_result=lambda book, success, error: results.append((book['title'], success, error)))
+    success_count, failed_books = sender.run()
+    assert success_count == 0
+    assert failed_books == [('book 0', 'HTTP 503')]
+    assert send.calls == ['book 0'] * 3
+    # on_result 只在最终失败时调用一次
+    assert results == [('book 0', False, 'HTTP 503')]
+
+
+def test_queued_sender_does_not_retry_missing_file(transfer_queue, address, books):
+    send = FlakySend({'book 0': 10})
+    os.remove(books[0]['path'])
+    sender = engine.QueuedSender(transfer_queue, send, address, [dict(books[0])])
+    success_count, failed_books = sender.run()
+    assert success_count == 0 and len(failed_books) == 1
+    # 失败一次后发现文件已不存在，不再重试
+    assert send.calls == ['book 0']
+
+
+def test_queued_sender_cancel_leaves_books_pending(transfer_queue, address, books):
+    send = FlakySend({'book 0': 10})
+    cancelled = []
+    sender = engine.QueuedSender(
+        transfer_queue, send, address, [dict(book) for book in books[:1]],
+        on_retry_wait=lambda count, delay: cancelled.append(True),
+        cancelled=lambda: bool(cancelled))
+    success_count, failed_books = sender.run()
+    assert (success_count, failed_books) == (0, [])
+    assert send.calls == ['book 0']
+    assert [book['title'] for book in transfer_queue.due(address, now=float('inf'))] == ['book 0']
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+from calibre_plugins.duokan_wifi_transfer import health
+
+ADDRESS = 'http://192.0.2.1:12121'
+
+
+@pytest.fixture
+def probes(monkeypatch):
+    """代替网络探测：依次返回 results 中的结果，并记录调用次数。"""
+    state = {'results': [False], 'calls': 0}
+
+    def fake_probe(address, timeout=health.PROBE_TIMEOUT):
+        state['calls'] += 1
+        return state['results'][min(state['calls'], len(state['results'])) - 1]
+
+    monkeypatch.setattr(health, 'probe', fake_probe)
+    return state
+
+
+def test_trips_after_threshold_consecutive_failures():
+    device = health.DeviceHealth(ADDRESS, threshold=3)
+    device.record_failure()
+    device.record_failure()
+    assert not device.tripped
+    device.record_success()
+    device.record_failure()
+    device.record_failure()
+    assert not device.tripped
+    device.record_failure()
+    assert device.tripped
+    device.record_success()
+    assert not device.tripped and device.failures == 0
+
+
+def test_probe_result_is_cached_for_probe_interval(probes):
+    device = health.DeviceHealth(ADDRESS, probe_interval=60)
+    assert device.reachable() is False
+    assert device.reachable() is False
+    assert probes['calls'] == 1
+    assert device.reachable(max_age=0) is False
+    assert probes['calls'] == 2
+
+
+def test_wait_until_reachable_gives_up_after_max_wait(probes):
+    device = health.DeviceHealth(ADDRESS, threshold=1, probe_interval=0)
+    device.record_failure()
+    assert device.wait_until_reachable(max_wait=0) is False
+    assert device.tripped
+
+
+def test_wait_until_reachable_resumes_when_probe_succeeds(probes):
+    probes['results'] = [False, True]
+    device = health.DeviceHealth(ADDRESS, threshold=1, probe_interval=0)
+    device.record_failure()
+    assert device.wait_until_reachable(max_wait=5) is True
+    assert not device.tripped
+    assert probes['calls'] == 2
+
+
+def test_wait_until_reachable_stops_when_cancelled(probes):
+    device = health.DeviceHealth(ADDRESS, threshold=1, probe_interval=0)
+    device.record_failure()
+    assert device.wait_until_reachable(max_wait=60, cancelled=lambda: True) is False
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from calibre_plugins.duokan_wifi_transfer import manifest
+
+
+def test_cached_file_hash_reads_file_only_when_it_changes(tmp_path, monkeypatch):
+    path = str(tmp_path / 'a.epub')
+    with open(path, 'wb') as f:
+        f.write(b'first')
+    reads = []
+    real_file_hash = manifest.file_hash
+
+    def counting_file_hash(p, *args, **kwargs):
+        reads.append(p)
+        return real_file_hash(p, *args, **kwargs)
+
+    monkeypatch.setattr(manifest, 'file_hash', counting_file_hash)
+    digest = manifest.cached_file_hash(path)
+    assert manifest.cached_file_hash(path) == digest
+    assert reads == [path]
+
+    with open(path, 'wb') as f:
+        f.write(b'second!')
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+    assert manifest.cached_file_hash(path) != digest
+    assert reads == [path, path]
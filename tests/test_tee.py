@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+import builtins
+import os
+import threading
+
+import pytest
+
+from calibre_plugins.duokan_wifi_transfer import engine, transfer
+
+CHUNK_SIZE = 1024
+
+
+@pytest.fixture
+def opens(monkeypatch):
+    """记录 transfer.py 中打开的文件路径。"""
+    paths = []
+
+    def counting_open(path, *args, **kwargs):
+        paths.append(path)
+        return builtins.open(path, *args, **kwargs)
+
+    monkeypatch.setattr(transfer, 'open', counting_open, raising=False)
+    return paths
+
+
+def write_book(directory, name, size):
+    path = os.path.join(str(directory), name)
+    with open(path, 'wb') as f:
+        f.write(os.urandom(size))
+    return path
+
+
+def read_all(tee, consumer, path, size):
+    """与 MultipartFile._send_tee 相同：按分块读取，被移出共享后自行读取剩余部分。"""
+    data = b''
+    index = 0
+    while len(data) < size:
+        chunk = tee.chunk(consumer, index)
+        if chunk is None:
+            with transfer.open(path, 'rb') as f:
+                f.seek(len(data))
+                data += f.read()
+            break
+        data += chunk
+        index += 1
+    return data
+
+
+def test_tee_serves_every_consumer_from_one_read(tmp_path, opens):
+    path = write_book(tmp_path, 'a.epub', 10 * CHUNK_SIZE + 7)
+    with open(path, 'rb') as f:
+        expected = f.read()
+    tees = transfer.TeeRegistry(chunk_size=CHUNK_SIZE, consumers=('a', 'b', 'c'))
+    # 领先的设备读完整本书并释放之后其他设备才开始
+    for consumer in ('a', 'b', 'c'):
+        tee = tees.acquire(path, consumer)
+        assert read_all(tee, consumer, path, len(expected)) == expected
+        tees.release(path, consumer)
+    assert opens == [path]
+    assert tees._tees == {}
+
+
+def test_tee_detaches_slow_consumer_when_window_is_full(tmp_path, opens):
+    path = write_book(tmp_path, 'a.epub', 10 * CHUNK_SIZE)
+    tee = transfer.TeeFile(path, CHUNK_SIZE, window=4, consumers=('fast', 'slow'))
+    for index in range(10):
+        assert tee.chunk('fast', index) is not None
+    assert len(tee._chunks) <= 4
+    # 慢设备需要的分块已被丢弃，改为自行读取
+    assert tee.chunk('slow', 0) is None
+    tee.close()
+
+
+def test_registry_keeps_at_most_window_chunks_for_late_consumers(tmp_path, opens):
+    paths = [write_book(tmp_path, f'{i}.epub', CHUNK_SIZE) for i in range(4)]
+    tees = transfer.TeeRegistry(chunk_size=CHUNK_SIZE, window=2, consumers=('a', 'b'))
+    for path in paths:
+        read_all(tees.acquire(path, 'a'), 'a', path, CHUNK_SIZE)
+        tees.release(path, 'a')
+    assert sorted(tees._tees) == sorted(paths[2:])
+    tees.forget('b')
+    assert tees._tees == {}
+
+
+def test_fanout_reads_each_book_once(tmp_path, opens):
+    devices = [f'http://192.168.1.{i}:12121' for i in range(1, 4)]
+    books = []
+    for i in range(4):
+        path = write_book(tmp_path, f'{i}.epub', 4 * CHUNK_SIZE + i)
+        books.append({'path': path, 'title': f'book {i}'})
+    received = {}
+    lock = threading.Lock()
+
+    def send(path, title, address=None, tee=None, **kwargs):
+        data = read_all(tee, address, path, os.path.getsize(path))
+        with lock:
+            received[address, path] = data
+        return True, ''
+
+    sender = engine.FanoutSender(send, devices, books, chunk_size=CHUNK_SIZE, max_workers=1)
+    results = sender.run()
+    assert all(result[0] == len(books) for result in results.values())
+    for book in books:
+        with open(book['path'], 'rb') as f:
+            expected = f.read()
+        assert all(received[address, book['path']] == expected for address in devices)
+    assert sorted(opens) == sorted(book['path'] for book in books)
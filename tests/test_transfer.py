@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+import time
+import types
+
+import pytest
+
+from calibre_plugins.duokan_wifi_transfer import transfer
+
+MB = 1024 * 1024
+
+
+class FakeClock(object):
+    """代替 transfer 模块中的 time：sleep 只推进时钟。"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(transfer, 'time', types.SimpleNamespace(
+        monotonic=clock.monotonic, sleep=clock.sleep, localtime=time.localtime))
+    return clock
+
+
+def at(hour, minute):
+    """今天本地时间 hour:minute 的时间戳。"""
+    local = time.localtime()
+    return time.mktime((local.tm_year, local.tm_mon, local.tm_mday, hour, minute, 0, 0, 0, -1))
+
+
+def test_rate_schedule_picks_rule_for_time_of_day():
+    schedule = transfer.RateSchedule(5, [('22:00', '06:00', 1), ('12:00', '13:00', 2)])
+    assert schedule(at(23, 30)) == 1 * MB
+    assert schedule(at(3, 0)) == 1 * MB
+    assert schedule(at(12, 30)) == 2 * MB
+    assert schedule(at(13, 0)) == 5 * MB
+    assert schedule(at(9, 0)) == 5 * MB
+    assert transfer.RateSchedule()(at(9, 0)) == 0
+
+
+def test_rate_schedule_rejects_malformed_rules():
+    with pytest.raises(ValueError):
+        transfer.RateSchedule(1, [('22', '06:00', 1)])
+    assert transfer.RateSchedule(1, [('1:00', '2:00', 3)]) == transfer.RateSchedule(1, [('01:00', '02:00', 3)])
+
+
+def test_token_bucket_average_rate_matches_limit(clock):
+    bucket = transfer.TokenBucket(100 * 1024)
+    for _ in range(20):
+        bucket.consume(10 * 1024)
+    # 200 KiB 以 100 KiB/s 发送；开始时令牌为空，不允许突发
+    assert sum(clock.sleeps) == pytest.approx(2.0)
+
+
+def test_token_bucket_caps_burst_after_idle(clock):
+    bucket = transfer.TokenBucket(100 * 1024)
+    clock.now += 60
+    bucket.consume(100 * 1024)
+    # 空闲期间最多积累 BURST_SECONDS 秒的令牌
+    assert sum(clock.sleeps) == pytest.approx(1.0 - transfer.BURST_SECONDS)
+
+
+def test_token_bucket_unlimited_never_sleeps(clock):
+    bucket = transfer.TokenBucket(0)
+    bucket.consume(10 * MB)
+    assert clock.sleeps == []
+    assert bucket.chunk_size(512 * 1024) == 512 * 1024
+
+
+def test_token_bucket_refreshes_scheduled_rate(clock):
+    rates = [100 * 1024]
+    bucket = transfer.TokenBucket(lambda: rates[0])
+    assert bucket.current_rate() == 100 * 1024
+    rates[0] = 200 * 1024
+    assert bucket.current_rate() == 100 * 1024
+    clock.now += transfer.RATE_REFRESH_INTERVAL
+    assert bucket.current_rate() == 200 * 1024
+    assert bucket.chunk_size(512 * 1024) == max(
+        transfer.MIN_LIMITED_CHUNK, int(200 * 1024 * transfer.LIMITED_CHUNK_SECONDS))